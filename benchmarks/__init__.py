@@ -0,0 +1,5 @@
+"""
+Бенчмарки бота воронки "Антистресс"
+
+Запуск из корня проекта: python -m benchmarks.<имя_модуля>
+"""
@@ -0,0 +1,102 @@
+"""
+Сравнение пропускной способности базы данных:
+соединение на каждый вызов против пула долгоживущих соединений (WAL)
+
+Запуск: python -m benchmarks.bench_database [--users 2000]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+from database import Database
+
+
+class PerCallDatabase(Database):
+    """Прежняя схема работы: новое соединение, один запрос, коммит и закрытие"""
+    
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        super().close()
+        # Схема создана через пул - возвращаем журнал по умолчанию, как было раньше
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+    
+    def add_user(self, user_id, username=None, first_name=None, last_name=None):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
+        if cursor.fetchone():
+            conn.close()
+            return False
+        added_date = datetime.now().isoformat()
+        cursor.execute('''
+            INSERT INTO users (user_id, username, first_name, last_name, added_date, status, last_message_time)
+            VALUES (?, ?, ?, ?, ?, 'file_sent', ?)
+        ''', (user_id, username, first_name, last_name, added_date, added_date))
+        conn.commit()
+        conn.close()
+        return True
+    
+    def get_user_info(self, user_id):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, status, contact_provided FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row
+    
+    def update_user_status(self, user_id, status, update_time=True):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE users SET status = ?, last_message_time = ? WHERE user_id = ?',
+            (status, datetime.now().isoformat(), user_id)
+        )
+        conn.commit()
+        conn.close()
+
+
+def run_workload(db, users: int) -> float:
+    """
+    Прогон типичной нагрузки воронки: добавление, чтение состояния, смена статуса
+    
+    Returns:
+        Количество операций в секунду
+    """
+    started = time.perf_counter()
+    for user_id in range(1, users + 1):
+        db.add_user(user_id, f'user{user_id}', 'Имя', None)
+        db.get_user_info(user_id)
+        db.get_user_info(user_id)
+        db.update_user_status(user_id, 'offer_sent')
+    elapsed = time.perf_counter() - started
+    return users * 4 / elapsed
+
+
+def bench(db_class, users: int, label: str, **kwargs):
+    """Запуск нагрузки на свежей базе во временном каталоге"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_class(os.path.join(tmp, 'bench.db'), **kwargs)
+        ops = run_workload(db, users)
+        db.close()
+    print(f"{label:<28} {ops:>10.0f} оп/с")
+    return ops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000, help='Количество синтетических пользователей')
+    args = parser.parse_args()
+    
+    print(f"Пользователей: {args.users}, операций: {args.users * 4}\n")
+    per_call = bench(PerCallDatabase, args.users, 'Соединение на вызов')
+    pooled = bench(Database, args.users, 'Пул соединений (WAL)')
+    print(f"\nУскорение: x{pooled / per_call:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""
+Нагрузочный прогон всей воронки через заглушку Bot API
+
+N синтетических пользователей проходят воронку: кодовое слово и PDF,
+предложение (через планировщик), контакт, оба догрева и рассылка.
+Для каждого этапа печатаются p50/p99 времени обработки обновления,
+обновлений в секунду, исходящих сообщений в секунду и время хранилища на обновление.
+
+Хранилище выбирается так же, как у бота (--storage или STORAGE_BACKEND).
+SQLite создаётся во временном каталоге; для postgres нужна пустая база
+в DATABASE_URL. Отложенные шаги наступают без ожидания: часы бота
+(time.time) переводятся вперёд на задержку шага.
+
+Запуск: python -m benchmarks.bench_funnel [--users 500] [--concurrency 50] [--latency 0] [--storage sqlite]
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import statistics
+import tempfile
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from benchmarks.fake_bot_api import FakeBotAPI
+
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+
+
+class StorageTimer:
+    """
+    Суммарное время вызовов методов хранилища (storage.Storage)
+    
+    Замер на границе интерфейса одинаков для всех реализаций и включает
+    ожидание очереди потока БД или пула соединений. Вложенные вызовы
+    (iter_audience_pages вызывает get_audience_page) не считаются дважды.
+    """
+    
+    def __init__(self, storage):
+        from storage import Storage
+        
+        self.total = 0.0
+        self._inside = contextvars.ContextVar('inside', default=False)
+        for name, member in vars(Storage).items():
+            if name.startswith('_') or name == 'close':
+                continue
+            if inspect.iscoroutinefunction(member):
+                setattr(storage, name, self._timed(getattr(storage, name)))
+            elif inspect.isasyncgenfunction(member):
+                setattr(storage, name, self._timed_pages(getattr(storage, name)))
+    
+    def _timed(self, method):
+        @functools.wraps(method)
+        async def timed(*args, **kwargs):
+            if self._inside.get():
+                return await method(*args, **kwargs)
+            token = self._inside.set(True)
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - started
+                self._inside.reset(token)
+        return timed
+    
+    def _timed_pages(self, method):
+        @functools.wraps(method)
+        async def timed(*args, **kwargs):
+            pages = method(*args, **kwargs).__aiter__()
+            while True:
+                try:
+                    page = await self._timed(pages.__anext__)()
+                except StopAsyncIteration:
+                    return
+                yield page
+        return timed
+
+
+class Clock:
+    """Часы бота (time.time) со сдвигом вперёд: отложенные шаги наступают сразу"""
+    
+    def __init__(self):
+        self.offset = 0.0
+        self._time = time.time
+    
+    def __enter__(self) -> 'Clock':
+        time.time = lambda: self._time() + self.offset
+        return self
+    
+    def __exit__(self, *exc_info):
+        time.time = self._time
+    
+    def advance(self, seconds: float):
+        self.offset += seconds
+
+
+class PhaseResult:
+    """Результаты одного этапа воронки"""
+    
+    def __init__(self, name: str, items: int, elapsed: float, latencies: List[float],
+                 messages: int, db_time: float):
+        self.name = name
+        self.items = items
+        self.elapsed = elapsed
+        self.latencies = latencies
+        self.messages = messages
+        self.db_time = db_time
+    
+    def row(self) -> str:
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p50 = f"{statistics.median(latencies) * 1000:.2f}"
+            p99 = f"{latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.2f}"
+        else:
+            p50 = p99 = '-'
+        rate = self.items / self.elapsed if self.elapsed else 0
+        out_rate = self.messages / self.elapsed if self.elapsed else 0
+        db_ms = self.db_time / self.items * 1000 if self.items else 0
+        return (f"{self.name:<16} {self.items:>7} {rate:>10.0f} {p50:>9} {p99:>9} "
+                f"{self.messages:>8} {out_rate:>10.0f} {db_ms:>9.3f}")
+
+
+HEADER = (f"{'Этап':<16} {'Событий':>7} {'Событий/с':>10} {'p50, мс':>9} {'p99, мс':>9} "
+          f"{'Исходящ':>8} {'Исходящ/с':>10} {'БД, мс':>9}")
+
+
+def message_update(update_id: int, user_id: int, text: Optional[str] = None,
+                   contact: Optional[dict] = None) -> dict:
+    """Обновление с сообщением пользователя в формате Bot API"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Иван', 'username': f'user{user_id}'},
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    if contact is not None:
+        message['contact'] = contact
+    return {'update_id': update_id, 'message': message}
+
+
+async def measure(name: str, api: FakeBotAPI, timer: StorageTimer, items: int,
+                  run: Callable[[List[float]], Awaitable[None]]) -> PhaseResult:
+    """Выполнить этап и снять счётчики до и после"""
+    latencies = []
+    messages_before = api.messages_sent
+    db_before = timer.total
+    started = time.perf_counter()
+    await run(latencies)
+    elapsed = time.perf_counter() - started
+    return PhaseResult(name, items, elapsed, latencies,
+                       api.messages_sent - messages_before, timer.total - db_before)
+
+
+async def process_updates(application, updates: List[dict], concurrency: int, latencies: List[float]):
+    """Прогнать обновления через обработчики, не больше concurrency одновременно"""
+    from telegram import Update
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def process(data):
+        async with semaphore:
+            update = Update.de_json(data, application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - started)
+    
+    await asyncio.gather(*(process(data) for data in updates))
+
+
+async def run_funnel(bot, api: FakeBotAPI, users: int, concurrency: int, contact_share: float):
+    """Прогон этапов воронки; возвращает результаты по этапам"""
+    import config
+    import config_timing
+    from funnel import FUNNEL
+    
+    application = bot.build_application()
+    timer = StorageTimer(bot.db)
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + users))
+    contact_users = user_ids[:int(users * contact_share)]
+    results = []
+    
+    with Clock() as clock:
+        async with application:
+            # 1. Кодовое слово: приветствие и PDF
+            updates = [message_update(i, user_id, config.CODE_WORD) for i, user_id in enumerate(user_ids)]
+            results.append(await measure('Кодовое слово', api, timer, users, lambda lat: process_updates(
+                application, updates, concurrency, lat
+            )))
+            
+            # 2. Предложение через планировщик (часы переведены - все шаги наступили)
+            clock.advance(config_timing.OFFER_DELAY_SECONDS + 1)
+            
+            async def run_offers(latencies):
+                bot.scheduler.register('offer', lambda user_id: bot.send_offer(application, user_id))
+                bot.scheduler.start()
+                while await bot.db.get_next_job_due() is not None:
+                    await asyncio.sleep(0.01)
+                await bot.scheduler.stop()
+            
+            results.append(await measure('Предложение', api, timer, users, run_offers))
+            
+            # 3. Контакты: половина текстом, половина кнопкой «поделиться контактом»
+            updates = []
+            for i, user_id in enumerate(contact_users):
+                if i % 2:
+                    contact = {'phone_number': '+79991234567', 'first_name': 'Иван', 'user_id': user_id}
+                    updates.append(message_update(users + i, user_id, contact=contact))
+                else:
+                    updates.append(message_update(users + i, user_id, 'Иван Петров +79991234567'))
+            results.append(await measure('Контакт', api, timer, len(updates), lambda lat: process_updates(
+                application, updates, concurrency, lat
+            )))
+            
+            # 4-5. Догревы: оставшиеся без контакта пользователи получают все шаги воронки
+            warmup_users = users - len(contact_users)
+            for step in FUNNEL.steps:
+                clock.advance(step.delay_seconds + 1)
+                results.append(await measure(step.title, api, timer, warmup_users, lambda lat: bot.send_due_steps(
+                    application
+                )))
+            
+            # 6. Рассылка всем пользователям командой администратора
+            async def run_broadcast(latencies):
+                await process_updates(application, [message_update(
+                    10 * users, ADMIN_ID, '/broadcast_all Нагрузочный тест'
+                )], 1, latencies)
+                while await bot.db.get_broadcasts(statuses=['running']):
+                    await asyncio.sleep(0.05)
+            
+            results.append(await measure('Рассылка', api, timer, users, run_broadcast))
+    
+    await bot.db.close()
+    return results
+
+
+async def main_async(args):
+    api = FakeBotAPI(latency=args.latency / 1000)
+    await api.start()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, 'materials.pdf')
+        with open(pdf_path, 'wb') as f:
+            f.write(b'%PDF-1.4\n' + os.urandom(64 * 1024))
+        
+        # Настройки читаются при импорте config, поэтому задаём их до импорта бота
+        os.environ.update({
+            'BOT_TOKEN': '123456:BENCHMARK',
+            'ADMIN_ID': str(ADMIN_ID),
+            'TELEGRAM_API_URL': api.url,
+            'STORAGE_BACKEND': args.storage,
+            'DATABASE_PATH': os.path.join(tmp, 'bench.db'),
+            'PDF_FILE_PATH': pdf_path,
+            'OUTBOUND_RATE_PER_SECOND': str(args.rate),
+            'BROADCAST_RATE_PER_SECOND': str(args.rate),
+            'BROADCAST_CONCURRENCY': str(args.concurrency),
+        })
+        import bot
+        
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        
+        results = await run_funnel(bot, api, args.users, args.concurrency, args.contact_share)
+    
+    await api.stop()
+    
+    print(f"\nПользователей: {args.users}, одновременно: {args.concurrency}, "
+          f"задержка Bot API: {args.latency:g} мс, хранилище: {args.storage}\n")
+    print(HEADER)
+    for result in results:
+        print(result.row())
+    print(f"\nЗапросы к Bot API: {dict(api.counts)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=500, help='Количество синтетических пользователей')
+    parser.add_argument('--concurrency', type=int, default=50, help='Обновлений в обработке одновременно')
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа Bot API, мс')
+    parser.add_argument('--contact-share', type=float, default=0.5, help='Доля пользователей, оставляющих контакт')
+    parser.add_argument('--rate', type=float, default=1000, help='Лимит исходящих сообщений в секунду')
+    parser.add_argument('--storage', choices=('sqlite', 'memory', 'postgres'),
+                        default=os.environ.get('STORAGE_BACKEND', 'sqlite'), help='Хранилище (STORAGE_BACKEND)')
+    args = parser.parse_args()
+    
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Сравнение извлечения контактов: прежние три регулярки против однопроходного разбора
+
+Проверяет оба варианта на корпусе реальных форматов (benchmarks/phone_corpus.tsv)
+и замеряет скорость на нём же.
+
+Запуск: python -m benchmarks.bench_phone [--rounds 2000]
+"""
+import argparse
+import os
+import re
+import time
+
+from phone import extract_contact_info
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'phone_corpus.tsv')
+
+
+def legacy_validate_phone_number(phone: str) -> bool:
+    """Прежняя проверка номера"""
+    clean_phone = phone.lstrip('+')
+    if not clean_phone.isdigit():
+        return False
+    if len(clean_phone) < 10 or len(clean_phone) > 12:
+        return False
+    if clean_phone[0] in ['7', '8']:
+        return len(clean_phone) == 11
+    return True
+
+
+def legacy_extract_contact_info(text: str) -> tuple:
+    """Прежнее извлечение: три выражения по очереди, replace и отдельная проверка"""
+    phone_patterns = [
+        r'\+?7[\s\-]?\(?\d{3}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',
+        r'\+?\d{10,12}',
+        r'8[\s\-]?\(?\d{3}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',
+    ]
+    phone = None
+    for pattern in phone_patterns:
+        match = re.search(pattern, text)
+        if match:
+            phone = match.group().strip()
+            text = text.replace(match.group(), '').strip()
+            break
+    if not phone:
+        return None, None
+    clean_phone = re.sub(r'[\s\-\(\)]', '', phone)
+    if not legacy_validate_phone_number(clean_phone):
+        return None, 'invalid'
+    name = re.sub(r'[^\w\s\-А-Яа-яЁёA-Za-z]', '', text).strip()
+    if not name:
+        return None, clean_phone
+    return name, clean_phone
+
+
+def load_corpus():
+    """Строки корпуса: (текст, ожидаемое имя, ожидаемый номер)"""
+    corpus = []
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            text, name, phone = line.rstrip('\n').split('\t')
+            corpus.append((text.replace('\\n', '\n'), name or None, phone or None))
+    return corpus
+
+
+def accuracy(extract, corpus) -> int:
+    """Сколько строк корпуса разобрано правильно (номер сверяется после нормализации цифр)"""
+    correct = 0
+    for text, name, phone in corpus:
+        got_name, got_phone = extract(text)
+        if phone not in (None, 'invalid') and got_phone not in (None, 'invalid'):
+            # Прежний разбор не приводил номер к E.164 - сравниваем только цифры
+            same_phone = re.sub(r'\D', '', got_phone)[-10:] == re.sub(r'\D', '', phone)[-10:]
+        else:
+            same_phone = got_phone == phone
+        if same_phone and got_name == name:
+            correct += 1
+    return correct
+
+
+def bench(extract, corpus, rounds: int) -> float:
+    """Разборов в секунду"""
+    texts = [text for text, _, _ in corpus]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            extract(text)
+    return rounds * len(texts) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=2000, help='Сколько раз прогнать корпус')
+    args = parser.parse_args()
+    
+    corpus = load_corpus()
+    print(f"Строк в корпусе: {len(corpus)}, прогонов: {args.rounds}\n")
+    for label, extract in (('Три регулярки', legacy_extract_contact_info),
+                           ('Однопроходный разбор', extract_contact_info)):
+        ok = accuracy(extract, corpus)
+        rate = bench(extract, corpus, args.rounds)
+        print(f"{label:<22} {rate:>10.0f} разборов/с   верно: {ok}/{len(corpus)}")
+
+
+if __name__ == '__main__':
+    main()
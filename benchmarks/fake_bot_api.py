@@ -0,0 +1,170 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов
+
+Отвечает на методы, которыми пользуется бот, считает исходящие запросы
+и запоминает параметры последнего вызова каждого метода.
+Бот направляется на заглушку через TELEGRAM_API_URL.
+
+Отдельный запуск: python -m benchmarks.fake_bot_api [--port 8081] [--latency 20]
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+from collections import Counter
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+# Методы, которые отправляют сообщение пользователю
+MESSAGE_METHODS = {'sendMessage', 'sendDocument', 'copyMessage'}
+
+BOT_USER = {
+    'id': 100000,
+    'is_bot': True,
+    'first_name': 'Fake Bot',
+    'username': 'fake_bot',
+}
+
+
+class FakeBotAPI:
+    """HTTP-сервер на asyncio, отвечающий как Bot API"""
+    
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0):
+        """
+        Args:
+            host: Адрес сервера
+            port: Порт (0 - любой свободный)
+            latency: Искусственная задержка ответа в секундах (имитация сети)
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.counts = Counter()
+        self.last_params: Dict[str, Dict[str, str]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._message_id = 0
+    
+    @property
+    def url(self) -> str:
+        """Адрес для TELEGRAM_API_URL"""
+        return f"http://{self.host}:{self.port}"
+    
+    @property
+    def messages_sent(self) -> int:
+        """Сколько сообщений бот отправил пользователям"""
+        return sum(self.counts[method] for method in MESSAGE_METHODS)
+    
+    async def start(self):
+        """Запустить сервер"""
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+    
+    async def stop(self):
+        """Остановить сервер"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обработка одного соединения (keep-alive, запросы по очереди)"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                path = request_line.split()[1].decode()
+                method = path.rsplit('/', 1)[-1]
+                
+                result = await self._handle(method, _parse_params(headers.get('content-type', ''), body))
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\n'
+                    b'Content-Type: application/json\r\n'
+                    b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _handle(self, method: str, params: Dict[str, str]):
+        """Ответ на вызов метода Bot API"""
+        self.counts[method] += 1
+        self.last_params[method] = params
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            # Обновлений нет - имитируем короткий long polling
+            await asyncio.sleep(1)
+            return []
+        if method in MESSAGE_METHODS or method == 'editMessageText':
+            return self._message(params, document=(method == 'sendDocument'))
+        return True
+    
+    def _message(self, params: Dict[str, str], document: bool = False) -> Dict:
+        """Объект Message в ответ на отправку"""
+        self._message_id += 1
+        chat_id = int(params.get('chat_id', 0))
+        message = {
+            'message_id': int(params.get('message_id', self._message_id)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+        if document:
+            message['document'] = {'file_id': 'fake-document', 'file_unique_id': 'fake-document'}
+        return message
+
+
+def _parse_params(content_type: str, body: bytes) -> Dict[str, str]:
+    """Параметры запроса: form-urlencoded, JSON или multipart (только простые поля)"""
+    if content_type.startswith('application/json'):
+        return {key: str(value) for key, value in json.loads(body or b'{}').items()}
+    if content_type.startswith('multipart/form-data'):
+        fields = re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body)
+        return {name.decode(): value.decode('utf-8', 'replace') for name, value in fields}
+    return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+
+async def serve(host: str, port: int, latency: float):
+    """Работать до остановки процесса, раз в минуту печатая счётчики"""
+    api = FakeBotAPI(host, port, latency)
+    await api.start()
+    print(f"Заглушка Bot API: {api.url} (TELEGRAM_API_URL={api.url})")
+    while True:
+        await asyncio.sleep(60)
+        print(dict(api.counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа, мс')
+    args = parser.parse_args()
+    
+    try:
+        asyncio.run(serve(args.host, args.port, args.latency / 1000))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -3,24 +3,37 @@ Telegram бот - воронка "Антистресс"
 """
 import logging
 import os
-import re
 import asyncio
-from datetime import datetime, timedelta
+import hashlib
+import secrets
+import time
+from collections import Counter
+from functools import partial
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
     ContextTypes
 )
-from telegram.error import TelegramError
+from telegram.error import TelegramError, BadRequest
 
 import config
 import config_timing
-from database import Database
+from storage import create_storage
+from funnel import FUNNEL, FunnelStep
+from scheduler import DeadlineTimer, JobScheduler
+from broadcast import BroadcastContent, BroadcastManager
+from notifications import AdminNotifier
 import messages
+import metrics
+from updates import InboundThrottle, PerUserUpdateProcessor
+from outbound import OutboundDispatcher, PRIORITY_FUNNEL, PRIORITY_NAMES
+from phone import extract_contact_info, normalize_phone
 
 # Настройка логирования
 logging.basicConfig(
@@ -29,10 +42,59 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Инициализация базы данных
-db = Database()
+# Хранилище выбирается настройкой STORAGE_BACKEND (SQLite, PostgreSQL или память)
+db = create_storage()
 
+# Планировщик отложенных шагов воронки (хранятся в базе и переживают перезапуск)
+scheduler = JobScheduler(db)
 
+# Рассылки хранятся в базе и продолжаются после перезапуска
+broadcasts = BroadcastManager(db)
+
+# Контакты отправляются администратору сводками и хранятся в базе до доставки
+notifier = AdminNotifier(db)
+
+# Все исходящие сообщения проходят через общую приоритетную очередь
+# Заблокировавшие бота и удалённые аккаунты отмечаются недоступными
+outbound = OutboundDispatcher(on_unreachable=db.mark_inactive)
+
+# Лишние сообщения флудящего пользователя отбрасываются до его очереди (администратор не ограничен)
+inbound_throttle = InboundThrottle()
+
+# Бот обрабатывает только сообщения (контакт приходит тоже как message)
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Глубина очередей перед шагами воронки - видно, какой этап не успевает
+metrics.REGISTRY.gauge(
+    'bot_pending_offers', 'Запланированные, но ещё не отправленные предложения',
+    lambda: db.count_scheduled_jobs('offer')
+)
+metrics.REGISTRY.gauge('bot_due_steps', 'Наступившие, но ещё не отправленные шаги воронки', db.count_due_steps)
+metrics.REGISTRY.gauge('bot_db_queue_depth', 'Запросы, ожидающие потока БД', db.queue_depth)
+metrics.REGISTRY.gauge('bot_db_pending_writes', 'Отложенные записи, ожидающие сброса', db.pending_writes)
+metrics.REGISTRY.gauge('bot_admin_notifications_pending', 'Контакты, ожидающие сводки администратору', notifier.pending)
+metrics.REGISTRY.gauge(
+    'bot_outbound_queue_depth', 'Исходящие запросы, ожидающие отправки, по классу приоритета',
+    lambda: {name: outbound.queue_depth(priority) for priority, name in PRIORITY_NAMES.items()},
+    labels=['priority']
+)
+
+
+async def reactivate_if_inactive(user_id: int, user_info: Optional[dict]):
+    """Пользователь, отмеченный недоступным, снова написал боту - снимаем отметку"""
+    if user_info and user_info['inactive_at']:
+        await db.reactivate_user(user_id)
+        logger.info(f"Пользователь {user_id} снова доступен")
+
+
+async def reactivate_inbound(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перед любым обработчиком: написавший пользователь снова доступен (команда, кодовое слово, контакт)"""
+    user = update.effective_user
+    if user is not None:
+        await reactivate_if_inactive(user.id, await db.get_user_info(user.id))
+
+
+@metrics.timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
@@ -86,7 +148,7 @@ async def check_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username
     
-    user_info = db.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     
     message = (
         f"🆔 Ваша информация:\n\n"
@@ -108,39 +170,109 @@ async def check_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(message)
 
 
-async def send_offer_delayed(application, user_id: int, delay: int = 60):
-    """Отправка предложения консультации через заданную задержку"""
-    await asyncio.sleep(delay)
-    
+async def send_offer(application, user_id: int):
+    """Отправка предложения консультации (отложенный шаг offer)"""
     logger.info(f"Отправка предложения консультации пользователю {user_id}")
     
     try:
         # Проверяем, не оставил ли пользователь уже контакт
-        user_info = db.get_user_info(user_id)
+        user_info = await db.get_user_info(user_id)
         if user_info and user_info['contact_provided']:
             logger.info(f"Пользователь {user_id} уже оставил контакт, пропускаем")
             return
+        if user_info and user_info['inactive_at']:
+            logger.info(f"Пользователь {user_id} недоступен, предложение не отправляем")
+            return
         
         await application.bot.send_message(
             chat_id=user_id,
-            text=messages.OFFER_MESSAGE
+            text=messages.OFFER_MESSAGE,
+            rate_limit_args=PRIORITY_FUNNEL
         )
         
         # Обновляем last_message_time - первый догрев будет через 1 минуту после предложения
-        db.update_user_status(user_id, 'offer_sent', update_time=True)
+        await db.update_user_status(user_id, 'offer_sent', update_time=True)
         logger.info(f"Предложение отправлено пользователю {user_id}")
         
     except TelegramError as e:
         logger.error(f"Не удалось отправить предложение пользователю {user_id}: {e}")
 
 
+def _stat_file(path: str):
+    """Метаданные файла или None, если файла нет"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _hash_file(path: str) -> str:
+    """SHA-256 содержимого файла (читается блоками)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_file(path: str) -> bytes:
+    """Прочитать файл целиком"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def send_pdf_file(message, file_stat):
+    """
+    Отправка PDF файла с переиспользованием file_id
+    
+    Первая загрузка сохраняет file_id вместе с хешем и mtime файла.
+    Дальше файл отправляется по file_id без повторной загрузки.
+    Если файл на диске изменился, кеш сбрасывается и файл загружается заново.
+    
+    Args:
+        message: Сообщение, на которое отвечаем
+        file_stat: Результат os.stat для PDF файла
+    """
+    path = config.PDF_FILE_PATH
+    file_hash = None
+    cached = await db.get_cached_media(path)
+    
+    if cached and cached['file_mtime'] != file_stat.st_mtime:
+        # mtime изменился - сверяем содержимое, прежде чем сбрасывать кеш
+        file_hash = await asyncio.to_thread(_hash_file, path)
+        if file_hash == cached['file_hash']:
+            await db.save_cached_media(path, cached['file_id'], file_hash, file_stat.st_mtime)
+        else:
+            logger.info(f"PDF файл изменился, кеш file_id сброшен: {path}")
+            await db.delete_cached_media(path)
+            cached = None
+    
+    if cached:
+        try:
+            await message.reply_document(document=cached['file_id'])
+            return
+        except BadRequest as e:
+            # file_id перестал быть действительным - загружаем файл заново
+            logger.warning(f"Закешированный file_id отклонён: {e}")
+            await db.delete_cached_media(path)
+    
+    if file_hash is None:
+        file_hash = await asyncio.to_thread(_hash_file, path)
+    content = await asyncio.to_thread(_read_file, path)
+    
+    sent = await message.reply_document(document=content, filename=os.path.basename(path))
+    await db.save_cached_media(path, sent.document.file_id, file_hash, file_stat.st_mtime)
+    logger.info(f"PDF файл загружен, file_id сохранён в кеш: {path}")
+
+
 async def handle_antistress_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кодового слова Антистресс"""
     user = update.effective_user
     user_id = user.id
     
     # Проверяем, существует ли PDF файл
-    if not os.path.exists(config.PDF_FILE_PATH):
+    file_stat = await asyncio.to_thread(_stat_file, config.PDF_FILE_PATH)
+    if file_stat is None:
         await update.message.reply_text(
             "❌ Извините, файл пока недоступен. Обратитесь к администратору."
         )
@@ -148,7 +280,7 @@ async def handle_antistress_code(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     # Проверяем, новый ли это пользователь
-    is_new_user = db.add_user(
+    is_new_user = await db.add_user(
         user_id=user_id,
         username=user.username,
         first_name=user.first_name,
@@ -166,13 +298,12 @@ async def handle_antistress_code(update: Update, context: ContextTypes.DEFAULT_T
     
     # Отправляем PDF файл
     try:
-        with open(config.PDF_FILE_PATH, 'rb') as pdf_file:
-            await update.message.reply_document(document=pdf_file)
+        await send_pdf_file(update.message, file_stat)
         
         logger.info(f"Новый пользователь добавлен: {user_id} (@{user.username})")
         
-        # Запускаем отложенную отправку предложения консультации
-        asyncio.create_task(send_offer_delayed(context.application, user_id, delay=config_timing.OFFER_DELAY_SECONDS))
+        # Планируем отложенную отправку предложения консультации
+        await scheduler.schedule(user_id, 'offer', config_timing.OFFER_DELAY_SECONDS)
         logger.info(f"Запланирована отправка предложения через {config_timing.OFFER_DELAY_SECONDS} сек для {user_id}")
         
     except Exception as e:
@@ -182,84 +313,26 @@ async def handle_antistress_code(update: Update, context: ContextTypes.DEFAULT_T
         )
 
 
-def validate_phone_number(phone: str) -> bool:
-    """
-    Проверка корректности номера телефона
-    
-    Args:
-        phone: Номер телефона (уже очищенный от символов)
-        
-    Returns:
-        True если номер валидный
-    """
-    # Удаляем + в начале если есть
-    clean_phone = phone.lstrip('+')
-    
-    # Проверяем, что это только цифры
-    if not clean_phone.isdigit():
-        return False
-    
-    # Проверяем длину (10-12 цифр)
-    if len(clean_phone) < 10 or len(clean_phone) > 12:
-        return False
-    
-    # Если начинается с 7 или 8, должно быть 11 цифр
-    if clean_phone[0] in ['7', '8']:
-        return len(clean_phone) == 11
-    
-    return True
+@metrics.timed_handler
+async def handle_contact_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик контактов (Telegram Contact)"""
+    return await _process_contact(update, context)
 
 
-def extract_contact_info(text: str) -> tuple:
+async def _process_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
-    Извлечение имени и телефона из текста
+    Обработка контакта от пользователя
+    
+    Вызывается и из handle_message, поэтому не замеряется отдельно:
+    время попадает в метрику вызвавшего обработчика.
     
     Returns:
-        (name, phone) или (None, None) если не найдено
-        (None, 'invalid') если формат номера неправильный
+        True, если контакт сохранён
     """
-    # Ищем номер телефона (различные форматы)
-    phone_patterns = [
-        r'\+?7[\s\-]?\(?\d{3}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',  # +7 (xxx) xxx-xx-xx
-        r'\+?\d{10,12}',  # Просто цифры (10-12 символов)
-        r'8[\s\-]?\(?\d{3}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',  # 8 (xxx) xxx-xx-xx
-    ]
-    
-    phone = None
-    for pattern in phone_patterns:
-        match = re.search(pattern, text)
-        if match:
-            phone = match.group().strip()
-            # Удаляем телефон из текста, чтобы извлечь имя
-            text = text.replace(match.group(), '').strip()
-            break
-    
-    if not phone:
-        return None, None
-    
-    # Очищаем телефон от лишних символов
-    clean_phone = re.sub(r'[\s\-\(\)]', '', phone)
-    
-    # Проверяем корректность номера
-    if not validate_phone_number(clean_phone):
-        return None, 'invalid'
-    
-    # Имя - это то, что осталось после удаления телефона
-    # Очищаем от лишних символов и пробелов
-    name = re.sub(r'[^\w\s\-А-Яа-яЁёA-Za-z]', '', text).strip()
-    
-    if not name:
-        return None, clean_phone
-    
-    return name, clean_phone
-
-
-async def handle_contact_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка контакта от пользователя"""
     user_id = update.effective_user.id
     
     # Проверяем, есть ли пользователь в базе
-    user_info = db.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     if not user_info:
         return False
     
@@ -274,15 +347,16 @@ async def handle_contact_message(update: Update, context: ContextTypes.DEFAULT_T
     
     # Обработка контакта через Telegram Contact
     if update.message.contact:
-        phone = update.message.contact.phone_number
+        # Telegram присылает номер без единого формата (с «+» или без)
+        phone = normalize_phone(update.message.contact.phone_number) or update.message.contact.phone_number
         name = update.message.contact.first_name or update.effective_user.first_name
         
-        db.save_contact(user_id, name, phone)
+        await db.save_contact(user_id, name, phone)
         
         # Отправляем благодарность
         await update.message.reply_text(messages.THANK_YOU_MESSAGE)
         
-        # Уведомляем админа
+        # Контакт сохраняется для сводки администратору (отправляется в фоне)
         await notify_admin_about_contact(context, user_id, name, phone, update.effective_user.username)
         
         logger.info(f"Получен контакт от {user_id}: {name}, {phone}")
@@ -305,12 +379,12 @@ async def handle_contact_message(update: Update, context: ContextTypes.DEFAULT_T
             return False
         
         if name and phone:
-            db.save_contact(user_id, name, phone)
+            await db.save_contact(user_id, name, phone)
             
             # Отправляем благодарность
             await update.message.reply_text(messages.THANK_YOU_MESSAGE)
             
-            # Уведомляем админа
+            # Контакт сохраняется для сводки администратору (отправляется в фоне)
             await notify_admin_about_contact(context, user_id, name, phone, update.effective_user.username)
             
             logger.info(f"Получен контакт от {user_id}: {name}, {phone}")
@@ -320,27 +394,14 @@ async def handle_contact_message(update: Update, context: ContextTypes.DEFAULT_T
 
 
 async def notify_admin_about_contact(context, user_id, name, phone, username):
-    """Отправка уведомления админу о новом контакте"""
-    if not config.ADMIN_ID:
-        return
-    
+    """Уведомление админу о новом контакте (попадёт в ближайшую сводку, хранится до доставки)"""
     try:
-        notification = messages.ADMIN_NOTIFICATION.format(
-            name=name,
-            phone=phone,
-            user_id=user_id,
-            username=username or 'не указан',
-            date=datetime.now().strftime('%d.%m.%Y %H:%M')
-        )
-        
-        await context.bot.send_message(
-            chat_id=config.ADMIN_ID,
-            text=notification
-        )
-    except TelegramError as e:
-        logger.error(f"Не удалось уведомить админа: {e}")
+        await notifier.notify(user_id, name, phone, username)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить уведомление админу о контакте {user_id} ({name}, {phone}): {e}")
 
 
+@metrics.timed_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
     message_text = update.message.text.strip()
@@ -352,7 +413,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Проверяем, есть ли пользователь в базе
-    user_info = db.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     
     # Если пользователь НЕ в базе - даем подсказку
     if not user_info:
@@ -370,7 +431,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Предложение еще не отправлено - не обрабатываем сообщения
             return
         
-        contact_handled = await handle_contact_message(update, context)
+        contact_handled = await _process_contact(update, context)
         
         if not contact_handled:
             # Если контакт уже предоставлен
@@ -388,47 +449,102 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
 
 
+async def _send_step(application, user_id: int, step: FunnelStep, slots: asyncio.Semaphore) -> bool:
+    """Отправить один шаг воронки (одновременно не больше WARMUP_CONCURRENCY отправок)"""
+    async with slots:
+        try:
+            await application.bot.send_message(
+                chat_id=user_id,
+                text=step.text,
+                rate_limit_args=PRIORITY_FUNNEL
+            )
+        except TelegramError as e:
+            # Пользователь остаётся забранным и получит шаг после истечения аренды;
+            # после WARMUP_MAX_ATTEMPTS неудач его воронка останавливается
+            logger.error(f"Ошибка отправки шага {step.key} пользователю {user_id}: {e}")
+            return False
+    
+    # Шаг считается отправленным только после коммита отметки
+    try:
+        await db.mark_step_sent(user_id, step.key)
+    except Exception as e:
+        logger.error(f"Шаг {step.key} отправлен пользователю {user_id}, но отметка не сохранена: {e}")
+        return False
+    return True
+
+
+async def send_due_steps(application) -> dict:
+    """
+    Волна воронки догрева: отправить все наступившие шаги всех этапов
+    
+    Наступившие шаги забираются из базы пачками (claim_due_steps - один
+    запрос на пачку, сколько бы шагов ни было в воронке), отправки внутри
+    пачки идут параллельно, а общий лимит скорости держит диспетчер
+    исходящих сообщений.
+    
+    Args:
+        application: Приложение бота
+        
+    Returns:
+        Словарь: sent и failed по ключам шагов, seconds - длительность волны
+    """
+    slots = asyncio.Semaphore(config.WARMUP_CONCURRENCY)
+    started = time.perf_counter()
+    sent = Counter()
+    failed = Counter()
+    while True:
+        claimed = await db.claim_due_steps(config.WARMUP_BATCH_SIZE)
+        if not claimed:
+            break
+        
+        jobs = []
+        for job in claimed:
+            step = FUNNEL.get(job['step'])
+            if step is None:
+                # Шаг убрали из воронки, пока пользователь его ждал
+                logger.warning(f"Шаг {job['step']} пользователя {job['user_id']} больше не существует")
+                continue
+            jobs.append((step, _send_step(application, job['user_id'], step, slots)))
+        
+        results = await asyncio.gather(*(send for _, send in jobs))
+        for (step, _), ok in zip(jobs, results):
+            (sent if ok else failed)[step.key] += 1
+    
+    seconds = time.perf_counter() - started
+    total = sum(sent.values()) + sum(failed.values())
+    if total:
+        metrics.FUNNEL_WAVE_SECONDS.observe(seconds)
+        for step in FUNNEL.steps:
+            if sent[step.key] or failed[step.key]:
+                metrics.FUNNEL_MESSAGES.inc(step.key, 'sent', amount=sent[step.key])
+                metrics.FUNNEL_MESSAGES.inc(step.key, 'failed', amount=failed[step.key])
+                logger.info(f"{step.title}: отправлено {sent[step.key]}, ошибок {failed[step.key]}")
+        logger.info(
+            f"Волна догрева: {total} шагов за {seconds:.1f} сек ({sum(sent.values()) / seconds:.1f} в секунду)"
+        )
+    return {'sent': dict(sent), 'failed': dict(failed), 'seconds': seconds}
+
+
 async def check_warmup_users(application):
-    """Фоновая задача для проверки и отправки догревающих сообщений"""
+    """
+    Фоновая задача отправки шагов воронки
+    
+    Спит до ближайшего due_at из базы; новый более ранний срок (перезапуск
+    воронки, отправленный шаг, возвращение пользователя) будит её досрочно.
+    CHECK_INTERVAL_SECONDS - страховочная проверка на случай изменений базы извне.
+    """
+    timer = DeadlineTimer(max_sleep=config_timing.CHECK_INTERVAL_SECONDS)
+    db.watch_step_due(timer.notify)
     while True:
+        timer.reset()
         try:
-            logger.info("Проверка пользователей для догрева...")
-            
-            # Первый догрев
-            users_for_warmup1 = db.get_users_for_warmup(hours=config_timing.WARMUP_1_HOURS, warmup_number=1)
-            logger.info(f"Найдено {len(users_for_warmup1)} пользователей для первого догрева")
-            
-            for user in users_for_warmup1:
-                try:
-                    await application.bot.send_message(
-                        chat_id=user['user_id'],
-                        text=messages.WARMUP_1_MESSAGE
-                    )
-                    db.mark_warmup_sent(user['user_id'], 1)
-                    logger.info(f"Первый догрев отправлен пользователю {user['user_id']}")
-                except TelegramError as e:
-                    logger.error(f"Ошибка отправки первого догрева {user['user_id']}: {e}")
-            
-            # Второй догрев
-            users_for_warmup2 = db.get_users_for_warmup(hours=config_timing.WARMUP_2_HOURS, warmup_number=2)
-            logger.info(f"Найдено {len(users_for_warmup2)} пользователей для второго догрева")
-            
-            for user in users_for_warmup2:
-                try:
-                    await application.bot.send_message(
-                        chat_id=user['user_id'],
-                        text=messages.WARMUP_2_MESSAGE
-                    )
-                    db.mark_warmup_sent(user['user_id'], 2)
-                    logger.info(f"Второй догрев отправлен пользователю {user['user_id']}")
-                except TelegramError as e:
-                    logger.error(f"Ошибка отправки второго догрева {user['user_id']}: {e}")
-        
+            await send_due_steps(application)
+            next_due = await db.get_next_step_due()
         except Exception as e:
             logger.error(f"Ошибка в фоновой задаче догрева: {e}")
+            next_due = int(time.time()) + 5
         
-        # Проверяем с интервалом из конфига
-        await asyncio.sleep(config_timing.CHECK_INTERVAL_SECONDS)
+        await timer.sleep_until(next_due)
 
 
 # ===== КОМАНДЫ АДМИНИСТРАТОРА =====
@@ -441,16 +557,35 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("У вас нет доступа к этой команде.")
         return
     
-    total_users = db.get_user_count()
-    with_contact = db.get_contact_count()
+    funnel = await db.get_funnel_stats()
+    total_users = funnel['total_users']
+    with_contact = funnel['with_contact']
     without_contact = total_users - with_contact
+    inactive = funnel['inactive']
     
     stats_text = (
         f"📊 Статистика воронки \"Антистресс\":\n\n"
         f"👥 Всего пользователей: {total_users}\n"
         f"✅ Оставили контакт: {with_contact}\n"
         f"⏳ Без контакта: {without_contact}\n"
-        f"📈 Конверсия: {round(with_contact / total_users * 100, 1) if total_users > 0 else 0}%"
+        f"📈 Конверсия: {round(with_contact / total_users * 100, 1) if total_users > 0 else 0}%\n\n"
+        f"По этапам:\n"
+        f"📄 Получили файл: {funnel['status_file_sent']}\n"
+        f"🎁 Получили предложение: {funnel['status_offer_sent']}\n"
+        f"📞 Оставили контакт: {funnel['status_contact_provided']}\n\n"
+        f"🚫 Недоступны (заблокировали бота): {inactive} "
+        f"({round(inactive / total_users * 100, 1) if total_users > 0 else 0}%), "
+        f"из них с контактом: {funnel['inactive_with_contact']}"
+    )
+    
+    step_stats = await db.get_step_stats()
+    for step in FUNNEL.steps:
+        stats_text += f"\n🔥 {step.title} отправлен: {step_stats[step.key]}"
+    
+    cache = await db.cache_stats()
+    stats_text += (
+        f"\n\n🗂 Кеш пользователей: попаданий {cache['hits']}, промахов {cache['misses']}, "
+        f"отсечено фильтром {cache['negative_hits']}"
     )
     
     await update.message.reply_text(stats_text)
@@ -464,17 +599,16 @@ async def broadcast_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("У вас нет доступа к этой команде.")
         return
     
-    if not context.args:
+    content = broadcast_content(update)
+    if content is None:
         await update.message.reply_text(
             "Использование: /broadcast_all <текст сообщения>\n"
+            "или ответьте командой /broadcast_all на любое сообщение (фото, видео, файл, текст с форматированием)\n"
             "Отправит сообщение ВСЕМ пользователям воронки"
         )
         return
     
-    message_text = ' '.join(context.args)
-    users = db.get_all_users()
-    
-    await send_broadcast(update, context, users, message_text, "всем пользователям")
+    await send_broadcast(update, context, 'all', content, "всем пользователям")
 
 
 async def broadcast_without_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -485,17 +619,16 @@ async def broadcast_without_contact(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("У вас нет доступа к этой команде.")
         return
     
-    if not context.args:
+    content = broadcast_content(update)
+    if content is None:
         await update.message.reply_text(
             "Использование: /broadcast_no_contact <текст сообщения>\n"
+            "или ответьте командой /broadcast_no_contact на любое сообщение (фото, видео, файл, текст с форматированием)\n"
             "Отправит сообщение только тем, кто НЕ оставил контакт"
         )
         return
     
-    message_text = ' '.join(context.args)
-    users = db.get_users_without_contact()
-    
-    await send_broadcast(update, context, users, message_text, "пользователям без контакта")
+    await send_broadcast(update, context, 'no_contact', content, "пользователям без контакта")
 
 
 async def broadcast_with_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -506,48 +639,100 @@ async def broadcast_with_contact(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("У вас нет доступа к этой команде.")
         return
     
-    if not context.args:
+    content = broadcast_content(update)
+    if content is None:
         await update.message.reply_text(
             "Использование: /broadcast_with_contact <текст сообщения>\n"
+            "или ответьте командой /broadcast_with_contact на любое сообщение (фото, видео, файл, текст с форматированием)\n"
             "Отправит сообщение только тем, кто оставил контакт"
         )
         return
     
-    message_text = ' '.join(context.args)
-    users = db.get_users_with_contact()
+    await send_broadcast(update, context, 'with_contact', content, "пользователям с контактом")
+
+
+def broadcast_content(update: Update) -> Optional[BroadcastContent]:
+    """
+    Содержимое рассылки из команды администратора
+    
+    Returns:
+        Копия сообщения, на которое ответили командой, или текст после
+        команды (с переносами строк); None, если рассылать нечего
+    """
+    reply = update.message.reply_to_message
+    if reply is not None:
+        return BroadcastContent.from_message(reply)
     
-    await send_broadcast(update, context, users, message_text, "пользователям с контактом")
+    parts = update.message.text.split(None, 1)
+    if len(parts) < 2 or not parts[1].strip():
+        return None
+    return BroadcastContent(text=parts[1].strip())
 
 
-async def send_broadcast(update, context, users, message_text, description):
-    """Общая функция для рассылки"""
-    if not users:
+async def send_broadcast(update, context, audience, content, description):
+    """Общая функция для рассылки: создаёт задание и запускает его в фоне"""
+    broadcast_id = await broadcasts.create(
+        context.bot, audience, description, content, update.effective_chat.id
+    )
+    
+    if broadcast_id is None:
         await update.message.reply_text(f"Нет {description} для рассылки.")
+
+
+async def broadcast_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Управление рассылкой: /broadcast_pause, /broadcast_resume, /broadcast_cancel <id>"""
+    user_id = update.effective_user.id
+    
+    if user_id != config.ADMIN_ID:
+        await update.message.reply_text("У вас нет доступа к этой команде.")
         return
     
-    await update.message.reply_text(f"📤 Начинаю рассылку {len(users)} {description}...")
+    command = update.message.text.split()[0].lstrip('/').split('@')[0]
     
-    success_count = 0
-    fail_count = 0
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text(f"Использование: /{command} <номер рассылки>")
+        return
     
-    for user_id in users:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=message_text
-            )
-            success_count += 1
-        except TelegramError as e:
-            logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-            fail_count += 1
+    broadcast_id = int(context.args[0])
     
-    result_text = (
-        f"✅ Рассылка завершена!\n\n"
-        f"Успешно: {success_count}\n"
-        f"Ошибок: {fail_count}"
-    )
+    if command == 'broadcast_pause':
+        done = await broadcasts.pause(broadcast_id)
+        result = "⏸ Рассылка #{} приостановлена"
+    elif command == 'broadcast_resume':
+        done = await broadcasts.resume(context.bot, broadcast_id)
+        result = "▶️ Рассылка #{} продолжена"
+    else:
+        done = await broadcasts.cancel(context.bot, broadcast_id)
+        result = "⏹ Рассылка #{} отменена"
+    
+    if done:
+        await update.message.reply_text(result.format(broadcast_id))
+    else:
+        await update.message.reply_text(f"Рассылка #{broadcast_id} не найдена или уже в этом состоянии.")
+
+
+async def list_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Список последних рассылок"""
+    user_id = update.effective_user.id
+    
+    if user_id != config.ADMIN_ID:
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+    
+    jobs = await db.get_broadcasts(limit=10)
+    
+    if not jobs:
+        await update.message.reply_text("Рассылок ещё не было.")
+        return
     
-    await update.message.reply_text(result_text)
+    lines = ["📋 Последние рассылки:\n"]
+    for job in jobs:
+        lines.append(
+            f"#{job['broadcast_id']} {job['description']} - {job['status']}, "
+            f"{job['sent'] + job['failed']}/{job['total']}"
+        )
+    
+    await update.message.reply_text("\n".join(lines))
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -555,15 +740,38 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Exception while handling an update: {context.error}")
 
 
-def main():
-    """Запуск бота"""
-    # Проверка наличия токена
-    if not config.BOT_TOKEN:
-        logger.error("Не указан BOT_TOKEN в файле .env!")
-        return
+def build_application() -> Application:
+    """
+    Создание приложения с зарегистрированными обработчиками
+    
+    Очередь входящих обновлений ограничена: при переполнении вебхук
+    отвечает Telegram с задержкой, и тот сам придерживает доставку.
+    
+    Returns:
+        Настроенное приложение python-telegram-bot
+    """
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .update_queue(asyncio.Queue(maxsize=config.UPDATE_QUEUE_SIZE))
+        .request(metrics.InstrumentedRequest(
+            config.BOT_API_POOL_SIZE, config.BOT_API_POOL_TIMEOUT, config.BOT_API_TIMEOUT
+        ))
+        .rate_limiter(outbound)
+        .concurrent_updates(PerUserUpdateProcessor(
+            config.UPDATE_CONCURRENCY, inbound_throttle, exempt=(config.ADMIN_ID,)
+        ))
+    )
+    
+    # Адрес Bot API можно подменить (локальный сервер Bot API или заглушка для тестов)
+    if config.TELEGRAM_API_URL:
+        api_url = config.TELEGRAM_API_URL.rstrip('/')
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    
+    application = builder.build()
     
-    # Создание приложения
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    # Снятие отметки о недоступности - раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, reactivate_inbound), group=-1)
     
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler("start", start))
@@ -574,6 +782,10 @@ def main():
     application.add_handler(CommandHandler("broadcast_all", broadcast_all))
     application.add_handler(CommandHandler("broadcast_no_contact", broadcast_without_contact))
     application.add_handler(CommandHandler("broadcast_with_contact", broadcast_with_contact))
+    application.add_handler(CommandHandler(
+        ["broadcast_pause", "broadcast_resume", "broadcast_cancel"], broadcast_control
+    ))
+    application.add_handler(CommandHandler("broadcasts", list_broadcasts))
     
     # Обработчик текстовых сообщений
     application.add_handler(MessageHandler(
@@ -590,18 +802,80 @@ def main():
     # Обработчик ошибок
     application.add_error_handler(error_handler)
     
+    # Метрики в формате Prometheus (METRICS_PORT=0 - выключены)
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = metrics.MetricsServer(metrics.REGISTRY, config.METRICS_HOST, config.METRICS_PORT)
+    
     # Функция для запуска фоновой задачи после инициализации
     async def post_init(application: Application) -> None:
         """Запускается после инициализации приложения"""
         asyncio.create_task(check_warmup_users(application))
         logger.info("Фоновая задача для догревов запущена")
-    
-    # Регистрируем функцию post_init
+        
+        scheduler.register('offer', partial(send_offer, application))
+        scheduler.start()
+        logger.info("Планировщик отложенных шагов запущен")
+        
+        broadcasts.start(application.bot)
+        await notifier.start(application.bot)
+        
+        if metrics_server is not None:
+            metrics.REGISTRY.gauge(
+                'bot_update_queue_depth', 'Обновления, ожидающие обработчиков', application.update_queue.qsize
+            )
+            await metrics_server.start()
+    
+    async def post_shutdown(application: Application) -> None:
+        """Запускается при остановке приложения"""
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await scheduler.stop()
+        await broadcasts.stop()
+        await notifier.stop()
+        await db.close()
+        logger.info("Соединения с базой данных закрыты")
+    
+    # Регистрируем функции post_init и post_shutdown
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
+    
+    return application
+
+
+def main():
+    """Запуск бота"""
+    # Проверка наличия токена
+    if not config.BOT_TOKEN:
+        logger.error("Не указан BOT_TOKEN в файле .env!")
+        return
+    
+    application = build_application()
     
-    # Запуск бота
-    logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if config.BOT_MODE == 'webhook':
+        if not config.WEBHOOK_URL:
+            logger.error("Для режима webhook укажите WEBHOOK_URL в файле .env!")
+            return
+        
+        # Без секрета любой, кто знает адрес, сможет присылать поддельные обновления
+        secret_token = config.WEBHOOK_SECRET_TOKEN
+        if not secret_token:
+            secret_token = secrets.token_urlsafe(32)
+            logger.warning("WEBHOOK_SECRET_TOKEN не задан, сгенерирован случайный секрет")
+        
+        logger.info(f"Бот запущен в режиме webhook на порту {config.WEBHOOK_PORT}!")
+        application.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}",
+            secret_token=secret_token,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=False
+        )
+    else:
+        logger.info("Бот запущен!")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,604 @@
+"""
+Движок рассылок с ограничением скорости
+
+Общий лимит Bot API, интервал между сообщениями в один чат и повторы
+обеспечивает диспетчер исходящих сообщений (outbound.py); здесь рассылка
+дополнительно ограничена своей долей лимита, чтобы оставлять запас
+для ответов пользователям и шагов воронки.
+
+Рассылается либо текст, либо копия любого сообщения администратора
+(copy_message): форматирование сохраняется, а вложения отправляются
+по ссылке и не загружаются заново для каждого получателя.
+
+Рассылку ведёт один экземпляр бота - тот, кто её арендовал (claim_broadcast).
+Аренда продлевается после каждой пачки; если рассылку приостановили или
+отменили с другого экземпляра, продлить её не удастся и рассылка
+остановится. Рассылку упавшего экземпляра подхватит другой по истечении
+аренды.
+"""
+import asyncio
+import logging
+import secrets
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from telegram import Message
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
+
+import config
+from outbound import PRIORITY_BROADCAST, PRIORITY_FUNNEL, TokenBucket, unreachable_reason
+
+logger = logging.getLogger(__name__)
+
+# Аренда рассылки экземпляром бота (секунды): продлевается после каждой пачки,
+# рассылку упавшего экземпляра подхватит другой не раньше, чем она истечёт
+CLAIM_SECONDS = 600
+
+# Вложения, которые можно отправить по file_id, и методы их отправки
+MEDIA_SENDERS = {
+    'photo': 'send_photo',
+    'video': 'send_video',
+    'animation': 'send_animation',
+    'document': 'send_document',
+    'audio': 'send_audio',
+    'voice': 'send_voice',
+    'sticker': 'send_sticker',
+    'video_note': 'send_video_note',
+}
+
+# Вложения, которые отправляются без подписи
+CAPTIONLESS_MEDIA = {'sticker', 'video_note'}
+
+
+class BroadcastSourceLost(Exception):
+    """Исходное сообщение рассылки удалено, а отправить его содержимое заново нельзя"""
+
+
+@dataclass
+class BroadcastContent:
+    """Что рассылать: текст или копию сообщения администратора"""
+    text: str                                   # текст или подпись (HTML, если есть source_message_id)
+    source_chat_id: Optional[int] = None
+    source_message_id: Optional[int] = None     # None - рассылка текстом
+    media_kind: Optional[str] = None            # ключ MEDIA_SENDERS
+    media_file_id: Optional[str] = None
+    
+    @classmethod
+    def from_message(cls, message: Message) -> 'BroadcastContent':
+        """Копия сообщения (на которое ответил администратор)"""
+        content = cls(
+            text=(message.text_html if message.text else message.caption_html) or '',
+            source_chat_id=message.chat_id,
+            source_message_id=message.message_id,
+        )
+        for kind in MEDIA_SENDERS:
+            media = getattr(message, kind)
+            if kind == 'photo' and media:
+                media = media[-1]   # самый крупный размер
+            if media:
+                content.media_kind = kind
+                content.media_file_id = media.file_id
+                break
+        return content
+    
+    @classmethod
+    def from_job(cls, job: Dict) -> 'BroadcastContent':
+        """Содержимое сохранённой рассылки"""
+        return cls(
+            text=job['message_text'],
+            source_chat_id=job['source_chat_id'],
+            source_message_id=job['source_message_id'],
+            media_kind=job['media_kind'] if job['media_file_id'] else None,
+            media_file_id=job['media_file_id'],
+        )
+    
+    @property
+    def is_copy(self) -> bool:
+        return self.source_message_id is not None
+    
+    @property
+    def can_resend(self) -> bool:
+        """Можно ли отправить содержимое без исходного сообщения (опрос, геопозицию - нельзя)"""
+        return bool(self.media_file_id or self.text)
+    
+    @property
+    def parse_mode(self) -> Optional[str]:
+        return ParseMode.HTML if self.is_copy else None
+
+
+async def send_content(bot, chat_id: int, content: BroadcastContent, priority: int = PRIORITY_BROADCAST):
+    """Отправить содержимое заново: вложение по file_id или текст"""
+    if content.media_file_id:
+        send_media = getattr(bot, MEDIA_SENDERS[content.media_kind])
+        if content.media_kind in CAPTIONLESS_MEDIA:
+            await send_media(chat_id, content.media_file_id, rate_limit_args=priority)
+        else:
+            await send_media(
+                chat_id, content.media_file_id, caption=content.text or None,
+                parse_mode=content.parse_mode, rate_limit_args=priority
+            )
+    else:
+        await bot.send_message(
+            chat_id=chat_id, text=content.text, parse_mode=content.parse_mode, rate_limit_args=priority
+        )
+
+
+def make_sender(bot, content: BroadcastContent,
+                priority: int = PRIORITY_BROADCAST) -> Callable[[int], Awaitable]:
+    """
+    Корутина отправки одному получателю для BroadcastEngine.run
+    
+    Копия отправляется через copy_message - по ссылке на исходное сообщение.
+    Если администратор удалил исходное сообщение, рассылка продолжается
+    заново собранным сообщением: вложение по сохранённому file_id и подпись.
+    Если собрать его не из чего (например, копировался опрос), каждая
+    следующая отправка сразу выбрасывает BroadcastSourceLost.
+    
+    Пример - рассылка по аудитории постранично:
+        send = make_sender(bot, BroadcastContent.from_message(message))
+        async for page in db.iter_audience_pages('no_contact'):
+            await BroadcastEngine().run(page, send)
+    """
+    state = {'copy': content.is_copy, 'lost': False}
+    
+    async def send(chat_id: int):
+        if state['lost']:
+            raise BroadcastSourceLost()
+        if state['copy']:
+            try:
+                await bot.copy_message(
+                    chat_id=chat_id, from_chat_id=content.source_chat_id,
+                    message_id=content.source_message_id, rate_limit_args=priority
+                )
+                return
+            except BadRequest as e:
+                if 'message to copy not found' not in e.message.lower():
+                    raise
+                if not content.can_resend:
+                    state['lost'] = True
+                    raise BroadcastSourceLost() from e
+                logger.warning("Исходное сообщение рассылки удалено, отправляем по сохранённому file_id")
+                state['copy'] = False
+        await send_content(bot, chat_id, content, priority)
+    
+    return send
+
+
+@dataclass
+class BroadcastReport:
+    """Итоги рассылки"""
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    errors: Counter = field(default_factory=Counter)
+    resumed_from: int = 0  # обработано до перезапуска (не входит в скорость)
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+    
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+    
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+    
+    @property
+    def throughput(self) -> float:
+        """Сообщений в секунду"""
+        return (self.processed - self.resumed_from) / self.elapsed if self.elapsed > 0 else 0.0
+    
+    @property
+    def eta(self) -> float:
+        """Оценка оставшегося времени в секундах"""
+        if not self.throughput:
+            return 0.0
+        return (self.total - self.processed) / self.throughput
+    
+    def format(self) -> str:
+        """Текст отчёта для администратора"""
+        text = (
+            f"✅ Рассылка завершена!\n\n"
+            f"Успешно: {self.sent}\n"
+            f"Ошибок: {self.failed}\n"
+            f"⏱ Время: {self.elapsed:.1f} сек\n"
+            f"🚀 Скорость: {self.throughput:.1f} сообщ/сек"
+        )
+        if self.errors:
+            text += "\n\nОшибки по типам:\n" + "\n".join(
+                f"• {name}: {count}" for name, count in self.errors.most_common()
+            )
+        return text
+
+
+class BroadcastEngine:
+    """Параллельная отправка сообщений со своей долей общего лимита скорости"""
+    
+    def __init__(self, rate: float = config.BROADCAST_RATE_PER_SECOND,
+                 concurrency: int = config.BROADCAST_CONCURRENCY,
+                 progress_interval: float = 10.0):
+        """
+        Args:
+            rate: Лимит сообщений рассылки в секунду (не больше общего лимита бота)
+            concurrency: Максимум одновременных запросов к Bot API
+            progress_interval: Как часто писать прогресс в лог (секунды)
+        """
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+    
+    def estimate(self, total: int) -> float:
+        """Оценка длительности рассылки в секундах"""
+        return total / self.bucket.rate
+    
+    async def run(self, user_ids: Iterable[int], send: Callable[[int], Awaitable],
+                  on_result: Optional[Callable[[int, bool], Awaitable]] = None,
+                  stop: Optional[asyncio.Event] = None) -> BroadcastReport:
+        """
+        Разослать сообщение пользователям
+        
+        Args:
+            user_ids: ID получателей
+            send: Корутина отправки, принимающая ID чата
+            on_result: Корутина, вызываемая после каждого получателя (ID чата, доставлено ли)
+            stop: Событие остановки - после него новые отправки не начинаются
+            
+        Returns:
+            Отчёт о рассылке
+        """
+        user_ids = list(user_ids)
+        report = BroadcastReport(total=len(user_ids))
+        recipients = iter(user_ids)
+        
+        async def worker():
+            for chat_id in recipients:
+                if stop is not None and stop.is_set():
+                    return
+                delivered = await self._deliver(chat_id, send, report)
+                if on_result is not None:
+                    await on_result(chat_id, delivered)
+        
+        progress = asyncio.create_task(self._log_progress(report))
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(user_ids)) or 1)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # Если один исполнитель упал, остальные не должны продолжать отправку
+            for task in workers:
+                task.cancel()
+            progress.cancel()
+        
+        report.finished_at = time.monotonic()
+        logger.debug(
+            f"Пачка рассылки отправлена: {report.sent}/{report.total} за {report.elapsed:.1f} сек "
+            f"({report.throughput:.1f} сообщ/сек), ошибки: {dict(report.errors)}"
+        )
+        return report
+    
+    async def _deliver(self, chat_id: int, send: Callable[[int], Awaitable], report: BroadcastReport) -> bool:
+        """Отправка одному получателю (повторы выполняет диспетчер исходящих сообщений)"""
+        await self.bucket.acquire()
+        try:
+            await send(chat_id)
+        except TelegramError as e:
+            return self._fail(chat_id, e, report)
+        report.sent += 1
+        return True
+    
+    def _fail(self, chat_id: int, error: TelegramError, report: BroadcastReport) -> bool:
+        """Учесть окончательную ошибку отправки"""
+        if unreachable_reason(error) is not None:
+            # Пользователь уже отмечен недоступным диспетчером - это не сбой
+            logger.info(f"Пользователь {chat_id} недоступен: {error}")
+        else:
+            logger.error(f"Не удалось отправить сообщение пользователю {chat_id}: {error}")
+        report.failed += 1
+        report.errors[type(error).__name__] += 1
+        return False
+    
+    async def _log_progress(self, report: BroadcastReport):
+        """Периодически писать прогресс и оценку оставшегося времени"""
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            logger.info(
+                f"Рассылка: {report.processed}/{report.total}, "
+                f"{report.throughput:.1f} сообщ/сек, осталось ~{report.eta:.0f} сек"
+            )
+
+
+STATUS_TITLES = {
+    'running': '📤 Идёт',
+    'paused': '⏸ Приостановлена',
+    'cancelled': '⏹ Отменена',
+    'finished': '✅ Завершена',
+}
+
+
+def format_broadcast_status(job: Dict, throughput: float = 0.0) -> str:
+    """
+    Текст сообщения о ходе рассылки
+    
+    Args:
+        job: Задание рассылки из базы
+        throughput: Текущая скорость (сообщений в секунду)
+    """
+    processed = job['sent'] + job['failed']
+    text = (
+        f"{STATUS_TITLES.get(job['status'], job['status'])} рассылка #{job['broadcast_id']} "
+        f"{job['description']}\n\n"
+        f"Обработано: {processed}/{job['total']}\n"
+        f"Успешно: {job['sent']}\n"
+        f"Ошибок: {job['failed']}"
+    )
+    if job['status'] == 'running':
+        if throughput:
+            eta = max(job['total'] - processed, 0) / throughput
+            text += f"\n🚀 Скорость: {throughput:.1f} сообщ/сек, осталось ~{eta:.0f} сек"
+        text += (
+            f"\n\n/broadcast_pause {job['broadcast_id']} - приостановить\n"
+            f"/broadcast_cancel {job['broadcast_id']} - отменить"
+        )
+    elif job['status'] == 'paused':
+        text += (
+            f"\n\n/broadcast_resume {job['broadcast_id']} - продолжить\n"
+            f"/broadcast_cancel {job['broadcast_id']} - отменить"
+        )
+    return text
+
+
+class BroadcastManager:
+    """
+    Рассылки как задания в базе данных
+    
+    Получатели читаются из базы постранично по возрастанию user_id,
+    поэтому память не зависит от размера аудитории. После каждой
+    пачки сохраняется курсор, а внутри пачки - доставки по каждому
+    получателю, поэтому после перезапуска рассылка продолжается ровно
+    с того места, где остановилась.
+    """
+    
+    def __init__(self, db, chunk_size: int = 200,
+                 progress_interval: float = config.BROADCAST_PROGRESS_INTERVAL):
+        """
+        Args:
+            db: Хранилище (storage.Storage)
+            chunk_size: Размер пачки получателей между сохранениями курсора
+            progress_interval: Как часто обновлять сообщение о прогрессе (секунды)
+        """
+        self.db = db
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        # Владелец аренды рассылок - этот экземпляр бота
+        self.owner = secrets.token_hex(8)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._stops: Dict[int, asyncio.Event] = {}
+        self._watcher: Optional[asyncio.Task] = None
+    
+    async def create(self, bot, audience: str, description: str, content: BroadcastContent,
+                     admin_chat_id: int) -> Optional[int]:
+        """
+        Создать и запустить рассылку
+        
+        Returns:
+            ID рассылки или None, если получателей нет
+        """
+        total = await self.db.count_audience(audience)
+        if not total:
+            return None
+        
+        broadcast_id = await self.db.create_broadcast(
+            audience, description, content.text, admin_chat_id, total,
+            source_chat_id=content.source_chat_id, source_message_id=content.source_message_id,
+            media_kind=content.media_kind, media_file_id=content.media_file_id
+        )
+        job = await self.db.get_broadcast(broadcast_id)
+        status_message = await bot.send_message(chat_id=admin_chat_id, text=format_broadcast_status(job))
+        await self.db.set_broadcast_status_message(broadcast_id, status_message.message_id)
+        
+        await self._launch(bot, broadcast_id)
+        return broadcast_id
+    
+    def start(self, bot):
+        """Подхватывать идущие рассылки без владельца: сразу и затем раз в CLAIM_SECONDS"""
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch(bot))
+    
+    async def resume_unfinished(self, bot):
+        """Продолжить рассылки, прерванные перезапуском бота или падением другого экземпляра"""
+        for job in await self.db.get_broadcasts(statuses=['running'], limit=100):
+            if job['broadcast_id'] not in self._tasks and await self._launch(bot, job['broadcast_id']):
+                logger.info(f"Продолжаем прерванную рассылку #{job['broadcast_id']}")
+    
+    async def pause(self, broadcast_id: int) -> bool:
+        """Приостановить рассылку"""
+        job = await self.db.get_broadcast(broadcast_id)
+        if not job or job['status'] != 'running':
+            return False
+        await self.db.set_broadcast_status(broadcast_id, 'paused')
+        await self._stop_task(broadcast_id)
+        return True
+    
+    async def resume(self, bot, broadcast_id: int) -> bool:
+        """Продолжить приостановленную рассылку"""
+        job = await self.db.get_broadcast(broadcast_id)
+        if not job or job['status'] != 'paused':
+            return False
+        await self.db.set_broadcast_status(broadcast_id, 'running')
+        # Если её ещё ведёт другой экземпляр (он не успел заметить паузу), он и продолжит
+        await self._launch(bot, broadcast_id)
+        return True
+    
+    async def cancel(self, bot, broadcast_id: int) -> bool:
+        """Отменить рассылку"""
+        job = await self.db.get_broadcast(broadcast_id)
+        if not job or job['status'] not in ('running', 'paused'):
+            return False
+        await self.db.set_broadcast_status(broadcast_id, 'cancelled')
+        if not await self._stop_task(broadcast_id):
+            await self._update_status_message(bot, broadcast_id)
+        return True
+    
+    async def stop(self):
+        """Остановить все рассылки при выключении бота (они продолжатся после запуска)"""
+        tasks = list(self._tasks.values())
+        if self._watcher is not None:
+            tasks.append(self._watcher)
+            self._watcher = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _watch(self, bot):
+        """Периодически подхватывать рассылки, аренда которых истекла"""
+        while True:
+            try:
+                await self.resume_unfinished(bot)
+            except Exception as e:
+                logger.error(f"Не удалось проверить прерванные рассылки: {e}")
+            await asyncio.sleep(CLAIM_SECONDS)
+    
+    async def _launch(self, bot, broadcast_id: int) -> bool:
+        """
+        Арендовать рассылку и запустить её фоновую задачу
+        
+        Returns:
+            False, если рассылку ведёт другой экземпляр или она уже не идёт
+        """
+        if broadcast_id in self._tasks:
+            return True
+        if not await self.db.claim_broadcast(broadcast_id, self.owner, CLAIM_SECONDS):
+            return False
+        self._stops[broadcast_id] = asyncio.Event()
+        self._tasks[broadcast_id] = asyncio.create_task(self._run(bot, broadcast_id))
+        return True
+    
+    async def _stop_task(self, broadcast_id: int) -> bool:
+        """Попросить задачу рассылки остановиться и дождаться её"""
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return False
+        self._stops[broadcast_id].set()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+    
+    async def _run(self, bot, broadcast_id: int):
+        """Выполнение рассылки с места последнего сохранённого курсора"""
+        stop = self._stops[broadcast_id]
+        job = await self.db.get_broadcast(broadcast_id)
+        engine = BroadcastEngine()
+        errors = Counter()
+        session = {
+            'processed': 0,
+            'resumed_from': job['sent'] + job['failed'],
+            'started_at': time.monotonic()
+        }
+        
+        send = make_sender(bot, BroadcastContent.from_job(job))
+        
+        async def on_result(chat_id, delivered):
+            await self.db.record_broadcast_delivery(broadcast_id, chat_id, delivered)
+            session['processed'] += 1
+        
+        def throughput():
+            elapsed = time.monotonic() - session['started_at']
+            return session['processed'] / elapsed if elapsed > 0 else 0.0
+        
+        progress = asyncio.create_task(self._report_progress(bot, broadcast_id, throughput))
+        try:
+            delivered = await self.db.get_broadcast_deliveries(broadcast_id)
+            chunks = self.db.iter_audience_pages(
+                job['audience'], after_user_id=job['cursor_user_id'], page_size=self.chunk_size
+            )
+            
+            async for chunk in chunks:
+                # Не удалось продлить аренду - рассылку остановили или отменили с другого экземпляра
+                if not await self.db.claim_broadcast(broadcast_id, self.owner, CLAIM_SECONDS):
+                    break
+                report = await engine.run(
+                    [user_id for user_id in chunk if user_id not in delivered],
+                    send, on_result=on_result, stop=stop
+                )
+                errors.update(report.errors)
+                if stop.is_set():
+                    break
+                await self.db.advance_broadcast_cursor(broadcast_id, chunk[-1])
+            else:
+                await self.db.set_broadcast_status(broadcast_id, 'finished')
+                job = await self.db.get_broadcast(broadcast_id)
+                await self._send_report(bot, job, errors, session)
+        except asyncio.CancelledError:
+            # Бот останавливается - рассылка продолжится после перезапуска
+            raise
+        except BroadcastSourceLost:
+            # Продолжить нечем: после возобновления каждая отправка снова завершилась бы ошибкой
+            logger.error(f"Исходное сообщение рассылки #{broadcast_id} удалено, рассылка отменена")
+            await self.db.set_broadcast_status(broadcast_id, 'cancelled')
+            await self._send_source_lost(bot, broadcast_id)
+        except Exception as e:
+            logger.error(f"Ошибка рассылки #{broadcast_id}, рассылка приостановлена: {e}")
+            await self.db.set_broadcast_status(broadcast_id, 'paused')
+        finally:
+            progress.cancel()
+            self._tasks.pop(broadcast_id, None)
+            self._stops.pop(broadcast_id, None)
+            # Снятая аренда позволяет другому экземпляру продолжить рассылку сразу
+            try:
+                await self.db.release_broadcast(broadcast_id, self.owner)
+            except Exception as e:
+                logger.warning(f"Не удалось снять аренду рассылки #{broadcast_id}: {e}")
+        
+        await self._update_status_message(bot, broadcast_id)
+    
+    async def _report_progress(self, bot, broadcast_id: int, throughput: Callable[[], float]):
+        """Периодически обновлять сообщение о прогрессе"""
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._update_status_message(bot, broadcast_id, throughput())
+    
+    async def _update_status_message(self, bot, broadcast_id: int, throughput: float = 0.0):
+        """Отредактировать сообщение о прогрессе в чате администратора"""
+        job = await self.db.get_broadcast(broadcast_id)
+        if not job or not job['status_message_id']:
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=job['admin_chat_id'],
+                message_id=job['status_message_id'],
+                text=format_broadcast_status(job, throughput),
+                rate_limit_args=PRIORITY_BROADCAST
+            )
+        except BadRequest as e:
+            # "Message is not modified" - прогресс не изменился
+            if 'not modified' not in str(e).lower():
+                logger.warning(f"Не удалось обновить прогресс рассылки #{broadcast_id}: {e}")
+        except TelegramError as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки #{broadcast_id}: {e}")
+    
+    async def _send_source_lost(self, bot, broadcast_id: int):
+        """Сообщить администратору, что рассылка отменена из-за удалённого исходного сообщения"""
+        job = await self.db.get_broadcast(broadcast_id)
+        text = (
+            f"⚠️ Рассылка #{broadcast_id} отменена: исходное сообщение удалено, "
+            f"а его содержимое нельзя отправить заново.\n\n"
+            f"Успешно: {job['sent']} из {job['total']}. Чтобы разослать остальным, "
+            f"отправьте сообщение ещё раз и запустите новую рассылку."
+        )
+        try:
+            await bot.send_message(chat_id=job['admin_chat_id'], text=text, rate_limit_args=PRIORITY_FUNNEL)
+        except TelegramError as e:
+            logger.error(f"Не удалось сообщить об отмене рассылки #{broadcast_id}: {e}")
+    
+    async def _send_report(self, bot, job: Dict, errors: Counter, session: Dict):
+        """Итоговый отчёт администратору"""
+        report = BroadcastReport(
+            total=job['total'], sent=job['sent'], failed=job['failed'], errors=errors,
+            resumed_from=session['resumed_from'],
+            started_at=session['started_at'], finished_at=time.monotonic()
+        )
+        try:
+            await bot.send_message(chat_id=job['admin_chat_id'], text=report.format(), rate_limit_args=PRIORITY_FUNNEL)
+        except TelegramError as e:
+            logger.error(f"Не удалось отправить отчёт о рассылке #{job['broadcast_id']}: {e}")
@@ -0,0 +1,121 @@
+"""
+Кеши состояния пользователей воронки "Антистресс"
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(value: int) -> int:
+    """Перемешивание 64-битного числа (splitmix64)"""
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+class BloomFilter:
+    """
+    Фильтр Блума для целочисленных ключей
+    
+    Отрицательный ответ точный: если ключа нет в фильтре, его нет и в базе.
+    Положительный ответ может быть ложным с вероятностью error_rate.
+    """
+    
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """
+        Args:
+            capacity: Ожидаемое количество ключей
+            error_rate: Допустимая доля ложноположительных ответов
+        """
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+    
+    def _positions(self, key: int):
+        """Номера битов ключа (двойное хеширование)"""
+        h1 = _mix64(key)
+        h2 = _mix64(h1) | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+    
+    def add(self, key: int):
+        """Добавить ключ"""
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def __contains__(self, key: int) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class UserStateCache:
+    """LRU-кеш состояния пользователей с ограниченным временем жизни записей"""
+    
+    def __init__(self, max_size: int, ttl: float):
+        """
+        Args:
+            max_size: Максимальное количество записей
+            ttl: Время жизни записи в секундах
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id: int) -> Tuple[bool, Any]:
+        """
+        Получить состояние пользователя
+        
+        Returns:
+            (найдено ли в кеше, значение)
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return False, None
+            
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return True, entry[1]
+    
+    def put(self, user_id: int, value: Any):
+        """Сохранить состояние пользователя"""
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(user_id)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def update(self, user_id: int, **fields):
+        """Обновить поля закешированного состояния (если пользователь в кеше)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] is not None:
+                entry[1].update(fields)
+    
+    def invalidate(self, user_id: int):
+        """Удалить пользователя из кеша"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+    
+    def clear(self):
+        """Очистить кеш"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> Dict[str, int]:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
@@ -17,14 +17,14 @@ if TEST_MODE:
     OFFER_DELAY_SECONDS = 60  # 1 минута после получения PDF
     WARMUP_1_HOURS = 1 / 60  # 1 минута после предложения консультации
     WARMUP_2_HOURS = 1 / 60  # 1 минута после первого догрева
-    CHECK_INTERVAL_SECONDS = 30  # Проверка каждые 30 секунд
+    CHECK_INTERVAL_SECONDS = 30  # Страховочная проверка шагов воронки каждые 30 секунд
     
     print("⚠️ БОТ РАБОТАЕТ В ТЕСТОВОМ РЕЖИМЕ!")
     print("Таймеры:")
     print(f"  - Предложение консультации: {OFFER_DELAY_SECONDS} сек после PDF")
     print(f"  - Первый догрев: 1 минута после предложения")
     print(f"  - Второй догрев: 1 минута после первого догрева")
-    print(f"  - Проверка пользователей: каждые {CHECK_INTERVAL_SECONDS} сек")
+    print(f"  - Страховочная проверка догревов: каждые {CHECK_INTERVAL_SECONDS} сек")
     print()
     
 else:
@@ -34,18 +34,34 @@ else:
     # ВАЖНО: таймеры отсчитываются от last_message_time
     # - После отправки предложения обновляется last_message_time
     # - Первый прогрев: через 24 часа от last_message_time (когда было отправлено предложение)
-    # - После отправки первого прогрева обновляется last_message_time (в mark_warmup_sent)
+    # - После отправки первого прогрева обновляется last_message_time (в mark_step_sent)
     # - Второй прогрев: через 24 часа от НОВОГО last_message_time (когда был отправлен первый прогрев)
     
     WARMUP_1_HOURS = 24  # 24 часа после предложения консультации
     WARMUP_2_HOURS = 24  # 24 часа после первого догрева (итого 48 часов после предложения)
-    CHECK_INTERVAL_SECONDS = 300  # Проверка каждые 5 минут (было 3600 для production)
+    # Шаги воронки отправляются точно в срок: фоновая задача спит до ближайшего
+    # due_at и просыпается раньше, если появился более ранний срок. Интервал -
+    # только страховка на случай, если база изменена извне (другим процессом)
+    CHECK_INTERVAL_SECONDS = 3600  # Страховочная проверка раз в час
     
     print("✅ БОТ РАБОТАЕТ В ПРОДАКШН РЕЖИМЕ")
     print("Таймеры:")
     print(f"  - Предложение консультации: {OFFER_DELAY_SECONDS} сек после PDF")
     print(f"  - Первый догрев: {WARMUP_1_HOURS} часов после предложения")
     print(f"  - Второй догрев: {WARMUP_2_HOURS} часов после первого догрева (итого 48 часов после предложения)")
-    print(f"  - Проверка пользователей: каждые {CHECK_INTERVAL_SECONDS} сек ({CHECK_INTERVAL_SECONDS // 60} минут)")
+    print(f"  - Страховочная проверка догревов: каждые {CHECK_INTERVAL_SECONDS} сек ({CHECK_INTERVAL_SECONDS // 60} минут)")
     print()
 
+# 📨 ШАГИ ВОРОНКИ ДОГРЕВА
+# Шаги отправляются по порядку; чтобы добавить шаг, допишите строку.
+# - key: ключ шага в базе (у работающего бота не переименовывать)
+# - title: название для /stats
+# - message: имя текста в messages.py
+# - delay_hours: задержка от предыдущего сообщения бота
+# - condition: кому отправлять (no_contact, with_contact, all)
+FUNNEL_STEPS = [
+    {'key': 'warmup_1', 'title': 'Догрев 1', 'message': 'WARMUP_1_MESSAGE',
+     'delay_hours': WARMUP_1_HOURS, 'condition': 'no_contact'},
+    {'key': 'warmup_2', 'title': 'Догрев 2', 'message': 'WARMUP_2_MESSAGE',
+     'delay_hours': WARMUP_2_HOURS, 'condition': 'no_contact'},
+]
@@ -1,49 +1,718 @@
 """
 Модуль для работы с базой данных пользователей воронки "Антистресс"
 """
+import asyncio
+import concurrent.futures
+import logging
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Optional, Dict
+from typing import Callable, Iterator, List, Optional, Dict, Tuple, Union
 import config
+import config_timing
+import metrics
+from cache import BloomFilter, UserStateCache
+from funnel import FUNNEL
+
+logger = logging.getLogger(__name__)
+
+# Ключи шагов, в которые переносятся колонки warmup_1_sent / warmup_2_sent старых баз
+LEGACY_WARMUP_STEPS = ('warmup_1', 'warmup_2')
+
+# Размер страницы при постраничном обходе пользователей
+PAGE_SIZE = 500
+
+# Минимальная ёмкость фильтра известных пользователей
+KNOWN_USERS_MIN_CAPACITY = 100000
+
+# Размер страницы при заполнении фильтра известных пользователей
+KNOWN_USERS_PAGE_SIZE = 5000
+
+# Условия отбора аудиторий рассылок (недоступные пользователи исключаются всегда)
+AUDIENCE_FILTERS = {
+    'all': 'inactive_at IS NULL',
+    'no_contact': 'inactive_at IS NULL AND contact_provided = 0',
+    'with_contact': 'inactive_at IS NULL AND contact_provided = 1',
+}
+
+# Размер кеша подготовленных выражений на одно соединение
+STATEMENT_CACHE_SIZE = 128
+
+# Настройки соединения: WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL убирает fsync на каждый коммит (в режиме WAL это безопасно)
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',     # 16 МБ страничного кеша
+    'PRAGMA mmap_size=67108864',    # 64 МБ memory-mapped I/O
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+# Отложенные записи состояния воронки (параметры для executemany)
+STATUS_UPDATE_SQL = 'UPDATE users SET status = ?, last_message_time = ? WHERE user_id = ?'
+STATUS_ONLY_SQL = 'UPDATE users SET status = ? WHERE user_id = ?'
+# Воронка стартует с первого шага; если она уже идёт, таймер текущего шага отсчитывается заново
+FUNNEL_RESTART_SQL = f'''
+    INSERT INTO user_steps (user_id, step, due_at) VALUES (?, '{FUNNEL.first.key}', ?)
+    ON CONFLICT (user_id) DO UPDATE SET due_at = ? + {FUNNEL.delay_sql('user_steps.step')}, attempts = 0
+    WHERE user_steps.step IS NOT NULL
+'''
+# Переход к следующему шагу; остановленная воронка (due_at IS NULL) не возобновляется
+STEP_SENT_SQL = '''
+    UPDATE user_steps SET step = ?, due_at = CASE WHEN due_at IS NOT NULL THEN ? END, attempts = 0
+    WHERE user_id = ? AND step = ?
+'''
+LAST_MESSAGE_SQL = 'UPDATE users SET last_message_time = ? WHERE user_id = ?'
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite"""
+    
+    def __init__(self, db_path: str, size: int = config.DB_POOL_SIZE):
+        """
+        Инициализация пула
+        
+        Args:
+            db_path: Путь к файлу базы данных
+            size: Максимальное количество соединений
+        """
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    def _create_connection(self) -> sqlite3.Connection:
+        """Открыть новое соединение и применить настройки"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            isolation_level=None  # транзакциями управляет connection()
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def _acquire(self) -> sqlite3.Connection:
+        """Взять соединение из пула (или создать новое, если лимит не исчерпан)"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        
+        if create:
+            try:
+                return self._create_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        return self._idle.get()
+    
+    @contextmanager
+    def connection(self, durable: bool = False):
+        """
+        Соединение из пула на время блока with
+        
+        Блок выполняется в транзакции: при успешном выходе она коммитится,
+        при исключении - откатывается. Вложенный вызов в том же потоке
+        переиспользует открытую транзакцию и изолируется точкой сохранения,
+        поэтому несколько операций можно объединить в один коммит.
+        
+        Args:
+            durable: Коммит с fsync (synchronous=FULL) - после выхода из блока
+                запись переживёт и падение системы, а не только процесса
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.execute('SAVEPOINT nested')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK TO nested')
+                conn.execute('RELEASE nested')
+                raise
+            conn.execute('RELEASE nested')
+            return
+        
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            if durable:
+                conn.execute('PRAGMA synchronous=FULL')
+            conn.execute('BEGIN')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            if durable:
+                conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = None
+            self._idle.put(conn)
+    
+    def close(self):
+        """Закрыть все свободные соединения"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+class WriteBuffer:
+    """
+    Буфер отложенной записи (group commit)
+    
+    Однотипные UPDATE копятся в памяти и сбрасываются одной транзакцией
+    через executemany - один fsync на всю группу вместо коммита на каждого
+    пользователя. Каждая запись получает future, который завершается после
+    коммита группы: до этого момента запись не считается сохранённой.
+    """
+    
+    def __init__(self, pool: ConnectionPool, max_size: int = config.DB_WRITE_BATCH_SIZE,
+                 max_delay: float = config.DB_WRITE_FLUSH_INTERVAL):
+        """
+        Args:
+            pool: Пул соединений
+            max_size: Сбросить буфер, когда в нём накопится столько записей
+            max_delay: Сбросить буфер, когда старейшая запись ждёт столько секунд
+        """
+        self.pool = pool
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._statements: Dict[str, List[tuple]] = {}
+        self._waiters: List[Tuple[float, concurrent.futures.Future]] = []
+        self._oldest: Optional[float] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+    
+    def add(self, *writes: Tuple[str, tuple]) -> concurrent.futures.Future:
+        """
+        Добавить записи в буфер (все попадут в одну группу)
+        
+        Args:
+            writes: Пары (SQL-выражение, параметры); записи с одинаковым
+                выражением идут в один executemany
+            
+        Returns:
+            Future, который завершается после коммита (или с ошибкой записи)
+        """
+        future = concurrent.futures.Future()
+        now = time.perf_counter()
+        with self._lock:
+            for statement, params in writes:
+                self._statements.setdefault(statement, []).append(params)
+            self._waiters.append((now, future))
+            if self._oldest is None:
+                self._oldest = now
+        return future
+    
+    def pending(self) -> int:
+        """Сколько записей ждут сброса"""
+        return len(self._waiters)
+    
+    def time_until_flush(self) -> Optional[float]:
+        """Через сколько секунд буфер нужно сбросить по времени (None - буфер пуст)"""
+        oldest = self._oldest
+        if oldest is None:
+            return None
+        return max(0.0, oldest + self.max_delay - time.perf_counter())
+    
+    def should_flush(self) -> bool:
+        """Пора ли сбрасывать буфер (по размеру или по времени)"""
+        return len(self._waiters) >= self.max_size or self.time_until_flush() == 0.0
+    
+    def flush(self) -> int:
+        """
+        Записать накопленное одной транзакцией с fsync
+        
+        Returns:
+            Количество записей в сброшенной группе
+        """
+        # Группы сбрасываются строго по очереди - порядок записей сохраняется
+        with self._flush_lock:
+            with self._lock:
+                statements, waiters = self._statements, self._waiters
+                self._statements, self._waiters, self._oldest = {}, [], None
+            if not waiters:
+                return 0
+            
+            started = time.perf_counter()
+            try:
+                with self.pool.connection(durable=True) as conn:
+                    for statement, rows in statements.items():
+                        conn.executemany(statement, rows)
+            except Exception as e:
+                for _, future in waiters:
+                    future.set_exception(e)
+                raise
+            
+            committed = time.perf_counter()
+            metrics.DB_FLUSH_SECONDS.observe(committed - started)
+            metrics.DB_FLUSH_SIZE.observe(len(waiters))
+            for added_at, future in waiters:
+                metrics.DB_WRITE_DELAY_SECONDS.observe(committed - added_at)
+                future.set_result(None)
+            return len(waiters)
 
 
 class Database:
-    def __init__(self, db_path: str = config.DATABASE_PATH):
+    def __init__(self, db_path: str = config.DATABASE_PATH, pool_size: int = config.DB_POOL_SIZE):
         """
         Инициализация базы данных
         
         Args:
             db_path: Путь к файлу базы данных
+            pool_size: Размер пула соединений
         """
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, pool_size)
+        self.writes = WriteBuffer(self.pool)
+        self.user_cache = UserStateCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+        self.negative_hits = 0
+        # Вызываются с Unix-временем нового срока шага воронки (в потоке, где идёт запись)
+        self.step_due_listeners: List[Callable[[int], None]] = []
         self.init_db()
+        self.load_known_users()
+    
+    def close(self):
+        """Сбросить отложенные записи и закрыть соединения с базой данных"""
+        self.flush_writes()
+        self.pool.close()
+    
+    def flush_writes(self) -> int:
+        """
+        Сбросить буфер отложенной записи
+        
+        Returns:
+            Количество сохранённых записей
+        """
+        try:
+            return self.writes.flush()
+        except Exception:
+            # Изменения из буфера уже попали в кеш - сбрасываем его
+            self.user_cache.clear()
+            raise
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Общая транзакция для нескольких вызовов методов
+        
+        Все методы, вызванные внутри блока with в этом же потоке,
+        фиксируются одним коммитом.
+        """
+        try:
+            with self.pool.connection() as conn:
+                yield conn
+        except Exception:
+            # Откаченные изменения могли попасть в кеш - сбрасываем его
+            self.user_cache.clear()
+            raise
+    
+    def load_known_users(self):
+        """
+        Заполнение фильтра известных пользователей
+        
+        Фильтр Блума отвечает «точно нет в базе» без обращения к SQLite,
+        поэтому сообщения незнакомых пользователей не доходят до базы.
+        В фильтр попадают все пользователи, включая недоступных: иначе
+        вернувшийся к боту пользователь выглядел бы незнакомым.
+        """
+        capacity = max(KNOWN_USERS_MIN_CAPACITY, self.get_user_count() * 2)
+        known_users = BloomFilter(capacity)
+        after_user_id = 0
+        while True:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute(
+                    'SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                    (after_user_id, KNOWN_USERS_PAGE_SIZE)
+                )
+                page = [row[0] for row in cursor.fetchall()]
+            
+            for user_id in page:
+                known_users.add(user_id)
+            if len(page) < KNOWN_USERS_PAGE_SIZE:
+                break
+            after_user_id = page[-1]
+        self.known_users = known_users
+    
+    def _remember_user(self, user_id: int):
+        """Добавить пользователя в фильтр известных (с перестройкой при переполнении)"""
+        if self.known_users.count >= self.known_users.capacity:
+            self.load_known_users()
+        self.known_users.add(user_id)
+    
+    def cache_stats(self) -> Dict[str, int]:
+        """
+        Счётчики кеша состояния пользователей
+        
+        Returns:
+            hits, misses и size кеша, а также negative_hits - запросы
+            незнакомых пользователей, отсечённые фильтром без обращения к базе
+        """
+        stats = self.user_cache.stats()
+        stats['negative_hits'] = self.negative_hits
+        return stats
     
     def init_db(self):
         """Создание таблицы пользователей, если её нет"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    added_date TEXT NOT NULL,
+                    status TEXT DEFAULT 'file_sent',
+                    contact_provided INTEGER DEFAULT 0,
+                    contact_name TEXT,
+                    contact_phone TEXT,
+                    last_message_time TEXT,
+                    inactive_at INTEGER,
+                    inactive_reason TEXT
+                )
+            ''')
+            
+            # Прогресс по воронке догрева: ключ следующего шага и время, когда он наступает
+            # (due_at IS NULL - воронка пройдена или остановлена), attempts - сколько раз
+            # шаг забирался на отправку
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_steps (
+                    user_id INTEGER PRIMARY KEY,
+                    step TEXT,
+                    due_at INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # Базы, созданные до появления счётчика попыток
+            cursor.execute('PRAGMA table_info(user_steps)')
+            if 'attempts' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute('ALTER TABLE user_steps ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            # Наступившие шаги всех этапов - один диапазонный скан по этому индексу
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_steps_due ON user_steps (due_at)')
+            
+            # Сколько раз отправлен каждый шаг
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS funnel_step_stats (
+                    step TEXT PRIMARY KEY,
+                    sent INTEGER NOT NULL
+                )
+            ''')
+            
+            # Базы, в которых догревы хранились колонками users
+            cursor.execute('PRAGMA table_info(users)')
+            columns = {row[1] for row in cursor.fetchall()}
+            if 'warmup_1_sent' in columns:
+                self._migrate_legacy_warmups(cursor, columns)
+            
+            # Базы, созданные до появления отметки о недоступности
+            if 'inactive_at' not in columns:
+                cursor.execute('ALTER TABLE users ADD COLUMN inactive_at INTEGER')
+                cursor.execute('ALTER TABLE users ADD COLUMN inactive_reason TEXT')
+            
+            # Недоступных (заблокировавших бота) немного - частичный индекс только по ним
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_inactive
+                ON users (inactive_at) WHERE inactive_at IS NOT NULL
+            ''')
+            
+            # Кеш file_id загруженных в Telegram файлов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    media_key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    file_hash TEXT NOT NULL,
+                    file_mtime REAL NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Отложенные шаги воронки (due_at - unix-время запуска)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                    user_id INTEGER NOT NULL,
+                    step TEXT NOT NULL,
+                    due_at INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, step)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs (due_at)')
+            
+            # Уведомления администратору о контактах: хранятся до доставки сводки
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS admin_notifications (
+                    notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    name TEXT,
+                    phone TEXT,
+                    username TEXT,
+                    created_at INTEGER NOT NULL,
+                    claimed_by TEXT,
+                    claimed_until INTEGER
+                )
+            ''')
+            
+            # Аренда сводки (claimed_by, claimed_until) появилась позже самих уведомлений
+            cursor.execute('PRAGMA table_info(admin_notifications)')
+            if 'claimed_by' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute('ALTER TABLE admin_notifications ADD COLUMN claimed_by TEXT')
+                cursor.execute('ALTER TABLE admin_notifications ADD COLUMN claimed_until INTEGER')
+            
+            # Рассылки: получатели обходятся по возрастанию user_id,
+            # cursor_user_id - последний полностью обработанный получатель
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    audience TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    message_text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    admin_chat_id INTEGER NOT NULL,
+                    status_message_id INTEGER,
+                    cursor_user_id INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    finished_at TEXT,
+                    source_chat_id INTEGER,
+                    source_message_id INTEGER,
+                    media_kind TEXT,
+                    media_file_id TEXT,
+                    claimed_by TEXT,
+                    claimed_until INTEGER
+                )
+            ''')
+            
+            # Рассылки копией сообщения администратора появились позже текстовых:
+            # source_* - копируемое сообщение (message_text тогда в HTML),
+            # media_kind и media_file_id - тип и file_id вложения
+            cursor.execute('PRAGMA table_info(broadcasts)')
+            broadcast_columns = {row[1] for row in cursor.fetchall()}
+            if 'source_message_id' not in broadcast_columns:
+                cursor.execute('ALTER TABLE broadcasts ADD COLUMN source_chat_id INTEGER')
+                cursor.execute('ALTER TABLE broadcasts ADD COLUMN source_message_id INTEGER')
+                cursor.execute('ALTER TABLE broadcasts ADD COLUMN media_kind TEXT')
+            if 'media_file_id' not in broadcast_columns:
+                # Раньше file_id вложения рассылки хранился в media_cache под ключом broadcast:<id>
+                cursor.execute('ALTER TABLE broadcasts ADD COLUMN media_file_id TEXT')
+                cursor.execute('''
+                    UPDATE broadcasts SET media_file_id = (
+                        SELECT file_id FROM media_cache WHERE media_key = 'broadcast:' || broadcast_id
+                    )
+                ''')
+                cursor.execute("DELETE FROM media_cache WHERE media_key LIKE 'broadcast:%'")
+            # Аренда рассылки экземпляром бота, который её ведёт
+            if 'claimed_by' not in broadcast_columns:
+                cursor.execute('ALTER TABLE broadcasts ADD COLUMN claimed_by TEXT')
+                cursor.execute('ALTER TABLE broadcasts ADD COLUMN claimed_until INTEGER')
+            
+            # Доставки после курсора (чтобы при возобновлении не отправить повторно)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                    broadcast_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    delivered INTEGER NOT NULL,
+                    PRIMARY KEY (broadcast_id, user_id)
+                ) WITHOUT ROWID
+            ''')
+            
+            self._init_funnel_stats(cursor)
+    
+    def _init_funnel_stats(self, cursor: sqlite3.Cursor):
+        """
+        Создание счётчиков воронки
         
+        Счётчики хранятся в одной строке и поддерживаются триггерами на users,
+        поэтому меняются в той же транзакции, что и сама запись пользователя.
+        Отправленные шаги считает триггер на user_steps. При первом запуске
+        счётчики заполняются по существующим данным.
+        """
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                added_date TEXT NOT NULL,
-                status TEXT DEFAULT 'file_sent',
-                contact_provided INTEGER DEFAULT 0,
-                contact_name TEXT,
-                contact_phone TEXT,
-                last_message_time TEXT,
-                warmup_1_sent INTEGER DEFAULT 0,
-                warmup_2_sent INTEGER DEFAULT 0
+            CREATE TABLE IF NOT EXISTS funnel_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_users INTEGER NOT NULL,
+                with_contact INTEGER NOT NULL,
+                status_file_sent INTEGER NOT NULL,
+                status_offer_sent INTEGER NOT NULL,
+                status_contact_provided INTEGER NOT NULL,
+                inactive INTEGER NOT NULL DEFAULT 0,
+                inactive_with_contact INTEGER NOT NULL DEFAULT 0
             )
         ''')
         
-        conn.commit()
-        conn.close()
+        # Счётчики недоступных появились позже остальных
+        cursor.execute('PRAGMA table_info(funnel_stats)')
+        if 'inactive' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE funnel_stats ADD COLUMN inactive INTEGER NOT NULL DEFAULT 0')
+            cursor.execute('ALTER TABLE funnel_stats ADD COLUMN inactive_with_contact INTEGER NOT NULL DEFAULT 0')
+        
+        cursor.execute('SELECT 1 FROM funnel_stats WHERE id = 1')
+        if cursor.fetchone() is None:
+            cursor.execute('''
+                INSERT INTO funnel_stats
+                SELECT 1, COUNT(*),
+                       COALESCE(SUM(contact_provided = 1), 0),
+                       COALESCE(SUM(status IS 'file_sent'), 0),
+                       COALESCE(SUM(status IS 'offer_sent'), 0),
+                       COALESCE(SUM(status IS 'contact_provided'), 0),
+                       COALESCE(SUM(inactive_at IS NOT NULL), 0),
+                       COALESCE(SUM(inactive_at IS NOT NULL AND contact_provided = 1), 0)
+                FROM users
+            ''')
+        
+        cursor.execute('SELECT 1 FROM funnel_step_stats LIMIT 1')
+        if cursor.fetchone() is None:
+            # Шаг отправлен всем, кто продвинулся дальше него по воронке
+            position = FUNNEL.position_sql('step')
+            cursor.executemany(f'''
+                INSERT INTO funnel_step_stats (step, sent)
+                SELECT ?, COUNT(*) FROM user_steps WHERE {position} > ?
+            ''', [(step.key, index) for index, step in enumerate(FUNNEL.steps)])
+        
+        # Определения триггеров менялись - пересоздаём их при каждом запуске.
+        # IS вместо = - чтобы NULL в статусе не превращал счётчик в NULL
+        for trigger in ('trg_users_funnel_insert', 'trg_users_funnel_update', 'trg_users_funnel_delete'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        cursor.execute('''
+            CREATE TRIGGER trg_users_funnel_insert
+            AFTER INSERT ON users
+            BEGIN
+                UPDATE funnel_stats SET
+                    total_users = total_users + 1,
+                    with_contact = with_contact + (NEW.contact_provided IS 1),
+                    status_file_sent = status_file_sent + (NEW.status IS 'file_sent'),
+                    status_offer_sent = status_offer_sent + (NEW.status IS 'offer_sent'),
+                    status_contact_provided = status_contact_provided + (NEW.status IS 'contact_provided'),
+                    inactive = inactive + (NEW.inactive_at IS NOT NULL),
+                    inactive_with_contact = inactive_with_contact
+                        + (NEW.inactive_at IS NOT NULL AND NEW.contact_provided IS 1)
+                WHERE id = 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER trg_users_funnel_update
+            AFTER UPDATE OF status, contact_provided, inactive_at ON users
+            WHEN OLD.status IS NOT NEW.status
+              OR OLD.contact_provided IS NOT NEW.contact_provided
+              OR (OLD.inactive_at IS NULL) IS NOT (NEW.inactive_at IS NULL)
+            BEGIN
+                UPDATE funnel_stats SET
+                    with_contact = with_contact
+                        + (NEW.contact_provided IS 1) - (OLD.contact_provided IS 1),
+                    status_file_sent = status_file_sent
+                        + (NEW.status IS 'file_sent') - (OLD.status IS 'file_sent'),
+                    status_offer_sent = status_offer_sent
+                        + (NEW.status IS 'offer_sent') - (OLD.status IS 'offer_sent'),
+                    status_contact_provided = status_contact_provided
+                        + (NEW.status IS 'contact_provided') - (OLD.status IS 'contact_provided'),
+                    inactive = inactive
+                        + (NEW.inactive_at IS NOT NULL) - (OLD.inactive_at IS NOT NULL),
+                    inactive_with_contact = inactive_with_contact
+                        + (NEW.inactive_at IS NOT NULL AND NEW.contact_provided IS 1)
+                        - (OLD.inactive_at IS NOT NULL AND OLD.contact_provided IS 1)
+                WHERE id = 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER trg_users_funnel_delete
+            AFTER DELETE ON users
+            BEGIN
+                UPDATE funnel_stats SET
+                    total_users = total_users - 1,
+                    with_contact = with_contact - (OLD.contact_provided IS 1),
+                    status_file_sent = status_file_sent - (OLD.status IS 'file_sent'),
+                    status_offer_sent = status_offer_sent - (OLD.status IS 'offer_sent'),
+                    status_contact_provided = status_contact_provided - (OLD.status IS 'contact_provided'),
+                    inactive = inactive - (OLD.inactive_at IS NOT NULL),
+                    inactive_with_contact = inactive_with_contact
+                        - (OLD.inactive_at IS NOT NULL AND OLD.contact_provided IS 1)
+                WHERE id = 1;
+                DELETE FROM user_steps WHERE user_id = OLD.user_id;
+            END
+        ''')
+        # Переход к следующему шагу означает, что предыдущий отправлен
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_user_steps_sent
+            AFTER UPDATE OF step ON user_steps
+            WHEN OLD.step IS NOT NULL AND OLD.step IS NOT NEW.step
+            BEGIN
+                INSERT INTO funnel_step_stats (step, sent) VALUES (OLD.step, 1)
+                ON CONFLICT (step) DO UPDATE SET sent = sent + 1;
+            END
+        ''')
+    
+    def _migrate_legacy_warmups(self, cursor: sqlite3.Cursor, columns: set):
+        """
+        Перенос прогресса из колонок warmup_1_sent / warmup_2_sent / next_action_at в user_steps
+        
+        Если next_action_at ещё не заполнен, время следующего догрева
+        вычисляется из last_message_time. Старые триггеры и индекс ссылаются
+        на удаляемые колонки, поэтому удаляются первыми и создаются заново
+        в _init_funnel_stats.
+        """
+        first, second = LEGACY_WARMUP_STEPS
+        delays = (int(config_timing.WARMUP_1_HOURS * 3600), int(config_timing.WARMUP_2_HOURS * 3600))
+        next_action_at = 'next_action_at' if 'next_action_at' in columns else 'NULL'
+        
+        for trigger in ('trg_users_funnel_insert', 'trg_users_funnel_update', 'trg_users_funnel_delete'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        cursor.execute('DROP INDEX IF EXISTS idx_users_next_action')
+        
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO user_steps (user_id, step, due_at)
+            SELECT user_id,
+                   CASE WHEN warmup_2_sent = 1 THEN NULL WHEN warmup_1_sent = 1 THEN ? ELSE ? END,
+                   CASE WHEN warmup_2_sent = 1 OR contact_provided = 1 THEN NULL
+                        ELSE COALESCE({next_action_at},
+                                      CAST(strftime('%s', last_message_time, 'utc') AS INTEGER)
+                                      + CASE WHEN warmup_1_sent = 0 THEN ? ELSE ? END)
+                   END
+            FROM users
+            WHERE status = 'offer_sent' OR warmup_1_sent = 1 OR contact_provided = 1
+        ''', (second, first, *delays))
+        cursor.execute('''
+            INSERT OR IGNORE INTO funnel_step_stats (step, sent)
+            SELECT ?, COALESCE(SUM(warmup_1_sent = 1), 0) FROM users
+            UNION ALL
+            SELECT ?, COALESCE(SUM(warmup_2_sent = 1), 0) FROM users
+        ''', (first, second))
+        
+        for column in ('warmup_1_sent', 'warmup_2_sent', 'next_action_at'):
+            if column in columns:
+                cursor.execute(f'ALTER TABLE users DROP COLUMN {column}')
+        
+        cursor.execute('PRAGMA table_info(funnel_stats)')
+        if 'warmup_1_sent' in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE funnel_stats DROP COLUMN warmup_1_sent')
+            cursor.execute('ALTER TABLE funnel_stats DROP COLUMN warmup_2_sent')
     
-    def add_user(self, user_id: int, username: Optional[str] = None, 
+    def add_user(self, user_id: int, username: Optional[str] = None,
                  first_name: Optional[str] = None, last_name: Optional[str] = None) -> bool:
         """
         Добавление пользователя в базу данных
@@ -53,31 +722,40 @@ class Database:
             username: Username пользователя
             first_name: Имя пользователя
             last_name: Фамилия пользователя
-            
+        
         Returns:
             True если пользователь добавлен, False если уже существует
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Проверяем, есть ли уже пользователь в базе
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        if cursor.fetchone():
-            conn.close()
-            return False
-        
-        # Добавляем нового пользователя
         added_date = datetime.now().isoformat()
-        cursor.execute('''
-            INSERT INTO users (
-                user_id, username, first_name, last_name, added_date, 
-                status, last_message_time
-            )
-            VALUES (?, ?, ?, ?, ?, 'file_sent', ?)
-        ''', (user_id, username, first_name, last_name, added_date, added_date))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Проверка и вставка - один оператор: из двух одновременных
+            # добавлений одного пользователя строку создаёт ровно одно
+            cursor.execute('''
+                INSERT INTO users (
+                    user_id, username, first_name, last_name, added_date,
+                    status, last_message_time
+                )
+                VALUES (?, ?, ?, ?, ?, 'file_sent', ?)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id
+            ''', (user_id, username, first_name, last_name, added_date, added_date))
+            if not cursor.fetchall():
+                return False
         
-        conn.commit()
-        conn.close()
+        self._remember_user(user_id)
+        self.user_cache.put(user_id, {
+            'user_id': user_id,
+            'username': username,
+            'first_name': first_name,
+            'contact_name': None,
+            'contact_phone': None,
+            'status': 'file_sent',
+            'added_date': added_date,
+            'contact_provided': 0,
+            'inactive_at': None
+        })
         return True
     
     def is_user_exists(self, user_id: int) -> bool:
@@ -86,43 +764,53 @@ class Database:
         
         Args:
             user_id: ID пользователя в Telegram
-            
+        
         Returns:
             True если пользователь существует, иначе False
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone() is not None
-        
-        conn.close()
-        return result
+        return self.get_user_info(user_id) is not None
     
     def update_user_status(self, user_id: int, status: str, update_time: bool = True):
         """
-        Обновление статуса пользователя
+        Обновление статуса пользователя (запись сохраняется до возврата)
         
         Args:
             user_id: ID пользователя
             status: Новый статус (file_sent, offer_sent, contact_provided)
             update_time: Обновлять ли время последнего сообщения
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self.defer_user_status(user_id, status, update_time)
+        self.flush_writes()
+    
+    def defer_user_status(self, user_id: int, status: str,
+                          update_time: bool = True) -> concurrent.futures.Future:
+        """
+        Обновление статуса пользователя через буфер отложенной записи
+        
+        С обновлением времени последнего сообщения запускается воронка
+        догрева, а если она уже идёт - таймер текущего шага отсчитывается заново.
         
+        Args:
+            user_id: ID пользователя
+            status: Новый статус (file_sent, offer_sent, contact_provided)
+            update_time: Обновлять ли время последнего сообщения
+            
+        Returns:
+            Future, который завершается после коммита записи
+        """
         if update_time:
-            current_time = datetime.now().isoformat()
-            cursor.execute('''
-                UPDATE users 
-                SET status = ?, last_message_time = ?
-                WHERE user_id = ?
-            ''', (status, current_time, user_id))
+            now = int(time.time())
+            future = self.writes.add(
+                (STATUS_UPDATE_SQL, (status, datetime.now().isoformat(), user_id)),
+                (FUNNEL_RESTART_SQL, (user_id, now + FUNNEL.first.delay_seconds, now)),
+            )
+            # Перезапущенный шаг наступит не раньше самой короткой задержки в воронке
+            self._notify_step_due(now + min(step.delay_seconds for step in FUNNEL.steps))
         else:
-            cursor.execute('UPDATE users SET status = ? WHERE user_id = ?', (status, user_id))
+            future = self.writes.add((STATUS_ONLY_SQL, (status, user_id)))
         
-        conn.commit()
-        conn.close()
+        self.user_cache.update(user_id, status=status)
+        return future
     
     def save_contact(self, user_id: int, name: str, phone: str):
         """
@@ -133,124 +821,326 @@ class Database:
             name: Имя для связи
             phone: Номер телефона
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users 
-            SET contact_provided = 1, contact_name = ?, contact_phone = ?, status = 'contact_provided'
-            WHERE user_id = ?
-        ''', (name, phone, user_id))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE users
+                SET contact_provided = 1, contact_name = ?, contact_phone = ?, status = 'contact_provided'
+                WHERE user_id = ?
+            ''', (name, phone, user_id))
         
-        conn.commit()
-        conn.close()
+        self.user_cache.update(
+            user_id, contact_provided=1, contact_name=name, contact_phone=phone, status='contact_provided'
+        )
     
-    def mark_warmup_sent(self, user_id: int, warmup_number: int):
+    def mark_inactive(self, user_id: int, reason: str):
         """
-        Отметить, что догревающее сообщение отправлено
+        Отметить пользователя недоступным (заблокировал бота, удалил аккаунт)
+        
+        Недоступные исключаются из рассылок, шагов воронки и отложенного
+        предложения, пока снова не напишут боту.
         
         Args:
             user_id: ID пользователя
-            warmup_number: Номер догрева (1 или 2)
+            reason: Причина (blocked, deactivated, chat_not_found)
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        inactive_at = int(time.time())
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE users SET inactive_at = ?, inactive_reason = ?
+                WHERE user_id = ? AND inactive_at IS NULL
+            ''', (inactive_at, reason, user_id))
+            if not cursor.rowcount:
+                return
+            cursor.execute('UPDATE user_steps SET due_at = NULL WHERE user_id = ?', (user_id,))
         
-        column = f'warmup_{warmup_number}_sent'
-        current_time = datetime.now().isoformat()
+        self.user_cache.update(user_id, inactive_at=inactive_at)
+    
+    def reactivate_user(self, user_id: int):
+        """
+        Снять отметку о недоступности (пользователь снова написал боту)
         
-        cursor.execute(f'''
-            UPDATE users 
-            SET {column} = 1, last_message_time = ?
-            WHERE user_id = ?
-        ''', (current_time, user_id))
+        Остановленная воронка продолжается с текущего шага, его таймер
+        отсчитывается заново.
         
-        conn.commit()
-        conn.close()
+        Args:
+            user_id: ID пользователя
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE users SET inactive_at = NULL, inactive_reason = NULL
+                WHERE user_id = ? AND inactive_at IS NOT NULL
+            ''', (user_id,))
+            due_at = None
+            if cursor.rowcount:
+                cursor.execute(f'''
+                    UPDATE user_steps SET due_at = ? + {FUNNEL.delay_sql('step')}, attempts = 0
+                    WHERE user_id = ? AND step IS NOT NULL AND due_at IS NULL
+                    RETURNING due_at
+                ''', (int(time.time()), user_id))
+                rows = cursor.fetchall()
+                due_at = rows[0][0] if rows else None
+        
+        self.user_cache.update(user_id, inactive_at=None)
+        if due_at is not None:
+            self._notify_step_due(due_at)
     
-    def get_users_for_warmup(self, hours: int, warmup_number: int) -> List[Dict]:
+    def mark_step_sent(self, user_id: int, step: str):
         """
-        Получить пользователей для догрева
+        Отметить, что шаг воронки отправлен (запись сохраняется до возврата)
         
         Args:
-            hours: Количество часов с последнего сообщения
-            warmup_number: Номер догрева (1 или 2)
+            user_id: ID пользователя
+            step: Ключ отправленного шага
+        """
+        self.defer_step_sent(user_id, step)
+        self.flush_writes()
+    
+    def defer_step_sent(self, user_id: int, step: str) -> concurrent.futures.Future:
+        """
+        Отметка об отправке шага через буфер отложенной записи
+        
+        Пользователь переходит к следующему шагу, который наступит через
+        свою задержку; после последнего шага воронка пройдена.
+        
+        Args:
+            user_id: ID пользователя
+            step: Ключ отправленного шага
             
         Returns:
-            Список пользователей, которым нужно отправить догрев
+            Future, который завершается после коммита записи
+        """
+        now = int(time.time())
+        next_step = FUNNEL.next_step(step)
+        if next_step is None:
+            advance = (None, None, user_id, step)
+        else:
+            advance = (next_step.key, now + next_step.delay_seconds, user_id, step)
+        future = self.writes.add(
+            (STEP_SENT_SQL, advance),
+            (LAST_MESSAGE_SQL, (datetime.now().isoformat(), user_id)),
+        )
+        if next_step is not None:
+            self._notify_step_due(now + next_step.delay_seconds)
+        return future
+    
+    def _notify_step_due(self, due_at: int):
+        """Сообщить подписчикам о новом сроке шага воронки"""
+        for listener in self.step_due_listeners:
+            listener(due_at)
+    
+    def get_next_step_due(self) -> Optional[int]:
+        """
+        Время ближайшего шага воронки (по индексу due_at)
+        
+        Returns:
+            Unix-время или None, если ни одного шага не ожидается
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT MIN(due_at) FROM user_steps')
+            return cursor.fetchone()[0]
+    
+    def claim_due_steps(self, limit: int, lease_seconds: int = config.WARMUP_CLAIM_SECONDS,
+                        now: Optional[int] = None,
+                        max_attempts: int = config.WARMUP_MAX_ATTEMPTS) -> List[Dict]:
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Атомарно забрать наступившие шаги воронки (всех этапов одним запросом)
         
-        warmup_column = f'warmup_{warmup_number}_sent'
+        Забранные пользователи переходят в состояние «отправляется»: их
+        due_at сдвигается на время аренды, поэтому следующие выборки
+        (в том числе из другого цикла или процесса) их не видят. После
+        отправки mark_step_sent назначает время следующего шага; если
+        отправка не удалась или процесс упал, шаг снова станет доступен
+        по истечении аренды. Если условие шага уже не выполняется
+        (например, пользователь оставил контакт), пользователь недоступен
+        или шаг уже забирался max_attempts раз без отправки, воронка
+        останавливается.
         
-        cursor.execute(f'''
-            SELECT user_id, username, first_name 
-            FROM users 
-            WHERE status = 'offer_sent'
-            AND contact_provided = 0 
-            AND {warmup_column} = 0
-            AND datetime(last_message_time, '+{hours} hours') <= datetime('now', 'localtime')
-        ''')
+        Args:
+            limit: Максимальное количество шагов
+            lease_seconds: Время аренды
+            now: Момент отсчёта (по умолчанию - текущее время)
+            max_attempts: Сколько раз шаг можно забрать без отметки об отправке
+            
+        Returns:
+            Список шагов (user_id, step) в порядке наступления
+        """
+        now = int(time.time()) if now is None else now
         
-        users = []
-        for row in cursor.fetchall():
-            users.append({
-                'user_id': row[0],
-                'username': row[1],
-                'first_name': row[2]
-            })
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'''
+                UPDATE user_steps
+                SET due_at = CASE WHEN attempts < ? AND EXISTS (
+                    SELECT 1 FROM users
+                    WHERE users.user_id = user_steps.user_id
+                    AND users.inactive_at IS NULL
+                    AND {FUNNEL.condition_sql('user_steps.step')}
+                ) THEN ? END,
+                attempts = attempts + 1
+                WHERE user_id IN (
+                    SELECT user_id FROM user_steps
+                    WHERE due_at <= ?
+                    ORDER BY due_at
+                    LIMIT ?
+                )
+                RETURNING user_id, step, due_at, attempts
+            ''', (max_attempts, now + lease_seconds, now, limit))
+            rows = cursor.fetchall()
         
-        conn.close()
-        return users
+        for user_id, step, due_at, attempts in rows:
+            if due_at is None and attempts > max_attempts:
+                logger.warning(
+                    f"Шаг {step} пользователю {user_id} не отправлен за {max_attempts} попыток, воронка остановлена"
+                )
+        return [{'user_id': row[0], 'step': row[1]} for row in rows if row[2] is not None]
     
-    def get_all_users(self) -> List[int]:
+    def count_due_steps(self, now: Optional[int] = None) -> int:
         """
-        Получение списка всех пользователей
+        Количество наступивших шагов воронки (всех этапов)
         
+        Args:
+            now: Момент отсчёта (по умолчанию - текущее время)
+            
         Returns:
-            Список ID всех пользователей
+            Количество наступивших шагов
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id FROM users')
-        users = [row[0] for row in cursor.fetchall()]
-        
-        conn.close()
-        return users
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT COUNT(*) FROM user_steps WHERE due_at <= ?',
+                (int(time.time()) if now is None else now,)
+            )
+            return cursor.fetchone()[0]
     
-    def get_users_without_contact(self) -> List[int]:
+    def get_audience_page(self, audience: str, after_user_id: int = 0, limit: int = PAGE_SIZE) -> List[int]:
         """
-        Получение пользователей, которые не оставили контакт
+        Страница аудитории рассылки (keyset-пагинация по user_id)
         
+        Args:
+            audience: Аудитория (all, no_contact, with_contact)
+            after_user_id: Вернуть пользователей с ID больше этого
+            limit: Размер страницы
+            
         Returns:
-            Список ID пользователей без контакта
+            Список ID пользователей по возрастанию
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'''
+                SELECT user_id FROM users
+                WHERE user_id > ? AND {AUDIENCE_FILTERS[audience]}
+                ORDER BY user_id
+                LIMIT ?
+            ''', (after_user_id, limit))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def iter_audience_pages(self, audience: str, after_user_id: int = 0,
+                            page_size: int = PAGE_SIZE) -> Iterator[List[int]]:
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Постраничный обход аудитории рассылки
         
-        cursor.execute('SELECT user_id FROM users WHERE contact_provided = 0')
-        users = [row[0] for row in cursor.fetchall()]
+        Args:
+            audience: Аудитория (all, no_contact, with_contact)
+            after_user_id: Начать с пользователей с ID больше этого
+            page_size: Размер страницы
+            
+        Yields:
+            Списки ID пользователей по возрастанию
+        """
+        while True:
+            page = self.get_audience_page(audience, after_user_id, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1]
+    
+    def count_audience(self, audience: str) -> int:
+        """
+        Размер аудитории рассылки (по счётчикам воронки, без скана users)
         
-        conn.close()
-        return users
+        Args:
+            audience: Аудитория (all, no_contact, with_contact)
+            
+        Returns:
+            Количество пользователей
+        """
+        if audience not in AUDIENCE_FILTERS:
+            raise KeyError(audience)
+        stats = self.get_funnel_stats()
+        if audience == 'all':
+            return stats['total_users'] - stats['inactive']
+        if audience == 'with_contact':
+            return stats['with_contact'] - stats['inactive_with_contact']
+        return (stats['total_users'] - stats['with_contact']) - (stats['inactive'] - stats['inactive_with_contact'])
     
-    def get_users_with_contact(self) -> List[int]:
+    def get_contact_page(self, after_user_id: int = 0, limit: int = PAGE_SIZE) -> List[Tuple[int, str]]:
         """
-        Получение пользователей, которые оставили контакт
+        Страница сохранённых контактов (keyset-пагинация по user_id)
         
+        Args:
+            after_user_id: Вернуть контакты пользователей с ID больше этого
+            limit: Размер страницы
+            
         Returns:
-            Список ID пользователей с контактом
+            Список пар (user_id, contact_phone) по возрастанию user_id
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT user_id, contact_phone FROM users
+                WHERE contact_provided = 1 AND user_id > ?
+                ORDER BY user_id
+                LIMIT ?
+            ''', (after_user_id, limit))
+            return [tuple(row) for row in cursor.fetchall()]
+    
+    def iter_contact_pages(self, page_size: int = PAGE_SIZE) -> Iterator[List[Tuple[int, str]]]:
+        """
+        Постраничный обход сохранённых контактов (по возрастанию user_id)
+        
+        Args:
+            page_size: Размер страницы
+            
+        Yields:
+            Списки пар (user_id, contact_phone)
+        """
+        after_user_id = 0
+        while True:
+            page = self.get_contact_page(after_user_id, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1][0]
+    
+    def update_contact_phones(self, phones: List[Tuple[int, str]]):
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Пакетное обновление номеров телефонов
         
-        cursor.execute('SELECT user_id FROM users WHERE contact_provided = 1')
-        users = [row[0] for row in cursor.fetchall()]
+        Args:
+            phones: Пары (user_id, новый номер)
+        """
+        with self.pool.connection() as conn:
+            conn.executemany(
+                'UPDATE users SET contact_phone = ? WHERE user_id = ?',
+                [(phone, user_id) for user_id, phone in phones]
+            )
         
-        conn.close()
-        return users
+        for user_id, phone in phones:
+            self.user_cache.update(user_id, contact_phone=phone)
     
     def get_user_count(self) -> int:
         """
@@ -259,14 +1149,7 @@ class Database:
         Returns:
             Количество пользователей в базе
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM users')
-        count = cursor.fetchone()[0]
-        
-        conn.close()
-        return count
+        return self.get_funnel_stats()['total_users']
     
     def get_contact_count(self) -> int:
         """
@@ -275,14 +1158,49 @@ class Database:
         Returns:
             Количество пользователей, оставивших контакт
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self.get_funnel_stats()['with_contact']
+    
+    def get_funnel_stats(self) -> Dict[str, int]:
+        """
+        Статистика воронки одним чтением
         
-        cursor.execute('SELECT COUNT(*) FROM users WHERE contact_provided = 1')
-        count = cursor.fetchone()[0]
+        Returns:
+            Словарь: total_users, with_contact, status_file_sent,
+            status_offer_sent, status_contact_provided, inactive, inactive_with_contact
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT total_users, with_contact, status_file_sent, status_offer_sent,
+                       status_contact_provided, inactive, inactive_with_contact
+                FROM funnel_stats WHERE id = 1
+            ''')
+            row = cursor.fetchone()
+            return dict(zip([column[0] for column in cursor.description], row))
+    
+    def get_step_stats(self) -> Dict[str, int]:
+        """
+        Сколько раз отправлен каждый шаг воронки
         
-        conn.close()
-        return count
+        Returns:
+            Словарь {ключ шага: количество} в порядке шагов воронки
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT step, sent FROM funnel_step_stats')
+            sent = dict(cursor.fetchall())
+        return {step.key: sent.get(step.key, 0) for step in FUNNEL.steps}
+    
+    def rebuild_funnel_stats(self):
+        """Пересчитать счётчики воронки по таблицам users и user_steps (если данные правили вручную)"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM funnel_stats')
+            cursor.execute('DELETE FROM funnel_step_stats')
+            self._init_funnel_stats(cursor)
     
     def get_user_info(self, user_id: int) -> Optional[Dict]:
         """
@@ -290,25 +1208,33 @@ class Database:
         
         Args:
             user_id: ID пользователя
-            
+        
         Returns:
             Словарь с информацией или None
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if user_id not in self.known_users:
+            self.negative_hits += 1
+            return None
         
-        cursor.execute('''
-            SELECT user_id, username, first_name, contact_name, contact_phone, 
-                   status, added_date, contact_provided
-            FROM users 
-            WHERE user_id = ?
-        ''', (user_id,))
+        found, user_info = self.user_cache.get(user_id)
+        if found:
+            return dict(user_info) if user_info else None
         
-        row = cursor.fetchone()
-        conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT user_id, username, first_name, contact_name, contact_phone,
+                       status, added_date, contact_provided, inactive_at
+                FROM users
+                WHERE user_id = ?
+            ''', (user_id,))
+            
+            row = cursor.fetchone()
         
+        user_info = None
         if row:
-            return {
+            user_info = {
                 'user_id': row[0],
                 'username': row[1],
                 'first_name': row[2],
@@ -316,6 +1242,727 @@ class Database:
                 'contact_phone': row[4],
                 'status': row[5],
                 'added_date': row[6],
-                'contact_provided': row[7]
+                'contact_provided': row[7],
+                'inactive_at': row[8]
+            }
+        
+        self.user_cache.put(user_id, user_info)
+        return dict(user_info) if user_info else None
+    
+    def get_cached_media(self, media_key: str) -> Optional[Dict]:
+        """
+        Получить закешированный file_id файла
+        
+        Args:
+            media_key: Ключ файла (обычно путь к нему)
+        
+        Returns:
+            Словарь с file_id, file_hash и file_mtime или None
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT file_id, file_hash, file_mtime FROM media_cache WHERE media_key = ?',
+                (media_key,)
+            )
+            
+            row = cursor.fetchone()
+        
+        if row:
+            return {
+                'file_id': row[0],
+                'file_hash': row[1],
+                'file_mtime': row[2]
             }
         return None
+    
+    def save_cached_media(self, media_key: str, file_id: str, file_hash: str, file_mtime: float):
+        """
+        Сохранить file_id загруженного файла
+        
+        Args:
+            media_key: Ключ файла (путь к нему или broadcast:<ID рассылки>)
+            file_id: file_id, который вернул Telegram
+            file_hash: SHA-256 содержимого файла (для вложения рассылки - file_unique_id)
+            file_mtime: Время изменения файла на момент загрузки (для вложения рассылки - 0)
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR REPLACE INTO media_cache (media_key, file_id, file_hash, file_mtime, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (media_key, file_id, file_hash, file_mtime, datetime.now().isoformat()))
+    
+    def delete_cached_media(self, media_key: str):
+        """
+        Сбросить кеш file_id файла
+        
+        Args:
+            media_key: Ключ файла (обычно путь к нему)
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM media_cache WHERE media_key = ?', (media_key,))
+    
+    def schedule_job(self, user_id: int, step: str, due_at: int):
+        """
+        Запланировать отложенный шаг воронки
+        
+        Повторное планирование того же шага переносит время запуска.
+        
+        Args:
+            user_id: ID пользователя
+            step: Название шага (например, offer)
+            due_at: Время запуска (unix-время, секунды)
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR REPLACE INTO scheduled_jobs (user_id, step, due_at)
+                VALUES (?, ?, ?)
+            ''', (user_id, step, due_at))
+    
+    def claim_due_jobs(self, limit: int, lease_seconds: int, now: Optional[int] = None) -> List[Dict]:
+        """
+        Атомарно забрать наступившие шаги
+        
+        Срок забранных шагов сдвигается на время аренды, поэтому следующие
+        выборки (в том числе другого экземпляра бота) их не видят. Выполненный
+        шаг удаляется delete_job; если процесс упал, шаг снова станет
+        доступен по истечении аренды.
+        
+        Args:
+            limit: Максимальное количество шагов
+            lease_seconds: Время аренды
+            now: Момент отсчёта (по умолчанию - текущее время)
+            
+        Returns:
+            Список шагов (user_id, step)
+        """
+        now = int(time.time()) if now is None else now
+        
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE scheduled_jobs SET due_at = ?
+                WHERE rowid IN (
+                    SELECT rowid FROM scheduled_jobs
+                    WHERE due_at <= ?
+                    ORDER BY due_at
+                    LIMIT ?
+                )
+                RETURNING user_id, step
+            ''', (now + lease_seconds, now, limit))
+            
+            return [{'user_id': row[0], 'step': row[1]} for row in cursor.fetchall()]
+    
+    def get_next_job_due(self) -> Optional[int]:
+        """
+        Время запуска ближайшего шага
+        
+        Returns:
+            Unix-время или None, если запланированных шагов нет
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT MIN(due_at) FROM scheduled_jobs')
+            return cursor.fetchone()[0]
+    
+    def count_scheduled_jobs(self, step: str) -> int:
+        """
+        Количество запланированных шагов
+        
+        Args:
+            step: Название шага
+            
+        Returns:
+            Сколько шагов ожидает запуска
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT COUNT(*) FROM scheduled_jobs WHERE step = ?', (step,))
+            return cursor.fetchone()[0]
+    
+    def delete_job(self, user_id: int, step: str):
+        """
+        Удалить выполненный шаг
+        
+        Args:
+            user_id: ID пользователя
+            step: Название шага
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM scheduled_jobs WHERE user_id = ? AND step = ?', (user_id, step))
+    
+    def defer_admin_notification(self, user_id: int, name: str, phone: str,
+                                 username: Optional[str]) -> concurrent.futures.Future:
+        """
+        Сохранить уведомление администратору о контакте через буфер отложенной записи
+        
+        Args:
+            user_id: ID пользователя
+            name: Имя для связи
+            phone: Номер телефона
+            username: Username пользователя
+            
+        Returns:
+            Future, который завершается после коммита записи
+        """
+        return self.writes.add(('''
+            INSERT INTO admin_notifications (user_id, name, phone, username, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, name, phone, username, int(time.time()))))
+    
+    def claim_admin_notifications(self, limit: int, owner: str, lease_seconds: int,
+                                  now: Optional[int] = None) -> List[Dict]:
+        """
+        Забрать недоставленные уведомления администратору для сводки
+        
+        Забираются свободные уведомления, уведомления с истёкшей арендой
+        (экземпляр, забравший их, упал) и уже забранные тем же owner
+        (повтор сводки, которую не удалось отправить).
+        
+        Args:
+            limit: Максимальное количество уведомлений
+            owner: Кто забирает (экземпляр бота)
+            lease_seconds: Время аренды
+            now: Момент отсчёта (по умолчанию - текущее время)
+            
+        Returns:
+            Список уведомлений в порядке поступления
+        """
+        now = int(time.time()) if now is None else now
+        
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE admin_notifications SET claimed_by = ?, claimed_until = ?
+                WHERE notification_id IN (
+                    SELECT notification_id FROM admin_notifications
+                    WHERE claimed_until IS NULL OR claimed_until <= ? OR claimed_by = ?
+                    ORDER BY notification_id
+                    LIMIT ?
+                )
+                RETURNING notification_id, user_id, name, phone, username, created_at
+            ''', (owner, now + lease_seconds, now, owner, limit))
+            
+            return sorted((
+                {
+                    'notification_id': row[0], 'user_id': row[1], 'name': row[2],
+                    'phone': row[3], 'username': row[4], 'created_at': row[5]
+                }
+                for row in cursor.fetchall()
+            ), key=lambda row: row['notification_id'])
+    
+    def count_admin_notifications(self) -> int:
+        """Количество недоставленных уведомлений администратору"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT COUNT(*) FROM admin_notifications')
+            return cursor.fetchone()[0]
+    
+    def delete_admin_notifications(self, notification_ids: List[int]):
+        """
+        Удалить доставленные уведомления
+        
+        Args:
+            notification_ids: ID уведомлений доставленной сводки
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany(
+                'DELETE FROM admin_notifications WHERE notification_id = ?',
+                [(notification_id,) for notification_id in notification_ids]
+            )
+    
+    
+    def create_broadcast(self, audience: str, description: str, message_text: str,
+                         admin_chat_id: int, total: int, source_chat_id: Optional[int] = None,
+                         source_message_id: Optional[int] = None, media_kind: Optional[str] = None,
+                         media_file_id: Optional[str] = None) -> int:
+        """
+        Создание задания рассылки
+        
+        Args:
+            audience: Аудитория (all, no_contact, with_contact)
+            description: Описание аудитории для сообщений админу
+            message_text: Текст рассылки (для копии сообщения - текст или подпись в HTML)
+            admin_chat_id: Чат администратора для отчётов о прогрессе
+            total: Количество получателей
+            source_chat_id: Чат копируемого сообщения
+            source_message_id: ID копируемого сообщения (None - рассылка текстом)
+            media_kind: Тип вложения копируемого сообщения (photo, video, document...)
+            media_file_id: file_id вложения (отправка без исходного сообщения, если его удалят)
+            
+        Returns:
+            ID рассылки
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO broadcasts (
+                    audience, description, message_text, admin_chat_id, total, created_at,
+                    source_chat_id, source_message_id, media_kind, media_file_id
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                audience, description, message_text, admin_chat_id, total, datetime.now().isoformat(),
+                source_chat_id, source_message_id, media_kind, media_file_id
+            ))
+            return cursor.lastrowid
+    
+    def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        """
+        Получить задание рассылки
+        
+        Args:
+            broadcast_id: ID рассылки
+            
+        Returns:
+            Словарь с полями таблицы broadcasts или None
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,))
+            row = cursor.fetchone()
+            if row:
+                return dict(zip([column[0] for column in cursor.description], row))
+            return None
+    
+    def get_broadcasts(self, statuses: Optional[List[str]] = None, limit: int = 10) -> List[Dict]:
+        """
+        Получить последние задания рассылки
+        
+        Args:
+            statuses: Отобрать только рассылки с этими статусами
+            limit: Максимальное количество заданий
+            
+        Returns:
+            Список заданий, новые первыми
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            if statuses:
+                placeholders = ', '.join('?' * len(statuses))
+                cursor.execute(f'''
+                    SELECT * FROM broadcasts
+                    WHERE status IN ({placeholders})
+                    ORDER BY broadcast_id DESC LIMIT ?
+                ''', (*statuses, limit))
+            else:
+                cursor.execute('SELECT * FROM broadcasts ORDER BY broadcast_id DESC LIMIT ?', (limit,))
+            
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def claim_broadcast(self, broadcast_id: int, owner: str, lease_seconds: int,
+                        now: Optional[int] = None) -> bool:
+        """
+        Арендовать идущую рассылку или продлить свою аренду
+        
+        Рассылку ведёт только арендовавший её экземпляр бота; аренда
+        продлевается после каждой пачки, поэтому рассылку упавшего
+        экземпляра подхватит другой по истечении аренды.
+        
+        Args:
+            broadcast_id: ID рассылки
+            owner: Кто арендует (экземпляр бота)
+            lease_seconds: Время аренды
+            now: Момент отсчёта (по умолчанию - текущее время)
+            
+        Returns:
+            False, если рассылка не идёт или арендована другим и аренда не истекла
+        """
+        now = int(time.time()) if now is None else now
+        
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE broadcasts SET claimed_by = ?, claimed_until = ?
+                WHERE broadcast_id = ? AND status = 'running'
+                AND (claimed_until IS NULL OR claimed_until <= ? OR claimed_by = ?)
+            ''', (owner, now + lease_seconds, broadcast_id, now, owner))
+            return cursor.rowcount == 1
+    
+    def release_broadcast(self, broadcast_id: int, owner: str):
+        """
+        Снять аренду рассылки
+        
+        Args:
+            broadcast_id: ID рассылки
+            owner: Кто арендовал; чужая аренда не снимается
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'UPDATE broadcasts SET claimed_by = NULL, claimed_until = NULL WHERE broadcast_id = ? AND claimed_by = ?',
+                (broadcast_id, owner)
+            )
+    
+    def set_broadcast_status(self, broadcast_id: int, status: str):
+        """
+        Изменение статуса рассылки
+        
+        Args:
+            broadcast_id: ID рассылки
+            status: Новый статус (running, paused, cancelled, finished)
+        """
+        finished_at = datetime.now().isoformat() if status in ('cancelled', 'finished') else None
+        
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'UPDATE broadcasts SET status = ?, finished_at = ? WHERE broadcast_id = ?',
+                (status, finished_at, broadcast_id)
+            )
+    
+    def set_broadcast_status_message(self, broadcast_id: int, message_id: int):
+        """
+        Сохранить ID сообщения админу, в котором показывается прогресс
+        
+        Args:
+            broadcast_id: ID рассылки
+            message_id: ID сообщения в чате администратора
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'UPDATE broadcasts SET status_message_id = ? WHERE broadcast_id = ?',
+                (message_id, broadcast_id)
+            )
+    
+    def record_broadcast_delivery(self, broadcast_id: int, user_id: int, delivered: bool):
+        """
+        Отметить результат отправки одному получателю
+        
+        Args:
+            broadcast_id: ID рассылки
+            user_id: ID получателя
+            delivered: True если сообщение доставлено
+        """
+        counter = 'sent' if delivered else 'failed'
+        
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, delivered)
+                VALUES (?, ?, ?)
+            ''', (broadcast_id, user_id, int(delivered)))
+            if cursor.rowcount:
+                cursor.execute(
+                    f'UPDATE broadcasts SET {counter} = {counter} + 1 WHERE broadcast_id = ?',
+                    (broadcast_id,)
+                )
+    
+    def get_broadcast_deliveries(self, broadcast_id: int) -> set:
+        """
+        Получатели после курсора, которым рассылка уже отправлена
+        
+        Args:
+            broadcast_id: ID рассылки
+            
+        Returns:
+            Множество ID пользователей
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ?', (broadcast_id,))
+            return {row[0] for row in cursor.fetchall()}
+    
+    def advance_broadcast_cursor(self, broadcast_id: int, cursor_user_id: int):
+        """
+        Сдвинуть курсор рассылки после обработки очередной пачки получателей
+        
+        Args:
+            broadcast_id: ID рассылки
+            cursor_user_id: Последний обработанный получатель
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'UPDATE broadcasts SET cursor_user_id = ? WHERE broadcast_id = ?',
+                (cursor_user_id, broadcast_id)
+            )
+            # Доставки до курсора больше не нужны - их покрывает сам курсор
+            cursor.execute(
+                'DELETE FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id <= ?',
+                (broadcast_id, cursor_user_id)
+            )
+
+
+class AsyncDatabase:
+    """
+    Асинхронный интерфейс к Database
+    
+    Все запросы выполняются в отдельном потоке БД, поэтому обработчики
+    не блокируют цикл событий. Поток забирает накопившиеся запросы пачкой
+    и выполняет их в одной транзакции - один коммит на пачку.
+    
+    Статусы и отметки об отправленных шагах воронки идут через буфер отложенной записи:
+    поток БД сбрасывает его по размеру или по времени, а корутина
+    возвращается только после коммита своей записи.
+    
+    Методы повторяют методы Database, но возвращают корутины:
+        user_info = await db.get_user_info(user_id)
+    
+    Если передан не объект Database, а функция, создающая его, база
+    открывается в потоке БД при первом запросе: объект можно создать
+    при импорте модуля, не трогая файл базы.
+    """
+    
+    def __init__(self, database: Union[Database, Callable[[], Database]] = Database, max_batch_size: int = 64):
+        """
+        Args:
+            database: Синхронная база данных или функция, которая её создаёт
+            max_batch_size: Максимальное количество запросов в одной транзакции
+        """
+        if isinstance(database, Database):
+            self._database = database
+            self._factory = None
+            self._step_due_listeners = database.step_due_listeners
+        else:
+            self._database = None
+            self._factory = database
+            self._step_due_listeners = []
+        self._database_lock = threading.Lock()
+        self.max_batch_size = max_batch_size
+        self._requests = queue.SimpleQueue()
+        self._thread = None
+        self._methods = {}
+    
+    @property
+    def database(self) -> Database:
+        """Синхронная база данных (создаётся при первом обращении)"""
+        if self._database is None:
+            with self._database_lock:
+                if self._database is None:
+                    database = self._factory()
+                    database.step_due_listeners = self._step_due_listeners
+                    self._database = database
+        return self._database
+    
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attribute = getattr(Database, name, None)
+        if not callable(attribute):
+            return getattr(self.database, name)
+        
+        if name not in self._methods:
+            method = self._method(name)
+            
+            async def call(*args, **kwargs):
+                return await self.run(method, *args, **kwargs)
+            
+            call.__name__ = name
+            call.__doc__ = attribute.__doc__
+            self._methods[name] = call
+        return self._methods[name]
+    
+    def _method(self, name: str) -> Callable:
+        """Метод Database для потока БД (сама база ищется при вызове, а не сейчас)"""
+        def method(*args, **kwargs):
+            return getattr(self.database, name)(*args, **kwargs)
+        
+        method.__name__ = name
+        return method
+    
+    def start(self):
+        """Запустить поток БД (вызывается автоматически при первом запросе)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, name='database', daemon=True)
+            self._thread.start()
+    
+    def queue_depth(self) -> int:
+        """Сколько запросов ждут потока БД"""
+        return self._requests.qsize()
+    
+    def pending_writes(self) -> int:
+        """Сколько отложенных записей ждут сброса"""
+        return self._database.writes.pending() if self._database is not None else 0
+    
+    async def run(self, func, *args, **kwargs):
+        """
+        Выполнить функцию в потоке БД
+        
+        Args:
+            func: Функция, работающая с базой данных
+            
+        Returns:
+            Результат функции (после коммита транзакции)
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._requests.put((loop, future, func, args, kwargs, time.perf_counter()))
+        return await future
+    
+    async def write(self, defer, *args, **kwargs):
+        """
+        Отложенная запись через буфер потока БД
+        
+        Args:
+            defer: Метод Database, который добавляет запись в буфер и возвращает future
+            
+        Returns:
+            None после коммита группы, в которую попала запись
+        """
+        durable = await self.run(defer, *args, **kwargs)
+        await asyncio.wrap_future(durable)
+    
+    async def update_user_status(self, user_id: int, status: str, update_time: bool = True):
+        """Асинхронный вариант Database.update_user_status (через буфер отложенной записи)"""
+        await self.write(self._method('defer_user_status'), user_id, status, update_time)
+    
+    async def mark_step_sent(self, user_id: int, step: str):
+        """Асинхронный вариант Database.mark_step_sent (через буфер отложенной записи)"""
+        await self.write(self._method('defer_step_sent'), user_id, step)
+    
+    async def add_admin_notification(self, user_id: int, name: str, phone: str, username: Optional[str]):
+        """Асинхронный вариант Database.defer_admin_notification (возвращается после коммита)"""
+        await self.write(self._method('defer_admin_notification'), user_id, name, phone, username)
+    
+    def watch_step_due(self, callback: Callable[[int], None]):
+        """
+        Подписаться на новые сроки шагов воронки
+        
+        Запись идёт в потоке БД, поэтому callback вызывается в цикле событий,
+        из которого сделана подписка.
+        
+        Args:
+            callback: Функция, принимающая Unix-время нового срока
+        """
+        loop = asyncio.get_running_loop()
+        self._step_due_listeners.append(
+            lambda due_at: loop.call_soon_threadsafe(callback, due_at)
+        )
+    
+    async def iter_audience_pages(self, audience: str, after_user_id: int = 0, page_size: int = PAGE_SIZE):
+        """Асинхронный вариант Database.iter_audience_pages"""
+        while True:
+            page = await self.run(self._method('get_audience_page'), audience, after_user_id, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1]
+    
+    async def iter_contact_pages(self, page_size: int = PAGE_SIZE):
+        """Асинхронный вариант Database.iter_contact_pages"""
+        after_user_id = 0
+        while True:
+            page = await self.run(self._method('get_contact_page'), after_user_id, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1][0]
+    
+    async def close(self):
+        """Дождаться выполнения запросов, остановить поток и закрыть соединения"""
+        if self._thread is not None:
+            self._requests.put(None)
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+        if self._database is not None:
+            self._database.close()
+    
+    def _worker(self):
+        """Цикл потока БД: собирает запросы в пачки, выполняет их и сбрасывает буфер записи"""
+        while True:
+            # Пока база не открыта (первый запрос ещё не выполнен), сбрасывать нечего
+            writes = self._database.writes if self._database is not None else None
+            try:
+                request = self._requests.get(timeout=writes.time_until_flush() if writes else None)
+            except queue.Empty:
+                # Запросов нет, а старейшая отложенная запись ждёт уже max_delay
+                self._flush_writes()
+                continue
+            if request is None:
+                self._flush_writes()
+                return
+            
+            batch = [request]
+            stop = False
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            
+            self._execute(batch)
+            writes = self._database.writes if self._database is not None else None
+            if stop or (writes is not None and writes.should_flush()):
+                self._flush_writes()
+            if stop:
+                return
+    
+    def _flush_writes(self):
+        """Сбросить буфер записи (ошибка уже передана ожидающим через их future)"""
+        if self._database is None:
+            return
+        try:
+            self.database.flush_writes()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить отложенные записи: {e}")
+    
+    def _execute(self, batch: list):
+        """Выполнить пачку запросов в одной транзакции и вернуть результаты"""
+        results = []
+        metrics.DB_BATCH_SIZE.observe(len(batch))
+        try:
+            with self.database.transaction():
+                for _, _, func, args, kwargs, queued_at in batch:
+                    started = time.perf_counter()
+                    metrics.DB_WAIT_SECONDS.observe(started - queued_at)
+                    try:
+                        results.append((True, func(*args, **kwargs)))
+                    except Exception as e:
+                        results.append((False, e))
+                    metrics.DB_SECONDS.observe(time.perf_counter() - started, func.__name__)
+        except Exception as e:
+            # База не открылась или коммит не удался - ни один запрос пачки не сохранён
+            results = [(False, e)] * len(batch)
+        
+        for (loop, future, *_), (ok, value) in zip(batch, results):
+            try:
+                loop.call_soon_threadsafe(_resolve_future, future, ok, value)
+            except RuntimeError:
+                # Цикл событий уже закрыт - результат никто не ждёт
+                pass
+
+
+def _resolve_future(future: asyncio.Future, ok: bool, value):
+    """Передать результат запроса ожидающей корутине"""
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
@@ -0,0 +1,125 @@
+"""
+Шаги воронки догрева, заданные данными
+
+Список шагов берётся из config_timing.FUNNEL_STEPS. Прогресс пользователя
+хранится в таблице user_steps одной строкой: ключ следующего шага и время,
+когда он наступает. Поэтому все наступившие шаги всех этапов выбираются
+одним запросом по индексу due_at - неважно, два шага в воронке или двадцать.
+"""
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+import config_timing
+import messages
+
+# Условия отправки шага (проверяются по строке users в момент отправки)
+CONDITIONS = {
+    'all': '1 = 1',
+    'no_contact': 'contact_provided = 0',
+    'with_contact': 'contact_provided = 1',
+}
+
+# Те же условия для хранилищ без SQL (по словарю с полями пользователя)
+CONDITION_CHECKS = {
+    'all': lambda user: True,
+    'no_contact': lambda user: not user['contact_provided'],
+    'with_contact': lambda user: bool(user['contact_provided']),
+}
+
+# Ключ шага хранится в базе и подставляется в SQL
+_KEY_RE = re.compile(r'^[a-z][a-z0-9_]*$')
+
+
+@dataclass(frozen=True)
+class FunnelStep:
+    """Один шаг воронки"""
+    key: str                # хранится в user_steps, не переименовывать у работающего бота
+    title: str              # название для /stats и логов
+    message: str            # имя текста в messages.py
+    delay_seconds: int      # задержка от предыдущего сообщения бота
+    condition: str = 'no_contact'
+    
+    @property
+    def text(self) -> str:
+        """Текст сообщения шага"""
+        return getattr(messages, self.message)
+
+
+class Funnel:
+    """Упорядоченный набор шагов и SQL-выражения, построенные по нему"""
+    
+    def __init__(self, steps: Iterable[FunnelStep]):
+        """
+        Args:
+            steps: Шаги в порядке отправки
+        
+        Raises:
+            ValueError: если шаги описаны некорректно
+        """
+        self.steps = tuple(steps)
+        if not self.steps:
+            raise ValueError("В воронке должен быть хотя бы один шаг")
+        
+        self._positions = {}
+        for position, step in enumerate(self.steps):
+            if not _KEY_RE.match(step.key):
+                raise ValueError(f"Некорректный ключ шага: {step.key!r}")
+            if step.key in self._positions:
+                raise ValueError(f"Повторяющийся ключ шага: {step.key}")
+            if not isinstance(getattr(messages, step.message, None), str):
+                raise ValueError(f"Шаг {step.key}: нет текста messages.{step.message}")
+            if step.condition not in CONDITIONS:
+                raise ValueError(f"Шаг {step.key}: неизвестное условие {step.condition!r}")
+            if step.delay_seconds < 0:
+                raise ValueError(f"Шаг {step.key}: отрицательная задержка")
+            self._positions[step.key] = position
+    
+    @property
+    def first(self) -> FunnelStep:
+        """Первый шаг"""
+        return self.steps[0]
+    
+    def get(self, key: str) -> Optional[FunnelStep]:
+        """Шаг по ключу (None - такого шага в воронке больше нет)"""
+        position = self._positions.get(key)
+        return None if position is None else self.steps[position]
+    
+    def next_step(self, key: str) -> Optional[FunnelStep]:
+        """Шаг после указанного (None - воронка пройдена)"""
+        position = self._positions.get(key)
+        if position is None or position + 1 == len(self.steps):
+            return None
+        return self.steps[position + 1]
+    
+    def delay_sql(self, column: str) -> str:
+        """CASE: задержка шага из колонки column (NULL для неизвестного шага)"""
+        whens = ' '.join(f"WHEN '{step.key}' THEN {step.delay_seconds}" for step in self.steps)
+        return f'CASE {column} {whens} END'
+    
+    def condition_sql(self, column: str, otherwise: str = '0') -> str:
+        """CASE: условие шага из колонки column по строке users (otherwise для неизвестного шага)"""
+        whens = ' '.join(f"WHEN '{step.key}' THEN ({CONDITIONS[step.condition]})" for step in self.steps)
+        return f'CASE {column} {whens} ELSE {otherwise} END'
+    
+    def condition_matches(self, key: str, user: Dict) -> bool:
+        """Выполняется ли условие шага key для пользователя (False для неизвестного шага)"""
+        step = self.get(key)
+        return step is not None and CONDITION_CHECKS[step.condition](user)
+    
+    def position_sql(self, column: str) -> str:
+        """CASE: номер шага из колонки column (NULL - воронка пройдена, её длина)"""
+        whens = ' '.join(f"WHEN '{step.key}' THEN {position}" for position, step in enumerate(self.steps))
+        return f'CASE {column} {whens} ELSE {len(self.steps)} END'
+
+
+FUNNEL = Funnel(
+    FunnelStep(
+        key=step['key'],
+        title=step['title'],
+        message=step['message'],
+        delay_seconds=int(step['delay_hours'] * 3600),
+        condition=step.get('condition', 'no_contact'),
+    )
+    for step in config_timing.FUNNEL_STEPS
+)
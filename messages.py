@@ -59,3 +59,8 @@ Telegram ID: {user_id}
 Username: @{username}
 Дата: {date}"""
 
+# Сводка, когда за окно пришло несколько контактов
+ADMIN_DIGEST_HEADER = "🧠 Новые запросы на консультацию психолога: {count}"
+ADMIN_DIGEST_LINE = "• {name}, {phone}, @{username} (ID {user_id}), {date}"
+ADMIN_DIGEST_OVERFLOW = "…и ещё {count} - в приложенном файле"
+
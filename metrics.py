@@ -0,0 +1,323 @@
+"""
+Метрики горячих путей бота в текстовом формате Prometheus
+
+Гистограммы и счётчики обновляются из обработчиков, потока БД и запросов
+к Bot API; встроенный HTTP-сервер отдаёт их по адресу /metrics.
+"""
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    """Метки в формате {name="value",...}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Гистограмма с метками (потокобезопасная)"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, *label_values: str):
+        """Учесть одно наблюдение"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Счётчики по корзинам (последняя - +Inf), сумма
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        
+        lines = []
+        for label_values, counts, total in sorted(snapshot):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Counter:
+    """Счётчик с метками (потокобезопасный)"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in snapshot]
+
+
+class Gauge:
+    """
+    Значение, которое вычисляется в момент запроса метрик (функция или корутина)
+    
+    Для гауга с метками функция возвращает словарь {значение метки: значение}.
+    """
+    
+    kind = 'gauge'
+    
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Union[float, Awaitable[float]]],
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.labels = tuple(labels)
+    
+    async def samples(self) -> Optional[List[str]]:
+        try:
+            value = self.collect()
+            if inspect.isawaitable(value):
+                value = await value
+        except Exception as e:
+            logger.warning(f"Не удалось получить метрику {self.name}: {e}")
+            return None
+        
+        if not self.labels:
+            return [f'{self.name} {_format_value(value)}']
+        return [
+            f'{self.name}{_format_labels(self.labels, (key,))} {_format_value(sample)}'
+            for key, sample in sorted(value.items())
+        ]
+
+
+class Registry:
+    """Набор метрик процесса"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+    
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+    
+    def gauge(self, name: str, documentation: str,
+              collect: Callable[[], Union[float, Awaitable[float]]], labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, collect, labels))
+    
+    async def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            if isinstance(metric, Gauge):
+                samples = await metric.samples()
+                if samples is None:
+                    continue
+            else:
+                samples = metric.render()
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_seconds', 'Время обработки обновления обработчиком', ['handler']
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках', ['handler', 'error']
+)
+DB_SECONDS = REGISTRY.histogram(
+    'bot_db_call_seconds', 'Время выполнения метода Database в потоке БД', ['method']
+)
+DB_WAIT_SECONDS = REGISTRY.histogram(
+    'bot_db_queue_wait_seconds', 'Ожидание запроса в очереди потока БД'
+)
+DB_BATCH_SIZE = REGISTRY.histogram(
+    'bot_db_batch_size', 'Запросов в одной транзакции потока БД',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+DB_FLUSH_SECONDS = REGISTRY.histogram(
+    'bot_db_flush_seconds', 'Время сброса буфера отложенной записи (executemany и коммит с fsync)'
+)
+DB_FLUSH_SIZE = REGISTRY.histogram(
+    'bot_db_flush_size', 'Записей в одном сбросе буфера отложенной записи',
+    buckets=(1, 4, 16, 64, 256, 1024, 4096)
+)
+DB_WRITE_DELAY_SECONDS = REGISTRY.histogram(
+    'bot_db_write_delay_seconds', 'Время от постановки записи в буфер до её коммита'
+)
+INBOUND_THROTTLED = REGISTRY.counter(
+    'bot_inbound_throttled_total', 'Входящие обновления, отброшенные защитой от флуда'
+)
+API_SECONDS = REGISTRY.histogram(
+    'bot_api_request_seconds', 'Время запроса к Bot API', ['method']
+)
+API_ERRORS = REGISTRY.counter(
+    'bot_api_errors_total', 'Ошибки запросов к Bot API по классу ошибки', ['method', 'error']
+)
+FUNNEL_WAVE_SECONDS = REGISTRY.histogram(
+    'bot_funnel_wave_seconds', 'Длительность волны догрева (все наступившие шаги воронки)',
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+)
+FUNNEL_MESSAGES = REGISTRY.counter(
+    'bot_funnel_messages_total', 'Шаги воронки по результату отправки', ['step', 'result']
+)
+OUTBOUND_UNREACHABLE = REGISTRY.counter(
+    'bot_outbound_unreachable_total', 'Отправки в недоступные чаты по причине', ['reason']
+)
+OUTBOUND_WAIT_SECONDS = REGISTRY.histogram(
+    'bot_outbound_wait_seconds', 'Ожидание исходящего запроса в очереди своего приоритета', ['priority']
+)
+
+
+def timed_handler(handler):
+    """Декоратор обработчика: время выполнения и исключения по имени функции"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который замеряет каждый запрос к Bot API"""
+    
+    def __init__(self, connection_pool_size: int, pool_timeout: float, timeout: float):
+        """
+        Размер пула задаётся явно: в python-telegram-bot до 22.4 по умолчанию
+        одно соединение, и все отправки бота выстраиваются к нему в очередь.
+        
+        Args:
+            connection_pool_size: Максимум одновременных соединений с Bot API
+            pool_timeout: Сколько секунд ждать свободного соединения
+            timeout: Таймаут подключения, чтения и записи (секунды)
+        """
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            pool_timeout=pool_timeout,
+            connect_timeout=timeout,
+            read_timeout=timeout,
+            write_timeout=timeout,
+        )
+    
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, method)
+
+
+class MetricsServer:
+    """Минимальный HTTP-сервер, отдающий GET /metrics"""
+    
+    def __init__(self, registry: Registry, host: str, port: int):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+    
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                body = (await self.registry.render()).encode()
+                status = b'200 OK'
+            else:
+                body = b'Not Found\n'
+                status = b'404 Not Found'
+            
+            writer.write(
+                b'HTTP/1.1 ' + status + b'\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
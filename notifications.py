@@ -0,0 +1,224 @@
+"""
+Сводки уведомлений администратору о новых контактах
+
+Каждый контакт сначала сохраняется в таблицу admin_notifications и удаляется
+только после доставки, поэтому ни сбой отправки, ни перезапуск бота не теряют
+заявки. Отправляет одна корутина, не чаще одной сводки за ADMIN_DIGEST_WINDOW:
+первый контакт после затишья уходит сразу, следующие копятся до конца окна.
+В сводке до ADMIN_DIGEST_SIZE контактов строками, при большем числе все
+контакты уходят CSV-файлом. Во время всплеска чат администратора получает
+одну сводку за окно вместо сотни отдельных сообщений и не упирается в лимит
+Telegram на один чат.
+
+Экземпляры бота с общей базой забирают контакты в сводку с арендой, поэтому
+один контакт не уйдёт администратору дважды; контакты экземпляра, упавшего
+до отправки сводки, заберёт другой по истечении аренды.
+"""
+import asyncio
+import csv
+import io
+import logging
+import secrets
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import config
+import config_timing
+import messages
+from outbound import PRIORITY_FUNNEL
+from scheduler import DeadlineTimer
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повтором, если сводку не удалось доставить (секунды)
+RETRY_DELAY = 60.0
+
+# Больше стольких контактов в одну сводку не берём (остальные уйдут следующей)
+MAX_DIGEST_ROWS = 5000
+
+# Аренда контактов, забранных в сводку (секунды)
+CLAIM_SECONDS = 300
+
+# Лимиты Telegram на длину текста сообщения и подписи к файлу
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+
+def _format_date(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M')
+
+
+def _fields(row: Dict) -> Dict:
+    """Поля уведомления для подстановки в шаблоны messages.py"""
+    return {
+        'name': row['name'],
+        'phone': row['phone'],
+        'user_id': row['user_id'],
+        'username': row['username'] or 'не указан',
+        'date': _format_date(row['created_at']),
+    }
+
+
+def format_digest(rows: List[Dict], max_lines: int, limit: int) -> Tuple[str, int]:
+    """
+    Текст сводки: заголовок и строки контактов, пока помещаются
+    
+    Args:
+        rows: Уведомления
+        max_lines: Сколько контактов выводить строками
+        limit: Максимальная длина текста
+    
+    Returns:
+        (текст, сколько контактов в нём выведено); не поместившиеся указаны числом
+    """
+    header = messages.ADMIN_DIGEST_HEADER.format(count=len(rows)) + '\n'
+    lines = []
+    length = len(header)
+    for row in rows[:max_lines]:
+        line = '\n' + messages.ADMIN_DIGEST_LINE.format(**_fields(row))
+        # Оставляем место под строку о приложенном файле
+        if length + len(line) > limit - 64:
+            break
+        lines.append(line)
+        length += len(line)
+    
+    text = header + ''.join(lines)
+    if len(lines) < len(rows):
+        text += '\n\n' + messages.ADMIN_DIGEST_OVERFLOW.format(count=len(rows) - len(lines))
+    return text, len(lines)
+
+
+def digest_csv(rows: List[Dict]) -> bytes:
+    """Все контакты сводки в CSV (UTF-8 с BOM, чтобы Excel открыл кириллицу)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['date', 'user_id', 'username', 'name', 'phone'])
+    for row in rows:
+        writer.writerow([
+            _format_date(row['created_at']), row['user_id'], row['username'] or '', row['name'], row['phone']
+        ])
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+class AdminNotifier:
+    """Сводки контактов для администратора с хранением до доставки"""
+    
+    def __init__(self, db, admin_chat_id: int = config.ADMIN_ID,
+                 window: float = config.ADMIN_DIGEST_WINDOW, size: int = config.ADMIN_DIGEST_SIZE,
+                 max_sleep: float = config_timing.CHECK_INTERVAL_SECONDS):
+        """
+        Args:
+            db: Хранилище (storage.Storage)
+            admin_chat_id: Чат администратора (0 - уведомления отключены)
+            window: Минимальный интервал между сводками (секунды)
+            size: Сколько контактов выводить в сводке строками (больше - CSV-файлом)
+            max_sleep: Страховочная проверка, даже если ждать нечего
+        """
+        self.db = db
+        self.admin_chat_id = admin_chat_id
+        self.window = window
+        self.size = size
+        # Владелец аренды контактов - этот экземпляр бота
+        self.owner = secrets.token_hex(8)
+        self._pending = 0
+        self._sent_at = 0.0
+        self._retry_at = 0.0
+        self._timer = DeadlineTimer(max_sleep)
+        self._task: Optional[asyncio.Task] = None
+    
+    async def notify(self, user_id: int, name: str, phone: str, username: Optional[str]):
+        """
+        Сохранить контакт для сводки (возвращается после коммита в базу)
+        
+        Args:
+            user_id: ID пользователя
+            name: Имя для связи
+            phone: Номер телефона
+            username: Username пользователя
+        """
+        if not self.admin_chat_id:
+            return
+        await self.db.add_admin_notification(user_id, name, phone, username)
+        self._pending += 1
+        self._timer.notify(self._next_digest_at())
+    
+    def pending(self) -> int:
+        """Сколько контактов ждут отправки администратору"""
+        return self._pending
+    
+    async def start(self, bot):
+        """Запустить отправку сводок (недоставленные до перезапуска уйдут первой сводкой)"""
+        if not self.admin_chat_id or self._task is not None:
+            return
+        self._pending = await self.db.count_admin_notifications()
+        self._task = asyncio.create_task(self._run(bot))
+    
+    async def stop(self):
+        """Остановить отправку (недоставленные контакты остаются в базе)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def _next_digest_at(self) -> Optional[float]:
+        """Когда отправлять следующую сводку (None - отправлять нечего)"""
+        if not self._pending:
+            return None
+        return max(self._sent_at + self.window, self._retry_at)
+    
+    async def _run(self, bot):
+        """Основной цикл: отправить сводку, когда подошёл срок, и уснуть до следующего"""
+        while True:
+            self._timer.reset()
+            due = self._next_digest_at()
+            if due is not None and due <= time.time():
+                try:
+                    await self._send_digest(bot)
+                except Exception as e:
+                    logger.error(f"Не удалось отправить сводку контактов администратору: {e}")
+                    self._retry_at = time.time() + RETRY_DELAY
+                continue
+            await self._timer.sleep_until(due)
+            if not self._pending:
+                # Контакты, сохранённые другими экземплярами или оставшиеся от упавшего
+                try:
+                    self._pending = await self.db.count_admin_notifications()
+                except Exception as e:
+                    logger.error(f"Не удалось проверить контакты для сводки: {e}")
+    
+    async def _send_digest(self, bot):
+        """Отправить накопившиеся контакты одним сообщением или файлом и удалить их из базы"""
+        rows = await self.db.claim_admin_notifications(MAX_DIGEST_ROWS, self.owner, CLAIM_SECONDS)
+        if not rows:
+            self._pending = 0
+            return
+        
+        if len(rows) == 1:
+            await bot.send_message(
+                chat_id=self.admin_chat_id,
+                text=messages.ADMIN_NOTIFICATION.format(**_fields(rows[0])),
+                rate_limit_args=PRIORITY_FUNNEL
+            )
+        else:
+            text, shown = format_digest(rows, self.size, MESSAGE_LIMIT)
+            if shown == len(rows):
+                await bot.send_message(chat_id=self.admin_chat_id, text=text, rate_limit_args=PRIORITY_FUNNEL)
+            else:
+                # Одно вложение вместо нескольких сообщений: сводка доставляется целиком или не доставляется
+                await bot.send_document(
+                    chat_id=self.admin_chat_id,
+                    document=digest_csv(rows),
+                    filename=f"leads_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                    caption=format_digest(rows, self.size, CAPTION_LIMIT)[0],
+                    rate_limit_args=PRIORITY_FUNNEL
+                )
+        
+        await self.db.delete_admin_notifications([row['notification_id'] for row in rows])
+        self._pending = max(self._pending - len(rows), 0)
+        self._sent_at = time.time()
+        self._retry_at = 0.0
+        logger.info(f"Администратору отправлена сводка: контактов {len(rows)}")
@@ -0,0 +1,300 @@
+"""
+Единый диспетчер исходящих сообщений с приоритетами
+
+Все запросы бота к Bot API проходят через OutboundDispatcher (rate limiter
+python-telegram-bot), поэтому ответы пользователям, шаги воронки и рассылки
+делят один лимит скорости. Ожидающие запросы обслуживаются по приоритету:
+большая рассылка не задерживает ответ тому, кто только что ввёл кодовое слово.
+
+Приоритет передаётся через rate_limit_args:
+    await bot.send_message(chat_id, text, rate_limit_args=PRIORITY_FUNNEL)
+Запросы без rate_limit_args (например, reply_text в обработчиках) - интерактивные.
+
+Лимиты Telegram Bot API: около 30 сообщений в секунду на бота суммарно
+и не чаще одного сообщения в секунду в один чат.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета (меньше - важнее)
+PRIORITY_INTERACTIVE = 0    # ответы на сообщения пользователя
+PRIORITY_FUNNEL = 1         # предложение, догревы, уведомления администратору
+PRIORITY_BROADCAST = 2      # рассылки
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_FUNNEL: 'funnel',
+    PRIORITY_BROADCAST: 'broadcast',
+}
+
+# Минимальный интервал между сообщениями в один чат (секунды).
+# Интерактивные ответы от него освобождены: приветствие и PDF уходят сразу.
+PER_CHAT_INTERVAL = 1.0
+
+# Методы Bot API, которые расходуют лимит (остальные проходят без очереди)
+LIMITED_PREFIXES = ('send', 'copy', 'forward', 'edit')
+
+# Сколько ожидающих запросов одного класса просматривать в поисках свободного чата
+SCAN_LIMIT = 32
+
+# Предохранитель: после стольких сетевых ошибок подряд отправка приостанавливается
+FAILURE_THRESHOLD = 5
+COOLDOWN_SECONDS = 30.0
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза из RetryAfter в секундах (в разных версиях PTB это int или timedelta)"""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+def unreachable_reason(error: TelegramError) -> Optional[str]:
+    """
+    Причина, по которой чат недоступен насовсем
+    
+    Returns:
+        blocked, deactivated или chat_not_found; None, если ошибка временная
+        или относится к самому запросу
+    """
+    message = error.message.lower()
+    if isinstance(error, Forbidden):
+        return 'deactivated' if 'deactivated' in message else 'blocked'
+    if isinstance(error, BadRequest) and 'chat not found' in message:
+        return 'chat_not_found'
+    return None
+
+
+class TokenBucket:
+    """Асинхронный ограничитель скорости по алгоритму token bucket"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate: Количество токенов в секунду
+            capacity: Размер «ведра» (допустимый всплеск), по умолчанию равен rate
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Дождаться токена (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def pause(self, seconds: float):
+        """Приостановить выдачу токенов (например, после RetryAfter)"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class OutboundDispatcher(BaseRateLimiter[int]):
+    """Приоритетная очередь исходящих запросов с общим лимитом и повторами"""
+    
+    def __init__(self, rate: float = config.OUTBOUND_RATE_PER_SECOND,
+                 per_chat_interval: float = PER_CHAT_INTERVAL, max_retries: int = 3,
+                 on_unreachable: Optional[Callable[[int, str], Awaitable[None]]] = None):
+        """
+        Args:
+            rate: Общий лимит сообщений в секунду на бота
+            per_chat_interval: Минимальный интервал между сообщениями в один чат
+            max_retries: Сколько раз повторять запрос после RetryAfter и сетевых ошибок
+            on_unreachable: Корутина (chat_id, причина), которая вызывается, когда
+                чат оказался недоступен насовсем (бот заблокирован, аккаунт удалён)
+        """
+        self.bucket = TokenBucket(rate)
+        self.on_unreachable = on_unreachable
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._queues = {priority: deque() for priority in sorted(PRIORITY_NAMES)}
+        self._last_sent: Dict[Any, float] = {}
+        self._failures = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    def queue_depth(self, priority: Optional[int] = None) -> int:
+        """Сколько запросов ждут отправки (всего или в одном классе)"""
+        if priority is not None:
+            return len(self._queues[priority])
+        return sum(len(waiters) for waiters in self._queues.values())
+    
+    async def initialize(self):
+        """Запустить цикл выдачи разрешений (вызывается при инициализации приложения)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def shutdown(self):
+        """Остановить цикл; ожидающие запросы отменяются"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for waiters in self._queues.values():
+            for _, _, future in waiters:
+                future.cancel()
+            waiters.clear()
+    
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any,
+                              kwargs: Dict[str, Any], endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: Optional[int]):
+        """Выполнить запрос к Bot API в своей очереди с общей политикой повторов"""
+        if not endpoint.startswith(LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+        
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        attempt = 0
+        while True:
+            await self._acquire(priority, chat_id)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                # Flood control действует на весь бот - притормаживаем все классы
+                delay = retry_after_seconds(e)
+                logger.warning(f"RetryAfter {delay} сек ({endpoint}), отправка приостановлена")
+                self.bucket.pause(delay)
+                if attempt >= self.max_retries:
+                    raise
+            except (BadRequest, Forbidden) as e:
+                # Ошибка в самом запросе или чат недоступен - повтор не поможет
+                reason = unreachable_reason(e)
+                if reason is not None:
+                    await self._report_unreachable(chat_id, reason)
+                raise
+            except NetworkError:
+                # TimedOut и сетевые ошибки - повтор с экспоненциальной паузой
+                self._record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+            else:
+                self._failures = 0
+                return result
+            attempt += 1
+    
+    async def _report_unreachable(self, chat_id, reason: str):
+        """Сообщить о недоступном чате (ошибка обработчика не мешает исходной ошибке)"""
+        metrics.OUTBOUND_UNREACHABLE.inc(reason)
+        if self.on_unreachable is None or not isinstance(chat_id, int):
+            return
+        try:
+            await self.on_unreachable(chat_id, reason)
+        except Exception as e:
+            logger.error(f"Не удалось отметить чат {chat_id} недоступным: {e}")
+    
+    def _record_failure(self):
+        """Предохранитель: серия сетевых ошибок останавливает отправку на время"""
+        self._failures += 1
+        if self._failures >= FAILURE_THRESHOLD:
+            logger.warning(
+                f"{self._failures} сетевых ошибок подряд, отправка приостановлена на {COOLDOWN_SECONDS:.0f} сек"
+            )
+            self.bucket.pause(COOLDOWN_SECONDS)
+            self._failures = 0
+    
+    async def _acquire(self, priority: int, chat_id):
+        """Встать в очередь своего класса и дождаться разрешения на отправку"""
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append((chat_id, time.monotonic(), future))
+        self._wakeup.set()
+        await future
+    
+    async def _run(self):
+        """Выдача разрешений: токен общего лимита получает самый приоритетный готовый запрос"""
+        have_token = False
+        while True:
+            self._wakeup.clear()
+            if not have_token and self.queue_depth():
+                await self.bucket.acquire()
+                have_token = True
+            
+            # Пока ждали токен, мог прийти более важный запрос - выбираем после получения
+            wait = self._grant() if have_token else None
+            if wait == 0:
+                have_token = False
+                continue
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _grant(self) -> Optional[float]:
+        """
+        Отдать разрешение первому готовому запросу по приоритету
+        
+        Returns:
+            0, если разрешение выдано; иначе через сколько секунд освободится
+            ближайший чат (None - ждать нечего)
+        """
+        now = time.monotonic()
+        wait = None
+        for priority, waiters in self._queues.items():
+            # Запросы в чат, которому ещё рано писать, пропускаем - очередь
+            # из сообщений в один чат не должна задерживать остальные чаты
+            blocked = set()
+            index = 0
+            while index < len(waiters) and len(blocked) < SCAN_LIMIT:
+                chat_id, queued_at, future = waiters[index]
+                if future.done():
+                    # Запрос отменён, пока ждал
+                    del waiters[index]
+                    continue
+                if chat_id in blocked:
+                    index += 1
+                    continue
+                
+                ready_at = self._last_sent.get(chat_id, 0.0) + self.per_chat_interval
+                if priority == PRIORITY_INTERACTIVE or ready_at <= now:
+                    del waiters[index]
+                    self._mark_sent(chat_id, now)
+                    metrics.OUTBOUND_WAIT_SECONDS.observe(now - queued_at, PRIORITY_NAMES[priority])
+                    future.set_result(None)
+                    return 0
+                
+                blocked.add(chat_id)
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                index += 1
+        return wait
+    
+    def _mark_sent(self, chat_id, now: float):
+        """Запомнить время отправки в чат (старые записи периодически удаляются)"""
+        if chat_id is None:
+            return
+        if len(self._last_sent) > 10000:
+            self._last_sent = {
+                chat: sent_at for chat, sent_at in self._last_sent.items()
+                if now - sent_at < self.per_chat_interval
+            }
+        self._last_sent[chat_id] = now
@@ -0,0 +1,193 @@
+"""
+Извлечение имени и телефона из сообщений и приведение номеров к E.164
+
+Номер ищется одним заранее скомпилированным выражением за один проход
+по тексту, а длина проверяется по таблице телефонных кодов стран.
+
+Перепроверка сохранённых номеров: python phone.py [--apply]
+"""
+import re
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Код страны -> допустимая длина национального номера (без кода)
+COUNTRY_PREFIXES = {
+    '1': (10, 10),      # США, Канада
+    '7': (10, 10),      # Россия, Казахстан
+    '20': (10, 10),     # Египет
+    '33': (9, 9),       # Франция
+    '34': (9, 9),       # Испания
+    '39': (9, 11),      # Италия
+    '44': (10, 10),     # Великобритания
+    '48': (9, 9),       # Польша
+    '49': (7, 11),      # Германия
+    '90': (10, 10),     # Турция
+    '371': (8, 8),      # Латвия
+    '370': (8, 8),      # Литва
+    '372': (7, 8),      # Эстония
+    '373': (8, 8),      # Молдова
+    '374': (8, 8),      # Армения
+    '375': (9, 9),      # Беларусь
+    '380': (9, 9),      # Украина
+    '971': (9, 9),      # ОАЭ
+    '972': (9, 9),      # Израиль
+    '992': (9, 9),      # Таджикистан
+    '993': (8, 8),      # Туркменистан
+    '994': (9, 9),      # Азербайджан
+    '995': (9, 9),      # Грузия
+    '996': (9, 9),      # Киргизия
+    '998': (9, 9),      # Узбекистан
+}
+
+# Код страны для номеров без «+» в национальном формате (8XXXXXXXXXX, 9XXXXXXXXX)
+DEFAULT_COUNTRY = '7'
+
+# Кандидат в номер: необязательный «+», затем 10-15 цифр, между которыми
+# допускаются пробелы, дефисы, точки и скобки (+7 (999) 123-45-67)
+PHONE_RE = re.compile(r'(?<![\w+])\+?\(?\d(?:[ \t\-.()]{0,3}\d){9,14}(?!\d)')
+
+# Всё, что не может входить в имя
+NAME_JUNK_RE = re.compile(r'[^\w\s\-]+')
+
+# Разделители, которые PHONE_RE допускает внутри номера
+_SEPARATORS = str.maketrans('', '', ' \t-.()+')
+
+# Максимальная длина кода страны в таблице
+_MAX_PREFIX = max(len(prefix) for prefix in COUNTRY_PREFIXES)
+
+
+def normalize_phone(raw: str) -> Optional[str]:
+    """
+    Привести номер к формату E.164
+    
+    Args:
+        raw: Номер в любом формате (+7 999 123-45-67, 89991234567, 375 29 123 45 67)
+    
+    Returns:
+        Номер вида +79991234567 или None, если номер некорректный
+    """
+    raw = raw.strip()
+    digits = raw.translate(_SEPARATORS)
+    if not digits.isdigit():
+        return None
+    
+    if not raw.startswith('+'):
+        # Национальный формат: 8 - выход на межгород, 10 цифр с 9 - мобильный без кода
+        if len(digits) == 11 and digits[0] == '8':
+            digits = DEFAULT_COUNTRY + digits[1:]
+        elif len(digits) == 10 and digits[0] == '9':
+            digits = DEFAULT_COUNTRY + digits
+    
+    for length in range(1, _MAX_PREFIX + 1):
+        bounds = COUNTRY_PREFIXES.get(digits[:length])
+        if bounds is not None:
+            national = len(digits) - length
+            if bounds[0] <= national <= bounds[1]:
+                return '+' + digits
+            return None
+    return None
+
+
+def extract_contact_info(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Извлечение имени и телефона из текста
+    
+    Returns:
+        (name, phone) или (None, None) если не найдено
+        (None, phone) если имени в тексте нет
+        (None, 'invalid') если формат номера неправильный
+    """
+    match = PHONE_RE.search(text)
+    if match is None:
+        return None, None
+    
+    phone = normalize_phone(match.group())
+    if phone is None:
+        return None, 'invalid'
+    
+    # Имя - это то, что осталось вокруг номера
+    rest = text[:match.start()] + ' ' + text[match.end():]
+    name = ' '.join(NAME_JUNK_RE.sub('', rest).split()).strip(' -')
+    
+    if not name:
+        return None, phone
+    
+    return name, phone
+
+
+def normalize_many(phones: Iterable[str]) -> List[Optional[str]]:
+    """
+    Пакетная нормализация номеров
+    
+    Args:
+        phones: Номера в произвольном формате
+    
+    Returns:
+        Номера в E.164 (None для некорректных) в том же порядке
+    """
+    return [normalize_phone(phone) if phone else None for phone in phones]
+
+
+def revalidate_contacts(rows: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str, Optional[str]]]:
+    """
+    Перепроверка сохранённых номеров
+    
+    Args:
+        rows: Пары (user_id, contact_phone)
+    
+    Yields:
+        (user_id, сохранённый номер, номер в E.164 или None) для номеров,
+        которые нужно исправить или которые не удалось разобрать
+    """
+    for user_id, stored in rows:
+        normalized = normalize_phone(stored) if stored else None
+        if normalized != stored:
+            yield user_id, stored, normalized
+
+
+async def revalidate_stored(apply: bool) -> Tuple[int, int]:
+    """
+    Перепроверить номера в хранилище (STORAGE_BACKEND)
+    
+    Args:
+        apply: Сохранить исправленные номера
+    
+    Returns:
+        (сколько номеров исправлено или нужно исправить, сколько не удалось разобрать)
+    """
+    from storage import create_storage
+    
+    db = create_storage()
+    fixed = invalid = 0
+    try:
+        async for page in db.iter_contact_pages():
+            updates = []
+            for user_id, stored, normalized in revalidate_contacts(page):
+                if normalized is None:
+                    invalid += 1
+                    print(f"{user_id}: не удалось разобрать номер {stored!r}")
+                else:
+                    fixed += 1
+                    updates.append((user_id, normalized))
+            if apply and updates:
+                await db.update_contact_phones(updates)
+    finally:
+        await db.close()
+    return fixed, invalid
+
+
+def main():
+    import argparse
+    import asyncio
+    
+    parser = argparse.ArgumentParser(description='Перепроверка сохранённых номеров телефонов')
+    parser.add_argument('--apply', action='store_true', help='Сохранить номера в формате E.164')
+    args = parser.parse_args()
+    
+    fixed, invalid = asyncio.run(revalidate_stored(args.apply))
+    
+    action = 'исправлено' if args.apply else 'нужно исправить'
+    print(f"Номеров {action}: {fixed}, некорректных: {invalid}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Планировщик отложенных шагов воронки "Антистресс"
+
+Шаги хранятся в таблице scheduled_jobs, поэтому переживают перезапуск бота.
+Роль очереди с приоритетом играет индекс по due_at: в памяти хранится только
+время ближайшего шага, и единственная корутина спит ровно до него.
+Наступившие шаги забираются с арендой (claim_due_jobs), поэтому экземпляры
+бота с общей базой не выполнят один шаг дважды, а шаг упавшего экземпляра
+выполнится по истечении аренды.
+
+DeadlineTimer - тот же приём отдельно: сон до ближайшего срока из базы
+с досрочным пробуждением, если появился более ранний срок (им же пользуется
+цикл шагов воронки догрева).
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import config_timing
+
+logger = logging.getLogger(__name__)
+
+# Аренда забранного шага (секунды): за это время шаг должен выполниться и удалиться
+JOB_LEASE_SECONDS = 900
+
+
+class DeadlineTimer:
+    """Сон до ближайшего срока; срок раньше текущего будит досрочно"""
+    
+    def __init__(self, max_sleep: Optional[float] = None):
+        """
+        Args:
+            max_sleep: Наибольшая длительность сна (None - спать до срока или пробуждения)
+        """
+        self.max_sleep = max_sleep
+        self._wakeup = asyncio.Event()
+        self._deadline: Optional[float] = None
+    
+    def notify(self, due_at: float):
+        """
+        Сообщить о новом сроке (потокобезопасно вызывать через loop.call_soon_threadsafe)
+        
+        Args:
+            due_at: Unix-время нового срока
+        """
+        if self._deadline is None or due_at < self._deadline:
+            self._wakeup.set()
+    
+    def reset(self):
+        """
+        Начать новый проход (вызывается до чтения сроков из базы)
+        
+        Сроки, о которых сообщат после этого, разбудят следующий сон сразу:
+        срок прошлого сна забывается, иначе сообщение о более позднем сроке
+        во время прохода было бы отброшено, а проход мог его и не увидеть.
+        """
+        self._wakeup.clear()
+        self._deadline = None
+    
+    async def sleep_until(self, deadline: Optional[float]):
+        """
+        Уснуть до срока или до пробуждения через notify
+        
+        Args:
+            deadline: Unix-время ближайшего срока (None - сроков нет)
+        """
+        self._deadline = deadline
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        if self.max_sleep is not None:
+            timeout = self.max_sleep if timeout is None else min(timeout, self.max_sleep)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class JobScheduler:
+    """Единый планировщик отложенных шагов вместо отдельной задачи на каждого пользователя"""
+    
+    def __init__(self, db, batch_size: int = 100, max_sleep: float = config_timing.CHECK_INTERVAL_SECONDS,
+                 lease_seconds: int = JOB_LEASE_SECONDS):
+        """
+        Args:
+            db: Хранилище (storage.Storage)
+            batch_size: Сколько наступивших шагов выполнять за один проход
+            max_sleep: Страховочная проверка базы (шаги, запланированные извне, не будят планировщик)
+            lease_seconds: Аренда забранного шага
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self._handlers: Dict[str, Callable[[int], Awaitable[None]]] = {}
+        self._timer = DeadlineTimer(max_sleep)
+        self._task: Optional[asyncio.Task] = None
+    
+    def register(self, step: str, handler: Callable[[int], Awaitable[None]]):
+        """
+        Зарегистрировать обработчик шага
+        
+        Args:
+            step: Название шага
+            handler: Корутина, принимающая ID пользователя
+        """
+        self._handlers[step] = handler
+    
+    async def schedule(self, user_id: int, step: str, delay_seconds: float):
+        """
+        Запланировать шаг для пользователя
+        
+        Args:
+            user_id: ID пользователя
+            step: Название шага
+            delay_seconds: Задержка до запуска
+        """
+        due_at = int(time.time() + delay_seconds)
+        await self.db.schedule_job(user_id, step, due_at)
+        
+        # Будим планировщик, если новый шаг раньше того, до которого он спит
+        self._timer.notify(due_at)
+    
+    def start(self):
+        """Запустить планировщик (незавершённые шаги подхватываются из базы)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановить планировщик"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        """Основной цикл: выполнить наступившие шаги и уснуть до следующего"""
+        while True:
+            self._timer.reset()
+            try:
+                jobs = await self.db.claim_due_jobs(self.batch_size, self.lease_seconds)
+                if jobs:
+                    await asyncio.gather(*(self._run_job(job) for job in jobs))
+                    if len(jobs) == self.batch_size:
+                        continue
+                next_due = await self.db.get_next_job_due()
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике отложенных шагов: {e}")
+                next_due = int(time.time()) + 5
+            
+            await self._timer.sleep_until(next_due)
+    
+    async def _run_job(self, job: Dict):
+        """Выполнить шаг и удалить его из очереди"""
+        handler = self._handlers.get(job['step'])
+        if handler is None:
+            logger.error(f"Нет обработчика для шага {job['step']}, шаг пропущен")
+        else:
+            try:
+                await handler(job['user_id'])
+            except Exception as e:
+                logger.error(f"Ошибка шага {job['step']} для пользователя {job['user_id']}: {e}")
+        
+        await self.db.delete_job(job['user_id'], job['step'])
@@ -0,0 +1,323 @@
+"""
+Хранилище состояния бота: общий интерфейс и выбор реализации
+
+Обработчики, планировщик, рассылки и сводки администратору работают
+с хранилищем только через методы Storage. Реализации:
+    sqlite   - файл SQLite, запросы в отдельном потоке БД (database.AsyncDatabase)
+    memory   - словари в памяти процесса, для тестов и бенчмарков (storage_memory)
+    postgres - PostgreSQL через пул соединений asyncpg (storage_postgres);
+               несколько экземпляров бота могут работать с одной базой
+
+Всё, что выполняет фоновая работа - шаги воронки, отложенные шаги,
+сводки администратору и рассылки, - забирается с арендой: пока аренда
+не истекла, другой экземпляр эту работу не возьмёт, а работа упавшего
+экземпляра подхватывается после её истечения.
+
+Реализация выбирается настройкой STORAGE_BACKEND. Все методы - корутины,
+кроме watch_step_due, queue_depth и pending_writes.
+"""
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import config
+from database import PAGE_SIZE, AsyncDatabase, Database
+
+# Реализации хранилища по значению STORAGE_BACKEND
+BACKENDS = ('sqlite', 'memory', 'postgres')
+
+
+class Storage(ABC):
+    """
+    Интерфейс хранилища
+    
+    Семантика методов задана SQLite-реализацией (database.Database), остальные
+    реализации повторяют её: те же ключи словарей, та же аренда шагов воронки,
+    те же исключения недоступных пользователей из аудиторий.
+    """
+    
+    def __init__(self):
+        self._step_due_callbacks: List[Callable[[int], None]] = []
+    
+    # Пользователи
+    
+    @abstractmethod
+    async def add_user(self, user_id: int, username: Optional[str] = None,
+                       first_name: Optional[str] = None, last_name: Optional[str] = None) -> bool:
+        """Добавить пользователя (False - уже существует)"""
+    
+    @abstractmethod
+    async def get_user_info(self, user_id: int) -> Optional[Dict]:
+        """Информация о пользователе или None"""
+    
+    @abstractmethod
+    async def update_user_status(self, user_id: int, status: str, update_time: bool = True):
+        """Сменить статус; с update_time воронка догрева запускается или её таймер отсчитывается заново"""
+    
+    @abstractmethod
+    async def save_contact(self, user_id: int, name: str, phone: str):
+        """Сохранить контактные данные"""
+    
+    @abstractmethod
+    async def mark_inactive(self, user_id: int, reason: str):
+        """Отметить пользователя недоступным и остановить его воронку"""
+    
+    @abstractmethod
+    async def reactivate_user(self, user_id: int):
+        """Снять отметку о недоступности и продолжить воронку с текущего шага"""
+    
+    # Воронка догрева
+    
+    @abstractmethod
+    async def mark_step_sent(self, user_id: int, step: str):
+        """Отметить отправку шага и назначить следующий (возвращается после сохранения)"""
+    
+    @abstractmethod
+    async def claim_due_steps(self, limit: int, lease_seconds: int = config.WARMUP_CLAIM_SECONDS,
+                              now: Optional[int] = None,
+                              max_attempts: int = config.WARMUP_MAX_ATTEMPTS) -> List[Dict]:
+        """
+        Атомарно забрать наступившие шаги с арендой на lease_seconds (список user_id, step);
+        шаг, забранный max_attempts раз без отметки об отправке, останавливает воронку
+        """
+    
+    @abstractmethod
+    async def count_due_steps(self, now: Optional[int] = None) -> int:
+        """Количество наступивших шагов"""
+    
+    @abstractmethod
+    async def get_next_step_due(self) -> Optional[int]:
+        """Время ближайшего шага или None"""
+    
+    def watch_step_due(self, callback: Callable[[int], None]):
+        """
+        Подписаться на новые сроки шагов воронки
+        
+        Args:
+            callback: Функция, принимающая Unix-время нового срока
+        """
+        self._step_due_callbacks.append(callback)
+    
+    def _notify_step_due(self, due_at: int):
+        """Сообщить подписчикам о новом сроке шага воронки"""
+        for callback in self._step_due_callbacks:
+            callback(due_at)
+    
+    @abstractmethod
+    async def get_funnel_stats(self) -> Dict[str, int]:
+        """
+        Статистика воронки: total_users, with_contact, status_file_sent,
+        status_offer_sent, status_contact_provided, inactive, inactive_with_contact
+        """
+    
+    @abstractmethod
+    async def get_step_stats(self) -> Dict[str, int]:
+        """Сколько раз отправлен каждый шаг воронки (в порядке шагов)"""
+    
+    async def cache_stats(self) -> Dict[str, int]:
+        """Счётчики кеша состояния пользователей (у хранилищ без кеша - нули)"""
+        return {'hits': 0, 'misses': 0, 'size': 0, 'negative_hits': 0}
+    
+    # Аудитории рассылок
+    
+    @abstractmethod
+    async def get_audience_page(self, audience: str, after_user_id: int = 0,
+                                limit: int = PAGE_SIZE) -> List[int]:
+        """Страница аудитории: ID пользователей больше after_user_id по возрастанию"""
+    
+    async def iter_audience_pages(self, audience: str, after_user_id: int = 0,
+                                  page_size: int = PAGE_SIZE) -> AsyncIterator[List[int]]:
+        """Постраничный обход аудитории рассылки"""
+        while True:
+            page = await self.get_audience_page(audience, after_user_id, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1]
+    
+    @abstractmethod
+    async def count_audience(self, audience: str) -> int:
+        """Размер аудитории (KeyError для неизвестной аудитории)"""
+    
+    # Перепроверка сохранённых номеров (phone.py)
+    
+    @abstractmethod
+    async def get_contact_page(self, after_user_id: int = 0, limit: int = PAGE_SIZE) -> List[Tuple[int, str]]:
+        """Страница контактов: пары (user_id, contact_phone) с user_id больше after_user_id по возрастанию"""
+    
+    async def iter_contact_pages(self, page_size: int = PAGE_SIZE) -> AsyncIterator[List[Tuple[int, str]]]:
+        """Постраничный обход сохранённых контактов"""
+        after_user_id = 0
+        while True:
+            page = await self.get_contact_page(after_user_id, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1][0]
+    
+    @abstractmethod
+    async def update_contact_phones(self, phones: List[Tuple[int, str]]):
+        """Пакетно заменить номера: пары (user_id, новый номер)"""
+    
+    # Кеш file_id
+    
+    @abstractmethod
+    async def get_cached_media(self, media_key: str) -> Optional[Dict]:
+        """Закешированный файл: file_id, file_hash, file_mtime или None"""
+    
+    @abstractmethod
+    async def save_cached_media(self, media_key: str, file_id: str, file_hash: str, file_mtime: float):
+        """Сохранить file_id загруженного файла"""
+    
+    @abstractmethod
+    async def delete_cached_media(self, media_key: str):
+        """Сбросить кеш file_id файла"""
+    
+    # Отложенные шаги (планировщик)
+    
+    @abstractmethod
+    async def schedule_job(self, user_id: int, step: str, due_at: int):
+        """Запланировать шаг (повторное планирование переносит время)"""
+    
+    @abstractmethod
+    async def claim_due_jobs(self, limit: int, lease_seconds: int, now: Optional[int] = None) -> List[Dict]:
+        """
+        Атомарно забрать наступившие шаги (список user_id, step): их срок переносится
+        на lease_seconds вперёд, и до удаления шаг повторится только после этого срока
+        """
+    
+    @abstractmethod
+    async def get_next_job_due(self) -> Optional[int]:
+        """Время ближайшего шага или None"""
+    
+    @abstractmethod
+    async def count_scheduled_jobs(self, step: str) -> int:
+        """Сколько шагов step ожидает запуска"""
+    
+    @abstractmethod
+    async def delete_job(self, user_id: int, step: str):
+        """Удалить выполненный шаг"""
+    
+    # Уведомления администратору
+    
+    @abstractmethod
+    async def add_admin_notification(self, user_id: int, name: str, phone: str, username: Optional[str]):
+        """Сохранить уведомление о контакте (возвращается после сохранения)"""
+    
+    @abstractmethod
+    async def claim_admin_notifications(self, limit: int, owner: str, lease_seconds: int,
+                                        now: Optional[int] = None) -> List[Dict]:
+        """
+        Забрать недоставленные уведомления в порядке поступления с арендой на lease_seconds
+        
+        Забираются свободные уведомления, уведомления с истёкшей арендой и уже
+        арендованные тем же owner (повтор неотправленной сводки).
+        """
+    
+    @abstractmethod
+    async def count_admin_notifications(self) -> int:
+        """Количество недоставленных уведомлений"""
+    
+    @abstractmethod
+    async def delete_admin_notifications(self, notification_ids: List[int]):
+        """Удалить доставленные уведомления"""
+    
+    # Рассылки
+    
+    @abstractmethod
+    async def create_broadcast(self, audience: str, description: str, message_text: str,
+                               admin_chat_id: int, total: int, source_chat_id: Optional[int] = None,
+                               source_message_id: Optional[int] = None, media_kind: Optional[str] = None,
+                               media_file_id: Optional[str] = None) -> int:
+        """Создать задание рассылки и вернуть его ID"""
+    
+    @abstractmethod
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        """Задание рассылки (поля таблицы broadcasts) или None"""
+    
+    @abstractmethod
+    async def get_broadcasts(self, statuses: Optional[List[str]] = None, limit: int = 10) -> List[Dict]:
+        """Последние задания рассылки, новые первыми"""
+    
+    @abstractmethod
+    async def claim_broadcast(self, broadcast_id: int, owner: str, lease_seconds: int,
+                              now: Optional[int] = None) -> bool:
+        """
+        Арендовать идущую рассылку для owner на lease_seconds или продлить его аренду
+        
+        Возвращает False, если рассылка не идёт (остановлена, отменена, завершена)
+        или арендована другим owner и аренда не истекла.
+        """
+    
+    @abstractmethod
+    async def release_broadcast(self, broadcast_id: int, owner: str):
+        """Снять аренду рассылки, если она принадлежит owner"""
+    
+    @abstractmethod
+    async def set_broadcast_status(self, broadcast_id: int, status: str):
+        """Изменить статус рассылки (cancelled и finished проставляют finished_at)"""
+    
+    @abstractmethod
+    async def set_broadcast_status_message(self, broadcast_id: int, message_id: int):
+        """Сохранить ID сообщения админу с прогрессом рассылки"""
+    
+    @abstractmethod
+    async def record_broadcast_delivery(self, broadcast_id: int, user_id: int, delivered: bool):
+        """Отметить результат отправки получателю (повторная отметка не учитывается)"""
+    
+    @abstractmethod
+    async def get_broadcast_deliveries(self, broadcast_id: int) -> set:
+        """Получатели после курсора, которым рассылка уже отправлена"""
+    
+    @abstractmethod
+    async def advance_broadcast_cursor(self, broadcast_id: int, cursor_user_id: int):
+        """Сдвинуть курсор рассылки и забыть доставки до него"""
+    
+    # Служебное
+    
+    def queue_depth(self) -> int:
+        """Сколько запросов ждут выполнения (у хранилищ без очереди - 0)"""
+        return 0
+    
+    def pending_writes(self) -> int:
+        """Сколько отложенных записей ждут сброса (у хранилищ без буфера - 0)"""
+        return 0
+    
+    @abstractmethod
+    async def close(self):
+        """Дождаться записей и закрыть соединения"""
+
+
+# SQLite-реализация проксирует методы Database через поток БД (__getattr__),
+# поэтому регистрируется как реализация интерфейса, а не наследуется от него
+Storage.register(AsyncDatabase)
+
+
+def create_storage(backend: str = config.STORAGE_BACKEND) -> Storage:
+    """
+    Создать хранилище по настройке
+    
+    Ни одна реализация не обращается к базе при создании: файл SQLite
+    открывается (и схема создаётся) в потоке БД при первом запросе,
+    пул PostgreSQL - при первом запросе в цикле событий. Поэтому хранилище
+    можно создавать при импорте, до запуска цикла событий.
+    
+    Args:
+        backend: sqlite, memory или postgres
+    
+    Returns:
+        Хранилище
+    
+    Raises:
+        ValueError: если реализация неизвестна
+    """
+    if backend == 'sqlite':
+        return AsyncDatabase(Database)
+    if backend == 'memory':
+        from storage_memory import MemoryStorage
+        return MemoryStorage()
+    if backend == 'postgres':
+        from storage_postgres import PostgresStorage
+        return PostgresStorage()
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={backend!r}, допустимо: {', '.join(BACKENDS)}")
@@ -0,0 +1,390 @@
+"""
+Хранилище в памяти процесса
+
+Для тестов и бенчмарков: не нужен ни файл, ни сервер БД, данные живут,
+пока жив объект. Семантика совпадает с SQLite-реализацией. Методы не
+уступают управление внутри себя, поэтому каждый вызов атомарен для
+остальных корутин без блокировок.
+"""
+import bisect
+import itertools
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import config
+from database import PAGE_SIZE
+from funnel import FUNNEL
+from storage import Storage
+
+# Условия отбора аудиторий рассылок (как database.AUDIENCE_FILTERS)
+AUDIENCE_CHECKS = {
+    'all': lambda user: user['inactive_at'] is None,
+    'no_contact': lambda user: user['inactive_at'] is None and not user['contact_provided'],
+    'with_contact': lambda user: user['inactive_at'] is None and bool(user['contact_provided']),
+}
+
+# Поля, которые возвращает get_user_info
+USER_INFO_FIELDS = (
+    'user_id', 'username', 'first_name', 'contact_name', 'contact_phone',
+    'status', 'added_date', 'contact_provided', 'inactive_at'
+)
+
+
+class MemoryStorage(Storage):
+    """Хранилище на словарях"""
+    
+    def __init__(self):
+        super().__init__()
+        self.users: Dict[int, Dict] = {}
+        # ID пользователей по возрастанию - для постраничного обхода аудиторий
+        self._user_ids: List[int] = []
+        # user_id -> {'step': ключ следующего шага, 'due_at': когда он наступает,
+        #             'attempts': сколько раз шаг забирался на отправку}
+        self.user_steps: Dict[int, Dict] = {}
+        self.step_sent: Counter = Counter()
+        self.media_cache: Dict[str, Dict] = {}
+        # (user_id, step) -> due_at
+        self.scheduled_jobs: Dict[tuple, int] = {}
+        self.admin_notifications: List[Dict] = []
+        self.broadcasts: Dict[int, Dict] = {}
+        # broadcast_id -> {user_id: delivered}
+        self.broadcast_deliveries: Dict[int, Dict[int, int]] = {}
+        self._notification_ids = itertools.count(1)
+        self._broadcast_ids = itertools.count(1)
+    
+    async def add_user(self, user_id: int, username: Optional[str] = None,
+                       first_name: Optional[str] = None, last_name: Optional[str] = None) -> bool:
+        if user_id in self.users:
+            return False
+        added_date = datetime.now().isoformat()
+        self.users[user_id] = {
+            'user_id': user_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'added_date': added_date,
+            'status': 'file_sent',
+            'contact_provided': 0,
+            'contact_name': None,
+            'contact_phone': None,
+            'last_message_time': added_date,
+            'inactive_at': None,
+            'inactive_reason': None,
+        }
+        bisect.insort(self._user_ids, user_id)
+        return True
+    
+    async def get_user_info(self, user_id: int) -> Optional[Dict]:
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        return {field: user[field] for field in USER_INFO_FIELDS}
+    
+    async def update_user_status(self, user_id: int, status: str, update_time: bool = True):
+        user = self.users.get(user_id)
+        if user is not None:
+            user['status'] = status
+            if update_time:
+                user['last_message_time'] = datetime.now().isoformat()
+        if not update_time:
+            return
+        
+        # Воронка стартует с первого шага; если она уже идёт, таймер текущего шага отсчитывается заново
+        now = int(time.time())
+        progress = self.user_steps.get(user_id)
+        if progress is None:
+            self.user_steps[user_id] = {
+                'step': FUNNEL.first.key, 'due_at': now + FUNNEL.first.delay_seconds, 'attempts': 0
+            }
+        elif progress['step'] is not None:
+            progress.update(due_at=self._due_at(progress['step'], now), attempts=0)
+        self._notify_step_due(now + min(step.delay_seconds for step in FUNNEL.steps))
+    
+    async def save_contact(self, user_id: int, name: str, phone: str):
+        user = self.users.get(user_id)
+        if user is not None:
+            user.update(contact_provided=1, contact_name=name, contact_phone=phone, status='contact_provided')
+    
+    async def mark_inactive(self, user_id: int, reason: str):
+        user = self.users.get(user_id)
+        if user is None or user['inactive_at'] is not None:
+            return
+        user.update(inactive_at=int(time.time()), inactive_reason=reason)
+        progress = self.user_steps.get(user_id)
+        if progress is not None:
+            progress['due_at'] = None
+    
+    async def reactivate_user(self, user_id: int):
+        user = self.users.get(user_id)
+        if user is None or user['inactive_at'] is None:
+            return
+        user.update(inactive_at=None, inactive_reason=None)
+        progress = self.user_steps.get(user_id)
+        if progress is not None and progress['step'] is not None and progress['due_at'] is None:
+            progress.update(due_at=self._due_at(progress['step'], int(time.time())), attempts=0)
+            if progress['due_at'] is not None:
+                self._notify_step_due(progress['due_at'])
+    
+    @staticmethod
+    def _due_at(key: str, now: int) -> Optional[int]:
+        """Срок шага key, отсчитанный от now (None - такого шага в воронке больше нет)"""
+        step = FUNNEL.get(key)
+        return None if step is None else now + step.delay_seconds
+    
+    async def mark_step_sent(self, user_id: int, step: str):
+        now = int(time.time())
+        next_step = FUNNEL.next_step(step)
+        progress = self.user_steps.get(user_id)
+        if progress is not None and progress['step'] == step:
+            # Остановленная воронка (due_at is None) не возобновляется
+            if next_step is None:
+                progress.update(step=None, due_at=None, attempts=0)
+            else:
+                due_at = None if progress['due_at'] is None else now + next_step.delay_seconds
+                progress.update(step=next_step.key, due_at=due_at, attempts=0)
+            self.step_sent[step] += 1
+        user = self.users.get(user_id)
+        if user is not None:
+            user['last_message_time'] = datetime.now().isoformat()
+        if next_step is not None:
+            self._notify_step_due(now + next_step.delay_seconds)
+    
+    def _due_steps(self, now: int) -> List[tuple]:
+        """Наступившие шаги (due_at, user_id) в порядке наступления"""
+        return sorted(
+            (progress['due_at'], user_id) for user_id, progress in self.user_steps.items()
+            if progress['due_at'] is not None and progress['due_at'] <= now
+        )
+    
+    async def claim_due_steps(self, limit: int, lease_seconds: int = config.WARMUP_CLAIM_SECONDS,
+                              now: Optional[int] = None,
+                              max_attempts: int = config.WARMUP_MAX_ATTEMPTS) -> List[Dict]:
+        now = int(time.time()) if now is None else now
+        claimed = []
+        for _, user_id in self._due_steps(now)[:limit]:
+            progress = self.user_steps[user_id]
+            user = self.users.get(user_id)
+            if (progress['attempts'] < max_attempts and user is not None and user['inactive_at'] is None
+                    and FUNNEL.condition_matches(progress['step'], user)):
+                progress['due_at'] = now + lease_seconds
+                claimed.append({'user_id': user_id, 'step': progress['step']})
+            else:
+                progress['due_at'] = None
+            progress['attempts'] += 1
+        return claimed
+    
+    async def count_due_steps(self, now: Optional[int] = None) -> int:
+        return len(self._due_steps(int(time.time()) if now is None else now))
+    
+    async def get_next_step_due(self) -> Optional[int]:
+        return min(
+            (progress['due_at'] for progress in self.user_steps.values() if progress['due_at'] is not None),
+            default=None
+        )
+    
+    async def get_funnel_stats(self) -> Dict[str, int]:
+        users = self.users.values()
+        statuses = Counter(user['status'] for user in users)
+        return {
+            'total_users': len(self.users),
+            'with_contact': sum(1 for user in users if user['contact_provided'] == 1),
+            'status_file_sent': statuses['file_sent'],
+            'status_offer_sent': statuses['offer_sent'],
+            'status_contact_provided': statuses['contact_provided'],
+            'inactive': sum(1 for user in users if user['inactive_at'] is not None),
+            'inactive_with_contact': sum(
+                1 for user in users if user['inactive_at'] is not None and user['contact_provided'] == 1
+            ),
+        }
+    
+    async def get_step_stats(self) -> Dict[str, int]:
+        return {step.key: self.step_sent[step.key] for step in FUNNEL.steps}
+    
+    async def get_audience_page(self, audience: str, after_user_id: int = 0,
+                                limit: int = PAGE_SIZE) -> List[int]:
+        check = AUDIENCE_CHECKS[audience]
+        page = []
+        for user_id in itertools.islice(self._user_ids, bisect.bisect_right(self._user_ids, after_user_id), None):
+            if check(self.users[user_id]):
+                page.append(user_id)
+                if len(page) == limit:
+                    break
+        return page
+    
+    async def count_audience(self, audience: str) -> int:
+        check = AUDIENCE_CHECKS[audience]
+        return sum(1 for user in self.users.values() if check(user))
+    
+    async def get_contact_page(self, after_user_id: int = 0, limit: int = PAGE_SIZE) -> List[Tuple[int, str]]:
+        page = []
+        for user_id in itertools.islice(self._user_ids, bisect.bisect_right(self._user_ids, after_user_id), None):
+            user = self.users[user_id]
+            if user['contact_provided']:
+                page.append((user_id, user['contact_phone']))
+                if len(page) == limit:
+                    break
+        return page
+    
+    async def update_contact_phones(self, phones: List[Tuple[int, str]]):
+        for user_id, phone in phones:
+            if user_id in self.users:
+                self.users[user_id]['contact_phone'] = phone
+    
+    async def get_cached_media(self, media_key: str) -> Optional[Dict]:
+        cached = self.media_cache.get(media_key)
+        if cached is None:
+            return None
+        return {'file_id': cached['file_id'], 'file_hash': cached['file_hash'], 'file_mtime': cached['file_mtime']}
+    
+    async def save_cached_media(self, media_key: str, file_id: str, file_hash: str, file_mtime: float):
+        self.media_cache[media_key] = {
+            'file_id': file_id, 'file_hash': file_hash, 'file_mtime': file_mtime,
+            'updated_at': datetime.now().isoformat()
+        }
+    
+    async def delete_cached_media(self, media_key: str):
+        self.media_cache.pop(media_key, None)
+    
+    async def schedule_job(self, user_id: int, step: str, due_at: int):
+        self.scheduled_jobs[(user_id, step)] = due_at
+    
+    async def claim_due_jobs(self, limit: int, lease_seconds: int, now: Optional[int] = None) -> List[Dict]:
+        now = int(time.time()) if now is None else now
+        due = sorted(
+            (due_at, user_id, step) for (user_id, step), due_at in self.scheduled_jobs.items() if due_at <= now
+        )[:limit]
+        for _, user_id, step in due:
+            self.scheduled_jobs[(user_id, step)] = now + lease_seconds
+        return [{'user_id': user_id, 'step': step} for _, user_id, step in due]
+    
+    async def get_next_job_due(self) -> Optional[int]:
+        return min(self.scheduled_jobs.values(), default=None)
+    
+    async def count_scheduled_jobs(self, step: str) -> int:
+        return sum(1 for _, job_step in self.scheduled_jobs if job_step == step)
+    
+    async def delete_job(self, user_id: int, step: str):
+        self.scheduled_jobs.pop((user_id, step), None)
+    
+    async def add_admin_notification(self, user_id: int, name: str, phone: str, username: Optional[str]):
+        self.admin_notifications.append({
+            'notification_id': next(self._notification_ids), 'user_id': user_id, 'name': name,
+            'phone': phone, 'username': username, 'created_at': int(time.time()),
+            'claimed_by': None, 'claimed_until': None
+        })
+    
+    async def claim_admin_notifications(self, limit: int, owner: str, lease_seconds: int,
+                                        now: Optional[int] = None) -> List[Dict]:
+        now = int(time.time()) if now is None else now
+        claimed = [
+            row for row in self.admin_notifications
+            if row['claimed_until'] is None or row['claimed_until'] <= now or row['claimed_by'] == owner
+        ][:limit]
+        for row in claimed:
+            row['claimed_by'], row['claimed_until'] = owner, now + lease_seconds
+        return [
+            {key: value for key, value in row.items() if key not in ('claimed_by', 'claimed_until')}
+            for row in claimed
+        ]
+    
+    async def count_admin_notifications(self) -> int:
+        return len(self.admin_notifications)
+    
+    async def delete_admin_notifications(self, notification_ids: List[int]):
+        notification_ids = set(notification_ids)
+        self.admin_notifications = [
+            row for row in self.admin_notifications if row['notification_id'] not in notification_ids
+        ]
+    
+    async def create_broadcast(self, audience: str, description: str, message_text: str,
+                               admin_chat_id: int, total: int, source_chat_id: Optional[int] = None,
+                               source_message_id: Optional[int] = None, media_kind: Optional[str] = None,
+                               media_file_id: Optional[str] = None) -> int:
+        broadcast_id = next(self._broadcast_ids)
+        self.broadcasts[broadcast_id] = {
+            'broadcast_id': broadcast_id,
+            'audience': audience,
+            'description': description,
+            'message_text': message_text,
+            'status': 'running',
+            'admin_chat_id': admin_chat_id,
+            'status_message_id': None,
+            'cursor_user_id': 0,
+            'total': total,
+            'sent': 0,
+            'failed': 0,
+            'created_at': datetime.now().isoformat(),
+            'finished_at': None,
+            'source_chat_id': source_chat_id,
+            'source_message_id': source_message_id,
+            'media_kind': media_kind,
+            'media_file_id': media_file_id,
+            'claimed_by': None,
+            'claimed_until': None,
+        }
+        self.broadcast_deliveries[broadcast_id] = {}
+        return broadcast_id
+    
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        job = self.broadcasts.get(broadcast_id)
+        return dict(job) if job else None
+    
+    async def get_broadcasts(self, statuses: Optional[List[str]] = None, limit: int = 10) -> List[Dict]:
+        jobs = [
+            dict(self.broadcasts[broadcast_id]) for broadcast_id in sorted(self.broadcasts, reverse=True)
+            if not statuses or self.broadcasts[broadcast_id]['status'] in statuses
+        ]
+        return jobs[:limit]
+    
+    async def claim_broadcast(self, broadcast_id: int, owner: str, lease_seconds: int,
+                              now: Optional[int] = None) -> bool:
+        now = int(time.time()) if now is None else now
+        job = self.broadcasts.get(broadcast_id)
+        if job is None or job['status'] != 'running':
+            return False
+        if job['claimed_until'] is not None and job['claimed_until'] > now and job['claimed_by'] != owner:
+            return False
+        job['claimed_by'], job['claimed_until'] = owner, now + lease_seconds
+        return True
+    
+    async def release_broadcast(self, broadcast_id: int, owner: str):
+        job = self.broadcasts.get(broadcast_id)
+        if job is not None and job['claimed_by'] == owner:
+            job['claimed_by'] = job['claimed_until'] = None
+    
+    async def set_broadcast_status(self, broadcast_id: int, status: str):
+        job = self.broadcasts.get(broadcast_id)
+        if job is not None:
+            job['status'] = status
+            job['finished_at'] = datetime.now().isoformat() if status in ('cancelled', 'finished') else None
+    
+    async def set_broadcast_status_message(self, broadcast_id: int, message_id: int):
+        job = self.broadcasts.get(broadcast_id)
+        if job is not None:
+            job['status_message_id'] = message_id
+    
+    async def record_broadcast_delivery(self, broadcast_id: int, user_id: int, delivered: bool):
+        deliveries = self.broadcast_deliveries.setdefault(broadcast_id, {})
+        if user_id in deliveries:
+            return
+        deliveries[user_id] = int(delivered)
+        job = self.broadcasts.get(broadcast_id)
+        if job is not None:
+            job['sent' if delivered else 'failed'] += 1
+    
+    async def get_broadcast_deliveries(self, broadcast_id: int) -> set:
+        return set(self.broadcast_deliveries.get(broadcast_id, ()))
+    
+    async def advance_broadcast_cursor(self, broadcast_id: int, cursor_user_id: int):
+        job = self.broadcasts.get(broadcast_id)
+        if job is not None:
+            job['cursor_user_id'] = cursor_user_id
+        # Доставки до курсора больше не нужны - их покрывает сам курсор
+        deliveries = self.broadcast_deliveries.get(broadcast_id, {})
+        for user_id in [user_id for user_id in deliveries if user_id <= cursor_user_id]:
+            del deliveries[user_id]
+    
+    async def close(self):
+        pass
@@ -0,0 +1,174 @@
+"""
+Тесты обработчиков бота через заглушку Bot API (benchmarks.fake_bot_api)
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from telegram import Update
+
+import bot
+import config
+from benchmarks.fake_bot_api import FakeBotAPI
+from outbound import OutboundDispatcher
+from storage_memory import MemoryStorage
+
+
+def message_update(update_id: int, user_id: int, text=None, contact=None) -> dict:
+    """Обновление с сообщением пользователя в формате Bot API"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Иван'},
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if contact is not None:
+        message['contact'] = contact
+    return {'update_id': update_id, 'message': message}
+
+
+@pytest.fixture
+def run_bot(monkeypatch):
+    """
+    Выполнить сценарий с приложением бота, направленным на заглушку Bot API
+    
+    Сценарий - корутина (application, api, storage); хранилище бота - в памяти,
+    диспетчер исходящих новый: объекты asyncio привязаны к своему циклу событий.
+    """
+    storage = MemoryStorage()
+    monkeypatch.setattr(bot, 'db', storage)
+    monkeypatch.setattr(bot, 'outbound', OutboundDispatcher())
+    monkeypatch.setattr(config, 'BOT_TOKEN', '123456:TEST')
+    
+    async def scenario(check):
+        api = FakeBotAPI()
+        await api.start()
+        monkeypatch.setattr(config, 'TELEGRAM_API_URL', api.url)
+        try:
+            await check(bot.build_application(), api, storage)
+        finally:
+            await api.stop()
+    
+    return lambda check: asyncio.run(scenario(check))
+
+
+@pytest.mark.parametrize('update', [
+    message_update(1, 42, text=config.CODE_WORD),
+    message_update(1, 42, contact={'phone_number': '+79991234567', 'first_name': 'Иван', 'user_id': 42}),
+    message_update(1, 42, text='/start'),
+], ids=['code_word', 'contact', 'start'])
+def test_inactive_user_is_reactivated_on_any_message(run_bot, update):
+    async def check(application, api, storage):
+        await storage.add_user(42, 'user', 'Иван')
+        await storage.mark_inactive(42, 'blocked')
+        
+        async with application:
+            await application.process_update(Update.de_json(update, application.bot))
+        
+        assert (await storage.get_user_info(42))['inactive_at'] is None
+    
+    run_bot(check)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def port_open(port: int) -> bool:
+    with socket.socket() as sock:
+        return sock.connect_ex(('127.0.0.1', port)) == 0
+
+
+def post_update(url: str, update: dict, secret: str) -> int:
+    """Отправить обновление на вебхук, как Telegram; возвращает HTTP-статус"""
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_webhook_accepts_only_updates_with_secret(monkeypatch):
+    # Заглушка Bot API работает в своём потоке: run_webhook занимает основной поток своим циклом
+    api = FakeBotAPI()
+    api_loop = asyncio.new_event_loop()
+    api_loop.run_until_complete(api.start())
+    api_thread = threading.Thread(target=api_loop.run_forever, daemon=True)
+    api_thread.start()
+    
+    port = free_port()
+    for name, value in {
+        'BOT_TOKEN': '123456:TEST', 'TELEGRAM_API_URL': api.url, 'BOT_MODE': 'webhook',
+        'WEBHOOK_URL': 'https://bot.example.com', 'WEBHOOK_LISTEN': '127.0.0.1', 'WEBHOOK_PORT': port,
+        'WEBHOOK_PATH': 'hook', 'WEBHOOK_SECRET_TOKEN': 'right-secret',
+    }.items():
+        monkeypatch.setattr(config, name, value)
+    monkeypatch.setattr(bot, 'db', MemoryStorage())
+    monkeypatch.setattr(bot, 'outbound', OutboundDispatcher())
+    
+    statuses = {}
+    url = f'http://127.0.0.1:{port}/hook'
+    
+    def client(loop, application):
+        try:
+            wait_for(lambda: port_open(port))
+            statuses['wrong'] = post_update(url, message_update(1, 1, '/help'), 'wrong-secret')
+            statuses['right'] = post_update(url, message_update(2, 2, '/help'), 'right-secret')
+            wait_for(lambda: api.counts['sendMessage'] > 0)
+        finally:
+            loop.call_soon_threadsafe(application.stop_running)
+    
+    async def started(application):
+        threading.Thread(target=client, args=(asyncio.get_running_loop(), application)).start()
+    
+    build_application = bot.build_application
+    
+    def build():
+        # Фоновые задачи бота тесту не нужны - только приём обновлений
+        application = build_application()
+        application.post_init = started
+        application.post_shutdown = None
+        return application
+    
+    monkeypatch.setattr(bot, 'build_application', build)
+    try:
+        bot.main()
+    finally:
+        api_loop.call_soon_threadsafe(api_loop.stop)
+        api_thread.join()
+        api_loop.run_until_complete(api.stop())
+        api_loop.close()
+    
+    assert statuses == {'wrong': 403, 'right': 200}
+    # Ответ получил только отправитель обновления с правильным секретом
+    assert api.counts['sendMessage'] == 1
+    assert api.last_params['sendMessage']['chat_id'] == '2'
+    
+    webhook = api.last_params['setWebhook']
+    assert webhook['url'] == 'https://bot.example.com/hook'
+    assert webhook['secret_token'] == 'right-secret'
+    assert json.loads(webhook['allowed_updates']) == bot.ALLOWED_UPDATES
@@ -0,0 +1,109 @@
+"""
+Тесты рассылок: отправка после удаления исходного сообщения
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest
+
+from broadcast import BroadcastContent, BroadcastManager, BroadcastSourceLost, make_sender
+from storage_memory import MemoryStorage
+
+
+class FakeBot:
+    """Бот, у которого исходное сообщение рассылки удалено"""
+    
+    def __init__(self):
+        self.calls = []
+        self._message_ids = iter(range(1000, 2000))
+    
+    async def copy_message(self, **kwargs):
+        self.calls.append(('copy_message', kwargs['chat_id']))
+        raise BadRequest('Message to copy not found')
+    
+    async def send_sticker(self, chat_id, sticker, **kwargs):
+        self.calls.append(('send_sticker', chat_id, sticker, kwargs.get('caption')))
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(('send_message', chat_id, text))
+        return SimpleNamespace(message_id=next(self._message_ids))
+    
+    async def edit_message_text(self, **kwargs):
+        pass
+
+
+def test_deleted_sticker_is_resent_by_file_id_without_caption():
+    bot = FakeBot()
+    content = BroadcastContent(
+        text='', source_chat_id=1, source_message_id=5, media_kind='sticker', media_file_id='STICKER'
+    )
+    send = make_sender(bot, content)
+    
+    asyncio.run(send(10))
+    
+    assert bot.calls == [('copy_message', 10), ('send_sticker', 10, 'STICKER', None)]
+
+
+def test_deleted_source_without_file_id_stops_sending():
+    bot = FakeBot()
+    send = make_sender(bot, BroadcastContent(text='', source_chat_id=1, source_message_id=5))
+    
+    async def run():
+        for chat_id in (10, 11):
+            with pytest.raises(BroadcastSourceLost):
+                await send(chat_id)
+    
+    asyncio.run(run())
+    
+    assert bot.calls == [('copy_message', 10)]
+
+
+def test_broadcast_is_cancelled_when_source_is_lost():
+    async def run():
+        db = MemoryStorage()
+        for user_id in range(10, 20):
+            await db.add_user(user_id)
+        bot = FakeBot()
+        manager = BroadcastManager(db, chunk_size=3)
+        content = BroadcastContent(text='', source_chat_id=1, source_message_id=5)
+        
+        broadcast_id = await manager.create(bot, 'all', 'всем', content, admin_chat_id=1)
+        await asyncio.gather(*manager._tasks.values())
+        return db, bot, broadcast_id
+    
+    db, bot, broadcast_id = asyncio.run(run())
+    
+    job = asyncio.run(db.get_broadcast(broadcast_id))
+    assert job['status'] == 'cancelled'
+    assert job['sent'] == 0
+    # Следующие пачки не начинаются
+    assert {call[1] for call in bot.calls if call[0] == 'copy_message'} <= {10, 11, 12}
+    assert 'отменена' in bot.calls[-1][2]
+
+
+def test_broadcast_resends_stored_file_id_without_media_cache():
+    async def run():
+        db = MemoryStorage()
+        for user_id in (10, 11):
+            await db.add_user(user_id)
+        bot = FakeBot()
+        manager = BroadcastManager(db)
+        content = BroadcastContent(
+            text='', source_chat_id=1, source_message_id=5, media_kind='sticker', media_file_id='STICKER'
+        )
+        
+        broadcast_id = await manager.create(bot, 'all', 'всем', content, admin_chat_id=1)
+        # file_id хранится в самом задании: возобновлённая рассылка читает его из базы
+        assert (await db.get_broadcast(broadcast_id))['media_file_id'] == 'STICKER'
+        await asyncio.gather(*manager._tasks.values())
+        return db, bot, broadcast_id
+    
+    db, bot, broadcast_id = asyncio.run(run())
+    
+    assert asyncio.run(db.get_broadcast(broadcast_id))['sent'] == 2
+    assert [call for call in bot.calls if call[0] == 'send_sticker'] == [
+        ('send_sticker', 10, 'STICKER', None), ('send_sticker', 11, 'STICKER', None)
+    ]
+    # Кеш PDF рассылка не трогает
+    assert db.media_cache == {}
@@ -0,0 +1,48 @@
+"""
+Тесты кешей состояния пользователей (cache.py)
+"""
+import time
+
+from cache import BloomFilter, UserStateCache
+
+
+def test_bloom_filter_has_no_false_negatives():
+    known = BloomFilter(1000)
+    user_ids = [user_id * 7919 for user_id in range(1, 1001)]
+    for user_id in user_ids:
+        known.add(user_id)
+    
+    assert all(user_id in known for user_id in user_ids)
+    assert known.count == 1000
+    # Доля ложноположительных ответов - порядка error_rate
+    false_positives = sum(user_id in known for user_id in range(10 ** 6, 10 ** 6 + 10000))
+    assert false_positives < 300
+
+
+def test_cache_evicts_least_recently_used():
+    cache = UserStateCache(max_size=2, ttl=60)
+    cache.put(1, {'status': 'file_sent'})
+    cache.put(2, {'status': 'file_sent'})
+    # Чтение делает запись свежей - вытесняется вторая
+    assert cache.get(1) == (True, {'status': 'file_sent'})
+    cache.put(3, None)
+    
+    assert cache.get(2) == (False, None)
+    # Отсутствие пользователя в базе тоже кешируется
+    assert cache.get(3) == (True, None)
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'size': 2}
+
+
+def test_cache_expires_and_updates_entries():
+    cache = UserStateCache(max_size=10, ttl=0.01)
+    cache.put(1, {'status': 'file_sent', 'inactive_at': None})
+    cache.update(1, status='offer_sent')
+    assert cache.get(1) == (True, {'status': 'offer_sent', 'inactive_at': None})
+    
+    # Обновление не создаёт записи для пользователя, которого нет в кеше
+    cache.update(2, status='offer_sent')
+    assert cache.get(2) == (False, None)
+    
+    time.sleep(0.02)
+    assert cache.get(1) == (False, None)
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,106 @@
+"""
+Тесты SQLite-хранилища (database.Database)
+"""
+import sqlite3
+
+import pytest
+
+from database import Database
+
+
+def test_inactive_user_is_known_after_restart(tmp_path):
+    db_path = str(tmp_path / 'users.db')
+    db = Database(db_path)
+    db.add_user(1, 'first')
+    db.add_user(2, 'second')
+    db.mark_inactive(2, 'blocked')
+    db.close()
+    
+    db = Database(db_path)
+    try:
+        user_info = db.get_user_info(2)
+        assert user_info is not None
+        assert user_info['inactive_at'] is not None
+        assert db.add_user(2, 'second') is False
+        
+        db.reactivate_user(2)
+        assert db.get_user_info(2)['inactive_at'] is None
+        assert db.count_audience('all') == 2
+    finally:
+        db.close()
+
+
+def test_step_stops_after_max_attempts(tmp_path):
+    db = Database(str(tmp_path / 'users.db'))
+    try:
+        db.add_user(1)
+        db.update_user_status(1, 'offer_sent')
+        now = db.get_next_step_due()
+        
+        for attempt in range(3):
+            claimed = db.claim_due_steps(10, lease_seconds=1, now=now + attempt * 2, max_attempts=3)
+            assert [job['user_id'] for job in claimed] == [1]
+        
+        assert db.claim_due_steps(10, lease_seconds=1, now=now + 10, max_attempts=3) == []
+        assert db.get_next_step_due() is None
+    finally:
+        db.close()
+
+
+def test_sent_step_resets_attempts(tmp_path):
+    db = Database(str(tmp_path / 'users.db'))
+    try:
+        db.add_user(1)
+        db.update_user_status(1, 'offer_sent')
+        now = db.get_next_step_due()
+        
+        first = db.claim_due_steps(10, lease_seconds=1, now=now, max_attempts=1)[0]['step']
+        db.mark_step_sent(1, first)
+        
+        due_at = db.get_next_step_due()
+        assert due_at is not None
+        assert db.claim_due_steps(10, now=due_at, max_attempts=1) != []
+    finally:
+        db.close()
+
+
+def test_user_added_after_negative_lookup_is_found(tmp_path):
+    db = Database(str(tmp_path / 'users.db'))
+    try:
+        # Незнакомого пользователя отсекает фильтр, не обращаясь к базе
+        assert db.get_user_info(1) is None
+        assert db.cache_stats()['negative_hits'] == 1
+        
+        # Ложноположительный ответ фильтра: отсутствие пользователя попадает в кеш
+        db.known_users.add(2)
+        assert db.get_user_info(2) is None
+        assert db.user_cache.get(2) == (True, None)
+        
+        # Добавление заменяет закешированное отсутствие - пользователь сразу виден
+        for user_id in (1, 2):
+            assert db.add_user(user_id, 'user') is True
+            assert db.get_user_info(user_id)['username'] == 'user'
+        assert db.cache_stats()['negative_hits'] == 1
+    finally:
+        db.close()
+
+
+def test_failed_flush_drops_cached_state(tmp_path):
+    db = Database(str(tmp_path / 'users.db'))
+    try:
+        db.add_user(1)
+        status_saved = db.defer_user_status(1, 'offer_sent')
+        # Кеш обновляется сразу, до коммита группы
+        assert db.get_user_info(1)['status'] == 'offer_sent'
+        
+        # Ошибочная запись в той же группе откатывает всю транзакцию
+        db.writes.add(('INSERT INTO missing_table (user_id) VALUES (?)', (1,)))
+        with pytest.raises(sqlite3.OperationalError):
+            db.flush_writes()
+        assert isinstance(status_saved.exception(), sqlite3.OperationalError)
+        
+        # Несохранённый статус не остаётся в кеше
+        assert db.user_cache.stats()['size'] == 0
+        assert db.get_user_info(1)['status'] == 'file_sent'
+    finally:
+        db.close()
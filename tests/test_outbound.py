@@ -0,0 +1,103 @@
+"""
+Тесты диспетчера исходящих сообщений (outbound.OutboundDispatcher)
+"""
+import asyncio
+import time
+
+import pytest
+from telegram.error import NetworkError
+
+import outbound
+from outbound import PRIORITY_BROADCAST, PRIORITY_FUNNEL, PRIORITY_INTERACTIVE, OutboundDispatcher
+
+
+def send(dispatcher: OutboundDispatcher, callback, chat_id: int, priority=None):
+    """Запрос sendMessage через диспетчер, как его отправляет python-telegram-bot"""
+    return dispatcher.process_request(callback, (chat_id,), {}, 'sendMessage', {'chat_id': chat_id}, priority)
+
+
+def test_waiting_requests_are_served_by_priority():
+    async def scenario():
+        dispatcher = OutboundDispatcher(rate=1000, per_chat_interval=0)
+        sent = []
+        
+        async def callback(chat_id):
+            sent.append(chat_id)
+        
+        # Запросы встают в очереди до запуска цикла: рассылка раньше всех
+        requests = [
+            asyncio.create_task(send(dispatcher, callback, chat_id, priority))
+            for chat_id, priority in ((1, PRIORITY_BROADCAST), (2, PRIORITY_BROADCAST),
+                                      (3, PRIORITY_FUNNEL), (4, None))
+        ]
+        await asyncio.sleep(0)
+        assert dispatcher.queue_depth() == 4
+        assert dispatcher.queue_depth(PRIORITY_INTERACTIVE) == 1
+        
+        await dispatcher.initialize()
+        try:
+            await asyncio.wait_for(asyncio.gather(*requests), 1)
+        finally:
+            await dispatcher.shutdown()
+        # Ответ пользователю, затем шаг воронки, рассылка - в порядке поступления
+        assert sent == [4, 3, 1, 2]
+    
+    asyncio.run(scenario())
+
+
+def test_busy_chat_does_not_block_other_chats():
+    async def scenario():
+        dispatcher = OutboundDispatcher(rate=1000, per_chat_interval=60)
+        sent = []
+        
+        async def callback(chat_id):
+            sent.append(chat_id)
+        
+        await dispatcher.initialize()
+        try:
+            await asyncio.wait_for(send(dispatcher, callback, 1, PRIORITY_BROADCAST), 1)
+            # Второе сообщение в тот же чат ждёт интервала, сообщение в другой чат уходит сразу
+            waiting = asyncio.create_task(send(dispatcher, callback, 1, PRIORITY_BROADCAST))
+            await asyncio.wait_for(send(dispatcher, callback, 2, PRIORITY_BROADCAST), 1)
+            assert sent == [1, 2]
+            assert not waiting.done()
+            waiting.cancel()
+        finally:
+            await dispatcher.shutdown()
+    
+    asyncio.run(scenario())
+
+
+def test_network_failures_in_a_row_pause_sending():
+    async def scenario():
+        dispatcher = OutboundDispatcher(rate=1000, per_chat_interval=0, max_retries=0)
+        
+        async def fail(chat_id):
+            raise NetworkError('connection reset')
+        
+        async def succeed(chat_id):
+            return chat_id
+        
+        await dispatcher.initialize()
+        try:
+            # Успешная отправка обнуляет серию ошибок
+            for callback in [fail] * (outbound.FAILURE_THRESHOLD - 1) + [succeed] + [fail]:
+                try:
+                    await asyncio.wait_for(send(dispatcher, callback, 1), 1)
+                except NetworkError:
+                    pass
+            assert dispatcher.bucket._blocked_until < time.monotonic()
+            
+            for _ in range(outbound.FAILURE_THRESHOLD - 1):
+                with pytest.raises(NetworkError):
+                    await asyncio.wait_for(send(dispatcher, fail, 1), 1)
+            # FAILURE_THRESHOLD ошибок подряд останавливают выдачу разрешений всем классам
+            assert dispatcher.bucket._blocked_until > time.monotonic() + outbound.COOLDOWN_SECONDS - 1
+            paused = asyncio.create_task(send(dispatcher, succeed, 2))
+            await asyncio.sleep(0.05)
+            assert not paused.done()
+            paused.cancel()
+        finally:
+            await dispatcher.shutdown()
+    
+    asyncio.run(scenario())
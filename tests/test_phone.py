@@ -0,0 +1,37 @@
+"""
+Тесты разбора контактов (phone.py) на корпусе benchmarks/phone_corpus.tsv
+"""
+import pytest
+
+from benchmarks.bench_phone import load_corpus
+from phone import extract_contact_info, normalize_many, normalize_phone, revalidate_contacts
+
+CORPUS = load_corpus()
+
+
+@pytest.mark.parametrize('text, name, phone', CORPUS, ids=[text for text, _, _ in CORPUS])
+def test_corpus(text, name, phone):
+    assert extract_contact_info(text) == (name, phone)
+
+
+def test_phones_are_stored_as_e164():
+    for text, _, phone in CORPUS:
+        if phone not in (None, 'invalid'):
+            assert phone.startswith('+') and phone[1:].isdigit()
+            # Повторная нормализация сохранённого номера его не меняет
+            assert normalize_phone(phone) == phone
+
+
+def test_normalize_national_formats():
+    assert normalize_many(['8 (999) 123-45-67', '999 123 45 67', '+375 29 123-45-67', '', None]) == [
+        '+79991234567', '+79991234567', '+375291234567', None, None
+    ]
+    # Без плюса код страны с 8 не путается с выходом на межгород
+    assert normalize_phone('89991234567') == '+79991234567'
+    assert normalize_phone('+89991234567') is None
+    assert normalize_phone('+7 999 123 45 6a') is None
+
+
+def test_revalidate_reports_only_changed_phones():
+    rows = [(1, '+79991234567'), (2, '8 999 123-45-67'), (3, '12345'), (4, None)]
+    assert list(revalidate_contacts(rows)) == [(2, '8 999 123-45-67', '+79991234567'), (3, '12345', None)]
@@ -0,0 +1,46 @@
+"""
+Тесты планировщика (scheduler.DeadlineTimer)
+"""
+import asyncio
+import time
+
+from scheduler import DeadlineTimer
+
+
+def test_notify_during_pass_wakes_next_sleep():
+    async def scenario():
+        timer = DeadlineTimer()
+        # Прошлый сон до наступившего срока
+        await timer.sleep_until(time.time() - 1)
+        
+        # Новый проход: пока читаются сроки, появился срок позже прошлого
+        timer.reset()
+        timer.notify(time.time() + 60)
+        
+        # Проход его не увидел и уснул бы без срока - сообщение должно разбудить сразу
+        await asyncio.wait_for(timer.sleep_until(None), 1)
+    
+    asyncio.run(scenario())
+
+
+def test_later_deadline_does_not_wake_sleep():
+    async def scenario():
+        timer = DeadlineTimer()
+        sleeping = asyncio.create_task(timer.sleep_until(time.time() + 0.2))
+        await asyncio.sleep(0)
+        timer.notify(time.time() + 60)
+        await asyncio.sleep(0.05)
+        assert not sleeping.done()
+        
+        timer.notify(time.time())
+        await asyncio.wait_for(sleeping, 1)
+    
+    asyncio.run(scenario())
+
+
+def test_max_sleep_bounds_sleep_without_deadline():
+    async def scenario():
+        timer = DeadlineTimer(max_sleep=0.05)
+        await asyncio.wait_for(timer.sleep_until(None), 1)
+    
+    asyncio.run(scenario())
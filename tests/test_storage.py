@@ -0,0 +1,333 @@
+"""
+Общие тесты реализаций хранилища (storage.Storage)
+
+Каждый тест выполняется для хранилища в памяти и SQLite, а для PostgreSQL -
+если задан DATABASE_URL. Тесты PostgreSQL работают в отдельной временной
+схеме и не трогают таблицы самой базы.
+"""
+import asyncio
+import os
+import secrets
+from functools import partial
+
+import pytest
+
+from database import AsyncDatabase, Database
+from funnel import FUNNEL
+from storage_memory import MemoryStorage
+
+BACKENDS = ('memory', 'sqlite', 'postgres')
+
+USER_INFO_FIELDS = {
+    'user_id', 'username', 'first_name', 'contact_name', 'contact_phone',
+    'status', 'added_date', 'contact_provided', 'inactive_at'
+}
+
+
+def _with_search_path(dsn: str, schema: str) -> str:
+    """Адрес базы, в котором все таблицы создаются в схеме schema"""
+    separator = '&' if '?' in dsn else '?'
+    return f'{dsn}{separator}search_path={schema}'
+
+
+@pytest.fixture(params=BACKENDS)
+def run(request, tmp_path):
+    """
+    Выполнить сценарий с новым пустым хранилищем
+    
+    Сценарий - корутина, принимающая хранилище; хранилище создаётся
+    и закрывается в том же цикле событий.
+    """
+    backend = request.param
+    if backend == 'postgres':
+        if not os.environ.get('DATABASE_URL'):
+            pytest.skip('DATABASE_URL не задан')
+        asyncpg = pytest.importorskip('asyncpg')
+    
+    async def scenario(check):
+        if backend == 'memory':
+            storage = MemoryStorage()
+        elif backend == 'sqlite':
+            storage = AsyncDatabase(partial(Database, str(tmp_path / 'users.db')))
+        else:
+            from storage_postgres import PostgresStorage
+            dsn = os.environ['DATABASE_URL']
+            schema = f'test_{secrets.token_hex(4)}'
+            conn = await asyncpg.connect(dsn)
+            await conn.execute(f'CREATE SCHEMA {schema}')
+            storage = PostgresStorage(_with_search_path(dsn, schema))
+        try:
+            await check(storage)
+        finally:
+            await storage.close()
+            if backend == 'postgres':
+                await conn.execute(f'DROP SCHEMA {schema} CASCADE')
+                await conn.close()
+    
+    return lambda check: asyncio.run(scenario(check))
+
+
+def test_users(run):
+    async def check(storage):
+        assert await storage.add_user(1, 'first', 'First') is True
+        assert await storage.add_user(1, 'first', 'First') is False
+        assert await storage.get_user_info(2) is None
+        
+        user_info = await storage.get_user_info(1)
+        assert set(user_info) == USER_INFO_FIELDS
+        assert user_info['username'] == 'first'
+        assert user_info['status'] == 'file_sent'
+        assert user_info['contact_provided'] == 0
+        assert user_info['inactive_at'] is None
+        
+        await storage.update_user_status(1, 'offer_sent', update_time=False)
+        await storage.save_contact(1, 'Иван', '+79991234567')
+        user_info = await storage.get_user_info(1)
+        assert user_info['status'] == 'contact_provided'
+        assert (user_info['contact_name'], user_info['contact_phone']) == ('Иван', '+79991234567')
+        
+        await storage.mark_inactive(1, 'blocked')
+        assert (await storage.get_user_info(1))['inactive_at'] is not None
+        await storage.reactivate_user(1)
+        assert (await storage.get_user_info(1))['inactive_at'] is None
+    
+    run(check)
+
+
+def test_funnel_stats(run):
+    async def check(storage):
+        for user_id in range(1, 6):
+            await storage.add_user(user_id)
+        for user_id in (2, 3, 4, 5):
+            await storage.update_user_status(user_id, 'offer_sent')
+        await storage.save_contact(3, 'Иван', '+79991234567')
+        await storage.save_contact(4, 'Пётр', '+79991234568')
+        await storage.mark_inactive(4, 'blocked')
+        await storage.mark_inactive(5, 'deactivated')
+        
+        assert await storage.get_funnel_stats() == {
+            'total_users': 5,
+            'with_contact': 2,
+            'status_file_sent': 1,
+            'status_offer_sent': 2,
+            'status_contact_provided': 2,
+            'inactive': 2,
+            'inactive_with_contact': 1,
+        }
+    
+    run(check)
+
+
+def test_step_leasing(run):
+    first = FUNNEL.first
+    
+    async def check(storage):
+        for user_id in (1, 2, 3):
+            await storage.add_user(user_id)
+            await storage.update_user_status(user_id, 'offer_sent')
+        await storage.save_contact(2, 'Иван', '+79991234567')
+        await storage.mark_inactive(3, 'blocked')
+        
+        due_at = await storage.get_next_step_due()
+        assert due_at is not None
+        assert await storage.claim_due_steps(10, now=due_at - 1) == []
+        # Сроки назначены в пределах пары секунд, к now наступили у всех
+        now = due_at + 5
+        assert await storage.count_due_steps(now=now) == 2
+        
+        # Контакт оставлен - условие шага не выполняется, и его воронка останавливается
+        claimed = await storage.claim_due_steps(10, lease_seconds=60, now=now)
+        assert claimed == [{'user_id': 1, 'step': first.key}]
+        assert await storage.count_due_steps(now=now) == 0
+        
+        # Забранный шаг арендован до истечения аренды
+        assert await storage.claim_due_steps(10, lease_seconds=60, now=now + 59) == []
+        assert await storage.claim_due_steps(10, lease_seconds=60, now=now + 60) == claimed
+        
+        await storage.mark_step_sent(1, first.key)
+        assert (await storage.get_step_stats())[first.key] == 1
+        next_step = FUNNEL.next_step(first.key)
+        if next_step is not None:
+            next_due = await storage.get_next_step_due()
+            assert next_due is not None
+            assert await storage.claim_due_steps(10, now=next_due) == [{'user_id': 1, 'step': next_step.key}]
+    
+    run(check)
+
+
+def test_step_stops_after_max_attempts(run):
+    async def check(storage):
+        await storage.add_user(1)
+        await storage.update_user_status(1, 'offer_sent')
+        due_at = await storage.get_next_step_due()
+        
+        for attempt in range(2):
+            claimed = await storage.claim_due_steps(10, lease_seconds=1, now=due_at + attempt * 2, max_attempts=2)
+            assert [job['user_id'] for job in claimed] == [1]
+        assert await storage.claim_due_steps(10, lease_seconds=1, now=due_at + 10, max_attempts=2) == []
+        assert await storage.get_next_step_due() is None
+        
+        # Новое предложение запускает воронку заново, попытки отсчитываются сначала
+        await storage.update_user_status(1, 'offer_sent')
+        due_at = await storage.get_next_step_due()
+        assert [job['user_id'] for job in await storage.claim_due_steps(10, now=due_at, max_attempts=2)] == [1]
+    
+    run(check)
+
+
+def test_audiences(run):
+    async def check(storage):
+        for user_id in (5, 1, 4, 2, 3):
+            await storage.add_user(user_id)
+        await storage.save_contact(2, 'Иван', '+79991234567')
+        await storage.save_contact(3, 'Пётр', '+79991234568')
+        await storage.mark_inactive(3, 'blocked')
+        await storage.mark_inactive(4, 'blocked')
+        
+        assert await storage.count_audience('all') == 3
+        assert await storage.count_audience('with_contact') == 1
+        assert await storage.count_audience('no_contact') == 2
+        with pytest.raises(KeyError):
+            await storage.count_audience('everyone')
+        
+        assert await storage.get_audience_page('all', limit=2) == [1, 2]
+        assert await storage.get_audience_page('all', after_user_id=2, limit=2) == [5]
+        assert await storage.get_audience_page('with_contact') == [2]
+        assert await storage.get_audience_page('no_contact') == [1, 5]
+        assert [page async for page in storage.iter_audience_pages('all', page_size=2)] == [[1, 2], [5]]
+    
+    run(check)
+
+
+def test_broadcasts(run):
+    async def check(storage):
+        first = await storage.create_broadcast('all', 'всем', 'Привет', admin_chat_id=100, total=3)
+        second = await storage.create_broadcast(
+            'no_contact', 'без контакта', '<b>Привет</b>', admin_chat_id=100, total=2,
+            source_chat_id=100, source_message_id=7, media_kind='photo', media_file_id='PHOTO'
+        )
+        
+        job = await storage.get_broadcast(second)
+        assert job['status'] == 'running'
+        assert (job['sent'], job['failed'], job['cursor_user_id']) == (0, 0, 0)
+        assert (job['source_chat_id'], job['source_message_id'], job['media_kind']) == (100, 7, 'photo')
+        assert job['media_file_id'] == 'PHOTO'
+        assert (await storage.get_broadcast(first))['media_file_id'] is None
+        assert await storage.get_broadcast(second + 100) is None
+        
+        await storage.set_broadcast_status_message(first, 555)
+        await storage.record_broadcast_delivery(first, 1, True)
+        await storage.record_broadcast_delivery(first, 1, True)
+        await storage.record_broadcast_delivery(first, 2, False)
+        await storage.record_broadcast_delivery(first, 3, True)
+        job = await storage.get_broadcast(first)
+        assert (job['sent'], job['failed'], job['status_message_id']) == (2, 1, 555)
+        assert await storage.get_broadcast_deliveries(first) == {1, 2, 3}
+        
+        await storage.advance_broadcast_cursor(first, 2)
+        assert (await storage.get_broadcast(first))['cursor_user_id'] == 2
+        assert await storage.get_broadcast_deliveries(first) == {3}
+        
+        await storage.set_broadcast_status(first, 'finished')
+        assert (await storage.get_broadcast(first))['finished_at'] is not None
+        assert [job['broadcast_id'] for job in await storage.get_broadcasts()] == [second, first]
+        assert [job['broadcast_id'] for job in await storage.get_broadcasts(statuses=['running'])] == [second]
+    
+    run(check)
+
+
+def test_broadcast_lease(run):
+    async def check(storage):
+        broadcast_id = await storage.create_broadcast('all', 'всем', 'Привет', admin_chat_id=100, total=3)
+        
+        assert await storage.claim_broadcast(broadcast_id, 'first', lease_seconds=60, now=1000) is True
+        assert await storage.claim_broadcast(broadcast_id, 'second', lease_seconds=60, now=1059) is False
+        # Владелец продлевает аренду
+        assert await storage.claim_broadcast(broadcast_id, 'first', lease_seconds=60, now=1050) is True
+        assert await storage.claim_broadcast(broadcast_id, 'second', lease_seconds=60, now=1100) is False
+        # Аренда упавшего экземпляра истекла
+        assert await storage.claim_broadcast(broadcast_id, 'second', lease_seconds=60, now=1110) is True
+        
+        # Чужую аренду не снять, свою - можно
+        await storage.release_broadcast(broadcast_id, 'first')
+        assert await storage.claim_broadcast(broadcast_id, 'first', lease_seconds=60, now=1111) is False
+        await storage.release_broadcast(broadcast_id, 'second')
+        assert await storage.claim_broadcast(broadcast_id, 'first', lease_seconds=60, now=1111) is True
+        
+        # Приостановленную рассылку не продлить даже владельцу
+        await storage.set_broadcast_status(broadcast_id, 'paused')
+        assert await storage.claim_broadcast(broadcast_id, 'first', lease_seconds=60, now=1112) is False
+        assert await storage.claim_broadcast(broadcast_id + 100, 'first', lease_seconds=60) is False
+    
+    run(check)
+
+
+def test_admin_notifications(run):
+    async def check(storage):
+        for user_id in (1, 2, 3):
+            await storage.add_admin_notification(user_id, f'Имя {user_id}', f'+7999000000{user_id}', None)
+        assert await storage.count_admin_notifications() == 3
+        
+        batch = await storage.claim_admin_notifications(2, 'first', lease_seconds=60, now=1000)
+        assert [row['user_id'] for row in batch] == [1, 2]
+        assert batch[0]['name'] == 'Имя 1'
+        
+        # Забранные уведомления другой экземпляр не видит, пока аренда не истекла
+        other = await storage.claim_admin_notifications(10, 'second', lease_seconds=60, now=1000)
+        assert [row['user_id'] for row in other] == [3]
+        # Владелец забирает свои повторно - для повтора неотправленной сводки
+        assert await storage.claim_admin_notifications(10, 'first', lease_seconds=60, now=1000) == batch
+        
+        await storage.delete_admin_notifications([row['notification_id'] for row in batch])
+        assert await storage.count_admin_notifications() == 1
+        # Аренда упавшего экземпляра истекла - его уведомления забирает другой
+        expired = await storage.claim_admin_notifications(10, 'first', lease_seconds=60, now=1060)
+        assert expired == other
+    
+    run(check)
+
+
+def test_scheduled_jobs_and_media_cache(run):
+    async def check(storage):
+        await storage.schedule_job(1, 'offer', 200)
+        await storage.schedule_job(2, 'offer', 100)
+        await storage.schedule_job(1, 'offer', 300)
+        assert await storage.count_scheduled_jobs('offer') == 2
+        assert await storage.get_next_job_due() == 100
+        assert await storage.claim_due_jobs(1, lease_seconds=60, now=300) == [{'user_id': 2, 'step': 'offer'}]
+        assert await storage.claim_due_jobs(10, lease_seconds=60, now=300) == [{'user_id': 1, 'step': 'offer'}]
+        # Забранные шаги арендованы: до удаления они вернутся только по истечении аренды
+        assert await storage.claim_due_jobs(10, lease_seconds=60, now=359) == []
+        assert await storage.get_next_job_due() == 360
+        await storage.delete_job(2, 'offer')
+        assert await storage.claim_due_jobs(10, lease_seconds=60, now=360) == [{'user_id': 1, 'step': 'offer'}]
+        
+        await storage.save_cached_media('file.pdf', 'FILE_ID', 'hash', 1.5)
+        assert await storage.get_cached_media('file.pdf') == {
+            'file_id': 'FILE_ID', 'file_hash': 'hash', 'file_mtime': 1.5
+        }
+        await storage.delete_cached_media('file.pdf')
+        assert await storage.get_cached_media('file.pdf') is None
+    
+    run(check)
+
+
+def test_contact_pages(run):
+    async def check(storage):
+        for user_id in (4, 1, 3, 2):
+            await storage.add_user(user_id)
+        await storage.save_contact(1, 'Иван', '8 999 123-45-67')
+        await storage.save_contact(3, 'Пётр', '+79991234568')
+        await storage.save_contact(4, 'Анна', '+79991234569')
+        
+        assert await storage.get_contact_page(limit=2) == [(1, '8 999 123-45-67'), (3, '+79991234568')]
+        assert await storage.get_contact_page(after_user_id=3) == [(4, '+79991234569')]
+        assert [page async for page in storage.iter_contact_pages(page_size=2)] == [
+            [(1, '8 999 123-45-67'), (3, '+79991234568')], [(4, '+79991234569')]
+        ]
+        
+        await storage.update_contact_phones([(1, '+79991234567')])
+        assert (await storage.get_user_info(1))['contact_phone'] == '+79991234567'
+        assert (await storage.get_contact_page(limit=1)) == [(1, '+79991234567')]
+    
+    run(check)
@@ -0,0 +1,133 @@
+"""
+Тесты обработки входящих обновлений (updates.py)
+"""
+import asyncio
+import gc
+
+from telegram import Update
+
+import metrics
+from updates import InboundThrottle, PerUserUpdateProcessor, UserLocks
+
+
+def message_update(update_id: int, user_id: int) -> Update:
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Иван'},
+            'text': 'привет',
+        },
+    }, None)
+
+
+def throttled_total() -> float:
+    return metrics.INBOUND_THROTTLED._values.get((), 0)
+
+
+def test_user_locks_serialize_one_user_only():
+    async def scenario():
+        locks = UserLocks()
+        events = []
+        
+        async def work(user_id, name):
+            async with locks.hold(user_id):
+                events.append(f'{name}+')
+                await asyncio.sleep(0.01)
+                events.append(f'{name}-')
+        
+        await asyncio.gather(work(1, 'a'), work(1, 'b'), work(2, 'c'))
+        # Блоки одного пользователя не пересекаются и идут в порядке вызова,
+        # другой пользователь не ждёт
+        assert events.index('a-') < events.index('b+')
+        assert events.index('c+') < events.index('a-')
+        
+        # Блокировки отпущенных пользователей не хранятся
+        gc.collect()
+        assert len(locks) == 0
+    
+    asyncio.run(scenario())
+
+
+def test_processor_keeps_order_per_user():
+    async def scenario():
+        processor = PerUserUpdateProcessor(8)
+        handled = []
+        
+        async def handle(update_id, delay):
+            await asyncio.sleep(delay)
+            handled.append(update_id)
+        
+        # Первое обновление пользователя 1 обрабатывается дольше всех
+        await asyncio.gather(
+            processor.process_update(message_update(1, 1), handle(1, 0.03)),
+            processor.process_update(message_update(2, 1), handle(2, 0)),
+            processor.process_update(message_update(3, 2), handle(3, 0)),
+        )
+        assert handled == [3, 1, 2]
+    
+    asyncio.run(scenario())
+
+
+def test_throttle_allows_burst_then_refills():
+    throttle = InboundThrottle(rate=1, burst=2, max_users=10)
+    assert [throttle.allow(1, now=0) for _ in range(3)] == [True, True, False]
+    # Другой пользователь расходует своё ведро
+    assert throttle.allow(2, now=0) is True
+    assert throttle.allow(1, now=0.5) is False
+    assert throttle.allow(1, now=1) is True
+
+
+def test_throttle_evicts_full_and_oldest_buckets():
+    throttle = InboundThrottle(rate=1, burst=2, max_users=2)
+    throttle.allow(1, now=0)
+    throttle.allow(2, now=1)
+    # Ведро первого за 2 секунды снова полное и удаляется
+    throttle.allow(3, now=2)
+    assert len(throttle) == 2
+    
+    # Сверх max_users вытесняется давно писавший
+    throttle.allow(4, now=2.5)
+    assert len(throttle) == 2
+    assert list(throttle._buckets) == [3, 4]
+
+
+def test_processor_drops_flood_without_waiting_for_user_lock():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4, InboundThrottle(rate=0.001, burst=1, max_users=10))
+        handled = []
+        
+        async def handle(update_id):
+            handled.append(update_id)
+        
+        before = throttled_total()
+        async with processor.locks.hold(1):
+            # Первое обновление ждёт блокировку пользователя
+            first = asyncio.create_task(processor.process_update(message_update(1, 1), handle(1)))
+            await asyncio.sleep(0)
+            # Лишнее отбрасывается сразу, не вставая в очередь
+            await asyncio.wait_for(processor.process_update(message_update(2, 1), handle(2)), 1)
+            assert not first.done()
+        await first
+        
+        assert handled == [1]
+        assert throttled_total() == before + 1
+    
+    asyncio.run(scenario())
+
+
+def test_processor_does_not_throttle_exempt_user():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4, InboundThrottle(rate=0.001, burst=1, max_users=10), exempt=(1,))
+        handled = []
+        
+        async def handle(update_id):
+            handled.append(update_id)
+        
+        for update_id in range(3):
+            await processor.process_update(message_update(update_id, 1), handle(update_id))
+        assert handled == [0, 1, 2]
+    
+    asyncio.run(scenario())
@@ -0,0 +1,157 @@
+"""
+Параллельная обработка входящих обновлений с очередностью для каждого пользователя
+
+Обновления разных пользователей обрабатываются одновременно (до
+UPDATE_CONCURRENCY), а обновления одного пользователя - строго по порядку:
+обработчики читают состояние пользователя и действуют по нему, и два его
+сообщения, обработанные параллельно, могли бы, например, дважды отправить PDF.
+
+InboundThrottle отбрасывает лишние обновления пользователя, который шлёт
+сообщения чаще разрешённого, ещё до очереди пользователя: отброшенное
+обновление не ждёт блокировку, не доходит до обработчиков, запросов к базе
+и лимита исходящих сообщений.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Collection, Hashable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class UserLocks:
+    """
+    Реестр блокировок по ключу (ID пользователя)
+    
+    Блокировка существует, пока её держат или ждут: реестр хранит слабые
+    ссылки, и блокировки неактивных пользователей удаляются сборщиком мусора.
+    Поэтому память не растёт с числом пользователей.
+    """
+    
+    def __init__(self):
+        self._locks: 'weakref.WeakValueDictionary[Hashable, asyncio.Lock]' = weakref.WeakValueDictionary()
+    
+    def __len__(self) -> int:
+        return len(self._locks)
+    
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """Выполнить блок, пока никто другой не выполняет блок с тем же ключом"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        async with lock:
+            yield
+
+
+class InboundThrottle:
+    """
+    Token bucket на каждого пользователя для входящих обновлений
+    
+    Ведро хранится только у недавно писавших: через burst / rate секунд
+    тишины оно снова полное, то есть не отличается от нового, и удаляется.
+    Число вёдер дополнительно ограничено max_users (вытесняются давно
+    писавшие), поэтому память ограничена при любом числе пользователей.
+    """
+    
+    def __init__(self, rate: float = config.INBOUND_RATE_PER_SECOND,
+                 burst: float = config.INBOUND_BURST, max_users: int = config.INBOUND_THROTTLE_USERS):
+        """
+        Args:
+            rate: Сколько обновлений в секунду разрешено пользователю в среднем
+            burst: Сколько обновлений подряд разрешено после паузы
+            max_users: Максимум отслеживаемых пользователей
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.idle_after = burst / rate
+        # user_id -> (токены, время обновления); порядок - от давно писавших к недавним
+        self._buckets: 'OrderedDict[Hashable, Tuple[float, float]]' = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._buckets)
+    
+    def allow(self, key: Hashable, now: Optional[float] = None) -> bool:
+        """
+        Учесть обновление пользователя
+        
+        Returns:
+            True - обработать, False - лимит превышен, обновление отбрасывается
+        """
+        now = time.monotonic() if now is None else now
+        state = self._buckets.pop(key, None)
+        if state is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+        
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._evict(now)
+        return allowed
+    
+    def _evict(self, now: float):
+        """Удалить вёдра, которые уже снова полные, и лишние сверх max_users"""
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if now - updated < self.idle_after and len(self._buckets) <= self.max_users:
+                return
+            del self._buckets[key]
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик обновлений PTB: параллельно для разных пользователей, по порядку для одного"""
+    
+    def __init__(self, max_concurrent_updates: int = config.UPDATE_CONCURRENCY,
+                 throttle: Optional[InboundThrottle] = None, exempt: Collection[int] = ()):
+        """
+        Args:
+            max_concurrent_updates: Сколько обновлений обрабатывать одновременно
+            throttle: Защита от флуда (None - без ограничения)
+            exempt: ID пользователей, которых защита от флуда не ограничивает
+        """
+        super().__init__(max_concurrent_updates)
+        self.locks = UserLocks()
+        self.throttle = throttle
+        self.exempt = exempt
+    
+    async def process_update(self, update: object, coroutine: Awaitable[Any]):
+        """Дождаться предыдущих обновлений пользователя, затем занять общий слот"""
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        # Лишнее обновление отбрасывается до очереди пользователя и не ждёт блокировку
+        if self.throttle is not None and user.id not in self.exempt and not self.throttle.allow(user.id):
+            metrics.INBOUND_THROTTLED.inc()
+            logger.debug(f"Сообщение пользователя {user.id} отброшено защитой от флуда")
+            if asyncio.iscoroutine(coroutine):
+                coroutine.close()
+            return
+        
+        # Ожидание своей очереди не занимает слот: один пользователь,
+        # приславший много сообщений подряд, не задерживает остальных
+        async with self.locks.hold(user.id):
+            await super().process_update(update, coroutine)
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass